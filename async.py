@@ -26,7 +26,7 @@ import subprocess
 from optparse import OptionParser
 
 from async import __version__
-from async.config import AsyncConfig, AsyncConfigError
+from async.config import load_config, AsyncConfigError
 
 import async.archui as ui
 import async.cmd as cmd
@@ -154,6 +154,15 @@ parser.add_option("-f", "--force", action="store", type="string", default=None,
 parser.add_option("-d", "--dirs", action="store", type="string", default=None, dest="dirs",
                   help="Only sync the dirs given as a comma separated list.")
 
+parser.add_option("-j", "--jobs", action="store", type="int", default=None, dest="jobs",
+                  help="Number of directories to query concurrently.")
+
+parser.add_option("--cached", action="store_true", default=False, dest="cached",
+                  help="Reuse directory statuses cached by a previous ls, if still valid.")
+
+parser.add_option("--refresh", action="store_true", default=False, dest="refresh",
+                  help="Recompute all directory statuses and refresh the cache.")
+
 parser.add_option("--older", action="store", type="int", default=0, dest="older",
                   help="Only sync if last sync took place before the given amount of minutes")
 
@@ -207,7 +216,7 @@ else:
 
 try:
     # parse config
-    conf = AsyncConfig(os.path.expandvars('$HOME/.config/async/'))
+    conf = load_config(os.path.expandvars('$HOME/.config/async/'))
 
     # UI settings
     if opts.debug: ui.set_debug(1)
@@ -22,23 +22,6 @@ import re
 import os
 from collections import OrderedDict
 
-_cc = OrderedDict()
-
-# Load curses
-try:
-    import curses
-    curses.setupterm()
-
-    _numcolors = curses.tigetnum('colors')
-    _setfg = curses.tigetstr('setaf')
-    _setbg = curses.tigetstr('setab')
-    _bold  = curses.tigetstr('bold')
-    _reset = curses.tigetstr('sgr0')
-
-except:
-    _numcolors = 2
-
-
 # Encode in ascii
 if sys.version_info[0] <= 2:
     def _str(n):
@@ -51,29 +34,65 @@ else:
 if sys.version_info[0] <= 2:
     input = raw_input
 
-if _numcolors >= 16:
-    for i, k in enumerate("krgybmcw"):
-        _cc[k.upper()] = _str(_reset + curses.tparm(_setfg, i))     # dark
-        _cc[k]         = _str(_reset + curses.tparm(_setfg, i + 8)) # light
-        _cc['*'+k]     = _str(_bold + curses.tparm(_setfg, i))      # bold
-        _cc['t']       = _str(_reset)
-        _cc['#']       = "#"
-
-elif _numcolors >= 8:
-    for i, k in enumerate("krgybmcw"):
-        _cc[k.upper()] = _str(_reset + curses.tparm(_setfg, i)) # dark
-        _cc[k]         = _str(_bold + curses.tparm(_setfg, i))  # bold
-        _cc['*'+k]     = _str(_bold + curses.tparm(_setfg, i))  # bold
-        _cc['t']       = _str(_reset)
-        _cc['#']       = "#"
 
-else:
-    for i, k in enumerate("krgybmcw"):
-        _cc[k.upper()] = ""
-        _cc[k]         = ""
-        _cc['*'+k]     = ""
-        _cc['t']       = "\033[0m"
-        _cc['#']       = "#"
+# color codes. Filled in on first use, so we do not pay for the curses setup on startup.
+_cc = None
+_color_re = None
+
+# memoized renderings of short strings, like status messages and table rows
+_color_memo = {}
+_color_memo_size = 1024
+_color_memo_maxlen = 256
+
+def _colors():
+    global _cc, _color_re
+    if _cc != None: return _cc
+
+    # Load curses
+    try:
+        import curses
+        curses.setupterm()
+
+        numcolors = curses.tigetnum('colors')
+        setfg = curses.tigetstr('setaf')
+        bold  = curses.tigetstr('bold')
+        reset = curses.tigetstr('sgr0')
+
+    except:
+        numcolors = 2
+
+    cc = OrderedDict()
+    if numcolors >= 16:
+        for i, k in enumerate("krgybmcw"):
+            cc[k.upper()] = _str(reset + curses.tparm(setfg, i))     # dark
+            cc[k]         = _str(reset + curses.tparm(setfg, i + 8)) # light
+            cc['*'+k]     = _str(bold + curses.tparm(setfg, i))      # bold
+            cc['t']       = _str(reset)
+            cc['#']       = "#"
+
+    elif numcolors >= 8:
+        for i, k in enumerate("krgybmcw"):
+            cc[k.upper()] = _str(reset + curses.tparm(setfg, i)) # dark
+            cc[k]         = _str(bold + curses.tparm(setfg, i))  # bold
+            cc['*'+k]     = _str(bold + curses.tparm(setfg, i))  # bold
+            cc['t']       = _str(reset)
+            cc['#']       = "#"
+
+    else:
+        for i, k in enumerate("krgybmcw"):
+            cc[k.upper()] = ""
+            cc[k]         = ""
+            cc['*'+k]     = ""
+            cc['t']       = "\033[0m"
+            cc['#']       = "#"
+
+    # a single regex matching any color code. Longer codes first, so #*r is not taken
+    # for an unknown code followed by text.
+    keys = sorted(cc.keys(), key=len, reverse=True)
+    _color_re = re.compile('#(%s)' % '|'.join([re.escape(k) for k in keys]))
+
+    _cc = cc
+    return _cc
 
 
 fc = {'done'  : '#G',
@@ -174,8 +193,29 @@ def get_line_width():
     else:   return _maxwidth
 
 
+_strip_re = re.compile(r'\x1b[^m]*m|\x1b[^B]*B')
+
 def strip_color(s):
-    return re.sub(r'\x1b[^m]*m|\x1b[^B]*B', '', s)
+    return _strip_re.sub('', s)
+
+
+def _render(s):
+    """Returns a tuple (colored, plain) with the color codes in s translated, and
+    removed, in a single pass over s."""
+    ret = _color_memo.get(s, None)
+    if ret != None: return ret
+
+    cc = _colors()
+    parts = _color_re.split(s)
+    colored = ''.join([cc[p] if i % 2 == 1 else p for i, p in enumerate(parts)]) + cc['t']
+    plain = ''.join(parts[0::2])
+    ret = (colored, plain)
+
+    if len(s) <= _color_memo_maxlen:
+        if len(_color_memo) >= _color_memo_size: _color_memo.clear()
+        _color_memo[s] = ret
+
+    return ret
 
 
 def color(s, use_color=None):
@@ -184,24 +224,26 @@ def color(s, use_color=None):
     if use_color == None:
         use_color = _use_color and _isatty
 
-    ret = s + '#t'
-    if use_color:
-        for k in _cc: ret = ret.replace('#'+k, _cc[k])
-    else:
-        for k in _cc: ret = ret.replace('#'+k, '')
-
-    return ret
+    colored, plain = _render(s)
+    if use_color: return colored
+    else:         return plain
 
 
 def print_color(text, file=sys.stdout):
     write_color(text + '\n', file)
 
 def write_color(text, file=sys.stdout, loglevel=4, debug=0):
-    global _debug
+    global _debug, _logger, _loglevel
+    logging = _logger != None and loglevel <= _loglevel
+    if not logging and debug > _debug: return
+
+    colored, plain = _render(text)
     if debug <= _debug:
-        file.write('%s' % color(text))
+        if _use_color and _isatty: file.write(colored)
+        else:                      file.write(plain)
         file.flush()
-    write_log(text, level=loglevel)
+
+    if logging: _logger.write(plain)
 
 def print_log(text, level=3):
     write_log(txt + '\n', level=level)
@@ -286,6 +328,9 @@ def print_status(text=None, flag=None, nl=None):
 
 
 def print_progress(text, r, nl=None):
+    # progress bars only make sense when rewriting a terminal line
+    if not _isatty: return
+
     width = get_line_width()
 
     mwidth = int(width * 6 / 10)
@@ -315,6 +360,14 @@ def print_progress(text, r, nl=None):
     if nl: write_log(out, level=3)
 
 
+def clear_progress():
+    """Erases the line left by print_progress"""
+    if not _isatty: return
+
+    sys.stdout.write('\r%s\r' % (' ' * get_line_width()))
+    sys.stdout.flush()
+
+
 
 def ask_question_string(question, default=None):
     if default: hint = ' [%s]' % default
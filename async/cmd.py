@@ -18,8 +18,9 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import subprocess
-import inspect
-import ctypes
+import codecs
+import select
+import time
 import sys
 import os
 import re
@@ -50,57 +51,92 @@ def print_annex_line(line):
 
 
 class StreamWriter(Thread):
-    """Gets characters from stream. Calls char_callback one character at a time
-       and line_callback one line at a time"""
+    """Gets characters from stream. Calls char_callback with the characters read, in
+       chunks, and line_callback one line at a time. The output is decoded with encoding,
+       replacing invalid sequences"""
 
-    def __init__(self, stream, char_callback, line_callback, prefix=''):
+    # bytes per read, and minimum seconds between calls to char_callback
+    CHUNK = 65536
+    FLUSH_INTERVAL = 0.05
+
+    _split_re = re.compile(r'([\r\n])')
+
+    def __init__(self, stream, char_callback, line_callback, prefix='', encoding='utf-8'):
         super(StreamWriter, self).__init__()
         self.stream = stream
+        self.encoding = encoding
         self.char_callback = char_callback
         self.line_callback = line_callback
         self.prefix = prefix
         self._force_newline = Event()
         self.daemon = True
 
+        self._line = prefix
+        self._out = []
+        self._last = 0
+
 
     def force_newline(self):
         """Forces a newline, for example after user input"""
         self._force_newline.set()
 
 
-    def run(self):
-        line = self.prefix
-        b = 'a'
-        while len(b) > 0:
-            b = self.stream.read(1)
+    def _flush(self):
+        """Passes the pending characters to char_callback"""
+        if len(self._out) > 0 and self.char_callback:
+            self.char_callback(''.join(self._out))
+        self._out = []
+        self._last = time.time()
+
+
+    def _feed(self, text):
+        for piece in self._split_re.split(text):
+            if len(piece) == 0: continue
 
             # when forcing a newline, just reset line without calling callback. We can't
             # guarantee an other '\n' (from stdin for example) messes up with the rewriting.
             if self._force_newline.is_set():
-                line = self.prefix
+                self._line = self.prefix
                 self._force_newline.clear()
-                if self.char_callback: self.char_callback(line)
-
-            line = line + b
+                self._out.append(self._line)
 
-            # call line_callback to rewrite line.
-            if b == '\n':
+            # call line_callback to rewrite line. Pending characters go out first.
+            if piece == '\n':
                 if self.line_callback:
-                    self.line_callback(line)
-                line = self.prefix
-                if self.char_callback and len(line) > 0:
-                    self.char_callback(line)
+                    self._flush()
+                    self.line_callback(self._line + piece)
+                self._line = self.prefix
+                if len(self._line) > 0: self._out.append(self._line)
 
             # do not call line_callback when already rewriting a line
-            elif b == '\r':
-                if self.char_callback: self.char_callback('\r')
-                line = self.prefix
-                if self.char_callback and len(line) > 0:
-                    self.char_callback(line)
+            elif piece == '\r':
+                self._out.append('\r')
+                self._line = self.prefix
+                if len(self._line) > 0: self._out.append(self._line)
 
             else:
-                if self.char_callback: self.char_callback(b)
+                self._line = self._line + piece
+                self._out.append(piece)
 
+
+    def run(self):
+        fd = self.stream.fileno()
+        decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+
+        while True:
+            # hold pending characters for a while, unless the process goes quiet, for
+            # example waiting on a prompt.
+            if len(self._out) > 0:
+                wait = self._last + self.FLUSH_INTERVAL - time.time()
+                if wait <= 0 or len(select.select([fd], [], [], wait)[0]) == 0:
+                    self._flush()
+                    continue
+
+            data = os.read(fd, self.CHUNK)
+            self._feed(decoder.decode(data, len(data) == 0))
+            if len(data) == 0: break
+
+        self._flush()
         self.stream.close()
 
 
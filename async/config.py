@@ -21,10 +21,13 @@ import os
 import re
 import glob
 import shlex
+import pickle
 
 from collections import OrderedDict
 from configparser import ConfigParser
 
+from async.utils import cache_path
+
 class AsyncConfigError(Exception):
     def __init__(self, msg=None):
         super(AsyncConfigError, self).__init__(msg)
@@ -59,6 +62,13 @@ def parse_bool(key, val, dic):
 
 
 
+def parse_int(key, val, dic):
+    if val:
+        dic[key] = int(val.strip())
+    return dic.get(key, None)
+
+
+
 def parse_path(key, val, dic):
     if val:
         dic[key] = os.path.expandvars(os.path.expanduser(val.strip()))
@@ -191,6 +201,7 @@ class AsyncConfig(ConfigParser):
             'save_lastsync'  : (True, parse_bool),       # store .async.last with last sync metadata
             'asynclast_file' : (".async.last", parse_string),
             'skip_missing'   : (False, parse_bool),
+            'status_ttl'     : (300, parse_int),         # seconds a cached directory status is valid
         },
 
         'instance': {
@@ -204,6 +215,7 @@ class AsyncConfig(ConfigParser):
 
             'aws_keys'       : (None, parse_path),
             'volumes'        : ({}, parse_dict),
+            'ec2_backend'    : ('boto', parse_string),  # 'fake' runs against an in-process stand-in
 
             'zone'           : (None, parse_string),
             'user'           : (None, parse_string),
@@ -232,6 +244,7 @@ class AsyncConfig(ConfigParser):
             'unison_profile'  : (None, parse_string),
             'unison_args'     : ([], parse_list_args),
             'rsync_args'      : ([], parse_list_args),
+            'native_copy'     : (True, parse_bool),      # copy in-process between local directories
             'githooks_dir'    : ("", parse_path),
 
             'pre_init_hook'          : ([], parse_list_path),  # scripts to run before initialization
@@ -280,6 +293,9 @@ class AsyncConfig(ConfigParser):
         return dic
 
 
+    # attributes holding the parsed config. These get cached.
+    PARSED = ['path', 'host', 'remote', 'instance', 'directory', 'async']
+
     def __init__(self, cfgdir):
         ConfigParser.__init__(self)
         self.read(glob.glob(os.path.join(cfgdir, '*.conf')))
@@ -357,4 +373,95 @@ class AsyncConfig(ConfigParser):
                         val['dirs'][k]['symlink'] = p
 
 
+
+# Config cache
+# --------------------------------------------------------------------
+# The parsed config is pickled into the cache dir, along with what it depends on: the
+# stats of the config files and of the key files it references, and the values of the
+# environment variables that paths may expand. Key contents are never cached.
+
+def _file_stats(paths):
+    stats = {}
+    for p in paths:
+        try:
+            st = os.stat(p)
+            stats[p] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stats[p] = None
+    return stats
+
+
+
+def _config_deps(cfgdir, conf=None):
+    """Returns a dict with what the parsed config depends on. Takes environment variables
+    and key files from conf, when given."""
+    files = sorted(glob.glob(os.path.join(cfgdir, '*.conf')))
+    deps = {
+        'files': _file_stats(files + [__file__]),
+        'env':   {},
+        'keys':  {},
+    }
+
+    if conf:
+        names = set(['HOME'])
+        for f in files:
+            with open(f, 'r') as fd:
+                for m in re.finditer(r'\$(\w+)|\$\{(\w+)\}', fd.read()):
+                    names.add(m.group(1) or m.group(2))
+        deps['env'] = {k: os.environ.get(k, None) for k in names}
+
+        keys = [h['vol_keys'] for h in conf.host.values() if h['vol_keys']] + \
+               [i['aws_keys'] for i in conf.instance.values() if i['aws_keys']]
+        deps['keys'] = _file_stats(keys)
+
+    return deps
+
+
+
+def load_config(cfgdir):
+    """Returns an AsyncConfig for cfgdir. Uses the cached parsed config when none of its
+    dependencies changed."""
+    import hashlib
+    name = 'config-%s.pickle' % hashlib.sha1(os.path.abspath(cfgdir).encode('utf-8')).hexdigest()
+    path = cache_path(name)
+
+    try:
+        with open(path, 'rb') as fd:
+            cached = pickle.load(fd)
+
+        deps = _config_deps(cfgdir)
+        if cached['deps']['files'] == deps['files'] and \
+           cached['deps']['env'] == {k: os.environ.get(k, None) for k in cached['deps']['env']} and \
+           cached['deps']['keys'] == _file_stats(cached['deps']['keys'].keys()):
+
+            conf = AsyncConfig.__new__(AsyncConfig)
+            ConfigParser.__init__(conf)
+            for k in AsyncConfig.PARSED: setattr(conf, k, cached['conf'][k])
+            return conf
+
+    except (IOError, OSError, EOFError, KeyError, pickle.UnpicklingError, AttributeError):
+        pass
+
+    conf = AsyncConfig(cfgdir)
+    cached = {
+        'deps': _config_deps(cfgdir, conf),
+        'conf': {k: getattr(conf, k) for k in AsyncConfig.PARSED},
+    }
+
+    tmp = '%s.%d' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(tmp, 'wb') as fd:
+            pickle.dump(cached, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+
+    except (IOError, OSError):
+        if os.path.exists(tmp): os.remove(tmp)
+
+    return conf
+
+
+
 # vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -387,6 +387,23 @@ class AnnexDir(GitDir):
         return True
 
 
+    def status_key_cmd(self, host):
+        """Shell snippet whose output changes whenever status would. Runs on the
+        directory."""
+        return super(AnnexDir, self).status_key_cmd(host) + \
+            "; git rev-parse -q --verify refs/heads/git-annex"
+
+
+    def status_key_local(self, path):
+        """Computes in-process what status_key_cmd prints"""
+        import async.dirindex as dirindex
+
+        key = super(AnnexDir, self).status_key_local(path)
+        ref = dirindex.git_ref(path, 'refs/heads/git-annex')
+        if ref != None: key.append(ref)
+        return key
+
+
     def status(self, host, slow=False):
         status = super(AnnexDir, self).status(host, slow=slow)
         path = os.path.join(host.path, self.relpath)
@@ -25,6 +25,7 @@ from datetime import datetime, timedelta
 
 import async.archui as ui
 from async.utils import shquote
+from async.hosts.base import HostError
 
 
 
@@ -54,6 +55,25 @@ class SkipError(Exception):
 
 
 
+def _stat_key(path):
+    """Formats the stat of path as stat -L -c '%Y %a %U %G' does. None if it does not exist."""
+    import pwd, grp, stat
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    try:    user = pwd.getpwuid(st.st_uid).pw_name
+    except KeyError: user = str(st.st_uid)
+
+    try:    group = grp.getgrgid(st.st_gid).gr_name
+    except KeyError: group = str(st.st_gid)
+
+    return '%d %o %s %s' % (int(st.st_mtime), stat.S_IMODE(st.st_mode), user, group)
+
+
+
 class BaseDir(object):
 
     def __init__(self, conf):
@@ -202,6 +222,29 @@ class BaseDir(object):
         return False
 
 
+    def status_key_cmd(self, host):
+        """Shell snippet whose output changes whenever status would. Runs on the
+        directory."""
+        return "stat -L -c '%%Y %%a %%U %%G' . %s 2>/dev/null" % shquote(self.asynclast_file)
+
+
+    def status_key_local(self, path):
+        """Computes in-process what status_key_cmd prints, for a directory at path on the
+        local filesystem. Returns a list of lines."""
+        return [k for k in [_stat_key(path), _stat_key(os.path.join(path, self.asynclast_file))]
+                if k != None]
+
+
+    def status_key(self, host):
+        """Returns a string identifying the current status of the directory on host, used
+        to validate cached statuses. None if it can't be computed."""
+        path = os.path.join(host.path, self.relpath)
+        try:
+            return host.status_key(self, path)
+        except:
+            return None
+
+
     def status(self, host, slow=False):
         """Returns a dict of the status of the directory on host"""
         path = os.path.join(host.path, self.relpath)
@@ -222,25 +265,27 @@ class BaseDir(object):
             status['ls-remote'] = None
             status['ls-success'] = None
 
-        try:
-            raw  = host.run_cmd('stat -L -c "%%a %%U:%%G" "%s"' % path, catchout=True)
-            m = re.match('^(\d+) ([a-zA-Z]+):([a-zA-Z]+)$', raw)
-            status['perms'] = m.group(1)
-            status['user']  = m.group(2)
-            status['group'] = m.group(3)
+        st = host.path_stat(path)
+        if st:
+            status['perms'] = st['perms']
+            status['user']  = st['user']
+            status['group'] = st['group']
 
-        except:
+        else:
             status['path'] = None
             status['perms'] = '???'
             status['user']  = '???'
             status['group'] = '???'
 
-# NOTE: this is awfully slow
-#        size   = 0
-#        raw    = host.run_cmd('du -s "%s"' % path, catchout=True)
-#        if raw:
-#            m = re.match('^(\d+).*$', raw)
-#            if m: size = int(m.group(1))
+        # disk usage and number of files. walks only the subdirectories that changed since
+        # the last time.
+        if slow and status['path']:
+            try:
+                usage = host.usage(path)
+                status['size'] = usage['bytes']
+                status['numfiles'] = usage['files']
+            except HostError:
+                pass
 
         return status
 
@@ -356,16 +356,37 @@ class GitDir(BaseDir):
 
 
 
+    def status_key_cmd(self, host):
+        """Shell snippet whose output changes whenever status would. Runs on the
+        directory."""
+        return super(GitDir, self).status_key_cmd(host) + \
+            "; git rev-parse -q --verify HEAD; stat -c '%Y' .git/index 2>/dev/null"
+
+
+    def status_key_local(self, path):
+        """Computes in-process what status_key_cmd prints"""
+        import async.dirindex as dirindex
+
+        key = super(GitDir, self).status_key_local(path)
+        head = dirindex.git_ref(path, 'HEAD')
+        if head != None: key.append(head)
+
+        try:
+            key.append('%d' % int(os.stat(os.path.join(path, '.git', 'index')).st_mtime))
+        except OSError:
+            pass
+
+        return key
+
+
     def status(self, host, slow=False):
         status = super(GitDir, self).status(host, slow=slow)
         path = os.path.join(host.path, self.relpath)
         status['type'] = 'git'
 
-        # number of files
+        # number of tracked files
         try:
-            raw = host.run_cmd("git ls-files | wc -l",
-                               tgtpath=path, catchout=True).strip()
-            status['numfiles'] = int(raw)
+            status['numfiles'] = host.git_numfiles(path)
         except:
             status['numfiles'] = -1
 
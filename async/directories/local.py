@@ -41,23 +41,6 @@ class LocalDir(BaseDir):
         return False
 
 
-    def status(self, host, slow=False):
-        status = super(LocalDir, self).status(host, slow=slow)
-        path = os.path.join(host.path, self.relpath)
-
-        # number of files
-        if slow:
-            try:
-                raw = host.run_cmd("find . -not -type d -and  -print | wc -l",
-                                   tgtpath=path, catchout=True).strip()
-                status['numfiles'] = int(raw)
-            except:
-                status['numfiles'] = -1
-
-        return status
-
-
-
     def sync(self, local, remote, silent=False, dryrun=False, opts=None, runhooks=True):
 
         # do basic checks
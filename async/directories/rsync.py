@@ -23,6 +23,9 @@ import subprocess
 from async.directories.base import DirError, SyncError, InitError, HookError, CheckError
 from async.directories.local import LocalDir
 from async.hosts import SshHost, DirectoryHost
+from async.fastcopy import sync_tree, CopyError
+from async.pathdict import PathDict
+from async.utils import number2human
 
 import async.cmd as cmd
 import async.archui as ui
@@ -31,9 +34,71 @@ import subprocess
 
 class RsyncDir(LocalDir):
     """Directory synced via rsync"""
+
+    # rsync options the native copy knows how to honour
+    NATIVE_SHORT_OPTS = set('arptlgoDvqh')
+    NATIVE_LONG_OPTS  = set(['--archive', '--recursive', '--perms', '--times', '--links',
+                             '--group', '--owner', '--verbose', '--quiet', '--human-readable',
+                             '--delete'])
+
+    # the native copy always behaves like rsync -a, so args must ask for the same
+    ARCHIVE_OPTS = set('rlptgoD')
+    LONG_TO_SHORT = {'--archive': 'a', '--recursive': 'r', '--links': 'l', '--perms': 'p',
+                     '--times': 't', '--group': 'g', '--owner': 'o'}
+
     def __init__(self, conf):
         super(RsyncDir, self).__init__(conf)
         self.rsync_args = conf['rsync_args']
+        self.native_copy = conf['native_copy']
+
+
+
+    def _native_copy_ok(self, local, remote, args):
+        """Returns true if we can copy in-process instead of calling rsync. Both ends
+        need to be on the local filesystem, and args must ask for archive semantics, -a or
+        the equivalent -rlptgoD, without options that need rsync."""
+        if not self.native_copy:                    return False
+        if not isinstance(local, DirectoryHost):    return False
+        if not isinstance(remote, DirectoryHost):   return False
+
+        flags = set()
+        for a in args:
+            if a.startswith('--'):
+                if not a in self.NATIVE_LONG_OPTS: return False
+                flags.update(self.LONG_TO_SHORT.get(a, ''))
+            elif a.startswith('-'):
+                if not set(a[1:]) <= self.NATIVE_SHORT_OPTS: return False
+                flags.update(a[1:])
+            else:
+                return False
+
+        if 'a' in flags: flags.update(self.ARCHIVE_OPTS)
+        return self.ARCHIVE_OPTS <= flags
+
+
+
+    def _native_sync(self, src, tgt, ignore, delete=False, verbose=False, silent=False, dryrun=False):
+        """Copies src into tgt in-process. Uses reflinks or copy_file_range when both
+        paths live on the same filesystem."""
+        ui.print_debug('native copy %s %s. ignore: %s' % (src, tgt, ', '.join(ignore)))
+
+        if verbose and not silent: callback = lambda p: ui.print_color('  %s' % p)
+        else:                      callback = None
+
+        try:
+            if not dryrun:
+                stats = sync_tree(src, tgt, ignore=ignore, delete=delete, callback=callback)
+                if not silent:
+                    ui.print_color("copied %d files (%s), deleted %d" % (
+                        stats['files'], number2human(stats['bytes'], suffix='b'), stats['deleted']))
+
+        except CopyError as err:
+            raise SyncError(str(err))
+
+
+    def _relative_ignores(self, ignore, root):
+        """Returns the paths in the ignore PathMatcher that lie under root, relative to root"""
+        return [p[1:] for p in ignore.rsync_excludes(root)]
 
 
 
@@ -59,10 +124,10 @@ class RsyncDir(LocalDir):
         self.check_paths(remote)
 
         # handle ignores
-        ignore = set(self.ignore) | set(opts.ignore) | set(local.ignore) | set(remote.ignore)
-        ignore = set([p[len(self.relpath):] for p in ignore if p.startswith(self.relpath) ])
+        ignore_paths = set(self.ignore) | set(opts.ignore) | set(local.ignore) | set(remote.ignore)
+        ignore = PathDict(dic={p: p for p in ignore_paths}).compile(globs=True)
 
-        args = args + ['--exclude=%s' % p for p in ignore]
+        args = args + ['--exclude=%s' % p for p in ignore.rsync_excludes(self.relpath)]
 
         # get target path
         if isinstance(remote, SshHost):
@@ -90,13 +155,21 @@ class RsyncDir(LocalDir):
             self.run_hook(remote, 'pre_sync_remote', tgt=self.fullpath(remote), silent=silent, dryrun=dryrun)
 
         # sync
-        ui.print_debug('rsync %s %s %s' % (' '.join(args), src, tgt))
-        try:
-            if not dryrun:
-                cmd.rsync(src, tgt, args=args, silent=silent)
+        if self._native_copy_ok(local, remote, self.rsync_args):
+            self._native_sync(src, tgt, self._relative_ignores(ignore, self.relpath),
+                              delete='--delete' in self.rsync_args,
+                              verbose=any([a == '--verbose' or (a[:2] != '--' and 'v' in a)
+                                           for a in self.rsync_args]),
+                              silent=silent, dryrun=dryrun)
 
-        except subprocess.CalledProcessError as err:
-            raise SyncError(str(err))
+        else:
+            ui.print_debug('rsync %s %s %s' % (' '.join(args), src, tgt))
+            try:
+                if not dryrun:
+                    cmd.rsync(src, tgt, args=args, silent=silent)
+
+            except subprocess.CalledProcessError as err:
+                raise SyncError(str(err))
 
         # post-sync hook
         if runhooks:
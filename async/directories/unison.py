@@ -23,12 +23,17 @@ import subprocess
 from async.directories.base import DirError, SyncError, InitError, HookError, CheckError
 from async.directories.rsync import RsyncDir
 from async.hosts import SshHost, DirectoryHost
+from async.pathdict import PathDict
 
 import async.cmd as cmd
 import async.archui as ui
 
 class UnisonDir(RsyncDir):
     """Directory synced via unison"""
+
+    # unison options that don't change what a forced sync copies
+    NATIVE_UNISON_OPTS = set(['-times', '-auto', '-batch', '-silent', '-terse'])
+
     def __init__(self, conf):
         super(UnisonDir, self).__init__(conf)
 
@@ -37,6 +42,18 @@ class UnisonDir(RsyncDir):
 
 
 
+    def _native_unison_ok(self, local, remote):
+        """Returns true if a forced sync can mirror the files in-process instead of calling
+        unison. Both ends need to be on the local filesystem, and unison_args may not ask
+        for something only unison does."""
+        if not self.native_copy:                    return False
+        if not isinstance(local, DirectoryHost):    return False
+        if not isinstance(remote, DirectoryHost):   return False
+
+        return set(self.unison_args) <= self.NATIVE_UNISON_OPTS
+
+
+
     # Interface
     # ----------------------------------------------------------------
 
@@ -70,7 +87,8 @@ class UnisonDir(RsyncDir):
 
         # prepare args
         sshargs = []
-        sshargs = sshargs + remote.ssh_args
+        if isinstance(remote, SshHost):
+            sshargs = sshargs + remote.ssh_args
 
         args = ['-root', src,
                 '-root', tgt,
@@ -83,9 +101,10 @@ class UnisonDir(RsyncDir):
         args = args + self.unison_args
 
         # get the ignores
-        ignore = set(self.ignore) | set(opts.ignore) | set(local.ignore) | set(remote.ignore)
-        for p in ignore:
-            args = args + ['-ignore', 'Path %s' % p]
+        ignore_paths = set(self.ignore) | set(opts.ignore) | set(local.ignore) | set(remote.ignore)
+        ignore = PathDict(dic={p: p for p in ignore_paths}).compile(globs=True)
+        for p in ignore.unison_ignores():
+            args = args + ['-ignore', p]
 
         # prepare other options
         if opts.auto:  args = args + ['-auto']
@@ -104,12 +123,22 @@ class UnisonDir(RsyncDir):
             self.run_hook(local, 'pre_sync', tgt=self.fullpath(local), silent=silent, dryrun=dryrun)
             self.run_hook(remote, 'pre_sync_remote', tgt=self.fullpath(remote), silent=silent, dryrun=dryrun)
 
-        # sync
-        ui.print_debug('unison %s' % ' '.join(args))
-        try:
-            if not dryrun: cmd.unison(args=args, silent=silent)
-        except subprocess.CalledProcessError as err:
-            raise SyncError(str(err))
+        # sync. When forcing a direction between local directories there is nothing to
+        # reconcile, and we can mirror the files in-process.
+        if opts.force in set(['up', 'down']) and self._native_unison_ok(local, remote):
+            srcpath = os.path.join(local.path, self.relpath)
+            tgtpath = os.path.join(remote.path, self.relpath)
+            if opts.force == 'down': srcpath, tgtpath = tgtpath, srcpath
+
+            self._native_sync(srcpath, tgtpath, self._relative_ignores(ignore, self.relpath),
+                              delete=True, silent=silent, dryrun=dryrun)
+
+        else:
+            ui.print_debug('unison %s' % ' '.join(args))
+            try:
+                if not dryrun: cmd.unison(args=args, silent=silent)
+            except subprocess.CalledProcessError as err:
+                raise SyncError(str(err))
 
         # post-sync hook
         if runhooks:
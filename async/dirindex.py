@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# async - A tool to manage and sync different machines
+# Copyright 2012,2013 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Incremental index of directory trees. Keeps, for every subdirectory, the disk usage and
+# number of files directly inside it, keyed by the directory mtime. Adding, removing or
+# renaming entries bumps the mtime of the containing directory, so on the next walk we
+# only need to list directories whose mtime changed. Files growing in place are not
+# noticed until their directory changes.
+#
+# The number of tracked files in a git repo is read from the header of the git index
+# instead, which is much cheaper than listing them.
+#
+# NOTE: this module only depends on the standard library. It is sent to remote hosts and
+# run there as 'python3 - <cmd> <path>', so keep it self-contained.
+
+import os
+import sys
+import json
+import struct
+import hashlib
+
+
+def index_path(path):
+    """Returns the path of the index file for the tree at path"""
+    cachedir = os.environ.get('XDG_CACHE_HOME', None) or os.path.expanduser('~/.cache')
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(cachedir, 'async', 'dirindex', '%s.json' % digest)
+
+
+def load_index(path):
+    try:
+        with open(index_path(path), 'r') as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_index(path, index):
+    ipath = index_path(path)
+    tmp = '%s.%d' % (ipath, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(ipath)):
+            os.makedirs(os.path.dirname(ipath))
+
+        with open(tmp, 'w') as fd:
+            json.dump(index, fd)
+        os.rename(tmp, ipath)
+
+    except (IOError, OSError):
+        if os.path.exists(tmp): os.remove(tmp)
+
+
+def _list_dir(path):
+    """Returns the disk usage and number of non-directory entries directly in path, and
+    the names of its subdirectories. Symlinks are not followed."""
+    size = 0
+    files = 0
+    subdirs = []
+
+    for e in os.scandir(path):
+        try:
+            if e.is_dir(follow_symlinks=False):
+                subdirs.append(e.name)
+            else:
+                files = files + 1
+                size = size + e.stat(follow_symlinks=False).st_blocks * 512
+        except OSError:
+            continue
+
+    return size, files, subdirs
+
+
+def _update_entry(root, rel, entry):
+    """Returns the up to date index entry for directory rel, or None if it is gone"""
+    path = os.path.join(root, rel)
+    try:
+        st = os.stat(path)
+        if entry != None and entry[0] == st.st_mtime_ns:
+            return entry
+
+        # the directory itself takes space too, as du counts it
+        size, files, subdirs = _list_dir(path)
+        return [st.st_mtime_ns, size + st.st_blocks * 512, files, subdirs]
+
+    except OSError:
+        return None
+
+
+def update_index(root, index, jobs=8):
+    """Walks the tree at root, reusing the entries of index for directories whose mtime did
+    not change. Each level of the tree is processed by jobs threads in parallel. Returns
+    the updated index, which maps relative paths to lists [mtime, size, files, subdirs] of
+    each directory."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    new = {}
+    level = ['']
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(level) > 0:
+            entries = executor.map(lambda rel: _update_entry(root, rel, index.get(rel, None)), level)
+
+            nxt = []
+            for rel, entry in zip(level, entries):
+                if entry == None: continue
+                new[rel] = entry
+                nxt.extend([os.path.join(rel, name) for name in entry[3]])
+            level = nxt
+
+    return new
+
+
+def totals(index, rel=''):
+    """Returns the total disk usage and number of files under rel, from an index"""
+    size = 0
+    files = 0
+    stack = [rel]
+    while len(stack) > 0:
+        p = stack.pop()
+        entry = index.get(p, None)
+        if entry == None: continue
+
+        size = size + entry[1]
+        files = files + entry[2]
+        stack.extend([os.path.join(p, name) for name in entry[3]])
+
+    return size, files
+
+
+def usage(path):
+    """Returns a dict with the disk usage in bytes and the number of files under path,
+    updating its index"""
+    index = update_index(path, load_index(path))
+    save_index(path, index)
+
+    size, files = totals(index)
+    return {'bytes': size, 'files': files}
+
+
+def git_dir(path):
+    """Returns the git dir of the repo at path. .git may be a file pointing to the real
+    git dir. Raises IOError if it can't be read."""
+    gitdir = os.path.join(path, '.git')
+    if os.path.isfile(gitdir):
+        with open(gitdir, 'r') as fd:
+            line = fd.readline().strip()
+        if line.startswith('gitdir:'):
+            gitdir = os.path.join(path, line[len('gitdir:'):].strip())
+
+    return gitdir
+
+
+def git_index_count(path):
+    """Returns the number of entries in the git index of the repo at path, read from the
+    index header, or None if there is no index"""
+    try:
+        with open(os.path.join(git_dir(path), 'index'), 'rb') as fd:
+            header = fd.read(12)
+
+    except (IOError, OSError):
+        return None
+
+    if len(header) < 12: return None
+    signature, version, count = struct.unpack('>4sII', header)
+    if signature != b'DIRC': return None
+    return count
+
+
+def _read_ref(gitdirs, ref):
+    """Returns the contents of ref, loose or packed, in the first of gitdirs having it"""
+    for gitdir in gitdirs:
+        try:
+            with open(os.path.join(gitdir, ref), 'r') as fd:
+                return fd.read().strip()
+        except (IOError, OSError):
+            pass
+
+        try:
+            with open(os.path.join(gitdir, 'packed-refs'), 'r') as fd:
+                for line in fd:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref: return parts[0]
+        except (IOError, OSError):
+            pass
+
+    return None
+
+
+def git_ref(path, ref):
+    """Returns the object id ref points to in the repo at path, following symbolic refs
+    like HEAD, as 'git rev-parse -q --verify' does for full ref names. None if it does not
+    exist."""
+    try:
+        gitdirs = [git_dir(path)]
+        # worktrees keep HEAD in their own git dir, and the refs in the common one
+        if os.path.isfile(os.path.join(gitdirs[0], 'commondir')):
+            with open(os.path.join(gitdirs[0], 'commondir'), 'r') as fd:
+                gitdirs.append(os.path.join(gitdirs[0], fd.read().strip()))
+
+    except (IOError, OSError):
+        return None
+
+    # bound the symbolic ref chain, in case of loops
+    for i in range(5):
+        val = _read_ref(gitdirs, ref)
+        if val == None:                return None
+        if not val.startswith('ref:'): return val
+        ref = val[len('ref:'):].strip()
+
+    return None
+
+
+def main(args):
+    if len(args) == 2 and args[0] == 'usage':
+        json.dump(usage(args[1]), sys.stdout)
+        sys.stdout.write('\n')
+        return 0
+
+    sys.stderr.write("usage: dirindex.py usage <path>\n")
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# async - A tool to manage and sync different machines
+# Copyright 2012,2013 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import stat
+import errno
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+from async.pathdict import PathDict
+
+
+# ioctl to share extents between files (btrfs, xfs)
+FICLONE = 0x40049409
+
+# errors meaning a copy method is not available for these files
+_UNSUPPORTED = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                    errno.EOPNOTSUPP, errno.EBADF, errno.EPERM])
+
+
+class CopyError(Exception):
+    def __init__(self, msg=None):
+        super(CopyError, self).__init__(msg)
+
+
+
+class _Copier(object):
+    """Copies file contents with the fastest method available. Remembers which methods
+    failed, so we do not retry them on every file."""
+
+    def __init__(self, same_fs):
+        self.reflink    = same_fs
+        self.range_copy = same_fs and hasattr(os, 'copy_file_range')
+        self.sendfile   = hasattr(os, 'sendfile')
+
+
+    def _reflink(self, fsrc, ftgt, size):
+        import fcntl
+        fcntl.ioctl(ftgt.fileno(), FICLONE, fsrc.fileno())
+
+
+    def _range_copy(self, fsrc, ftgt, size):
+        left = size
+        while left > 0:
+            n = os.copy_file_range(fsrc.fileno(), ftgt.fileno(), left)
+            if n == 0: break
+            left = left - n
+
+
+    def _sendfile(self, fsrc, ftgt, size):
+        offset = 0
+        while offset < size:
+            n = os.sendfile(ftgt.fileno(), fsrc.fileno(), offset, size - offset)
+            if n == 0: break
+            offset = offset + n
+
+
+    def copy(self, src, tgt, size):
+        with open(src, 'rb') as fsrc, open(tgt, 'wb') as ftgt:
+            for flag, func in [('reflink', self._reflink),
+                               ('range_copy', self._range_copy),
+                               ('sendfile', self._sendfile)]:
+                if not getattr(self, flag): continue
+
+                try:
+                    func(fsrc, ftgt, size)
+                    return
+
+                except OSError as err:
+                    if not err.errno in _UNSUPPORTED: raise
+                    setattr(self, flag, False)
+
+                    # a partial copy may have happened. start over.
+                    fsrc.seek(0)
+                    ftgt.seek(0)
+                    ftgt.truncate()
+
+            shutil.copyfileobj(fsrc, ftgt, 1024*1024)
+
+
+
+def _scan(root, ignore):
+    """Walks root and returns a dict mapping relative paths to their lstat. Skips paths in
+    the ignore PathMatcher."""
+    entries = {}
+    if not os.path.isdir(root):
+        return entries
+
+    stack = ['']
+    while len(stack) > 0:
+        rel = stack.pop()
+        for e in os.scandir(os.path.join(root, rel)):
+            p = os.path.join(rel, e.name)
+            if p in ignore: continue
+
+            st = e.stat(follow_symlinks=False)
+            entries[p] = st
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(p)
+
+    return entries
+
+
+
+def _changed(s, t):
+    """quick check as done by rsync: file type, size and mtime"""
+    if t == None:                                         return True
+    if stat.S_IFMT(s.st_mode) != stat.S_IFMT(t.st_mode):  return True
+    if s.st_size != t.st_size:                            return True
+    if int(s.st_mtime) != int(t.st_mtime):                return True
+    return False
+
+
+
+def _remove(path):
+    if not os.path.lexists(path):                        return
+    if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+    else:                                                os.remove(path)
+
+
+
+def sync_tree(src, tgt, ignore=[], delete=False, jobs=4, callback=None):
+    """Makes tgt a copy of src, like rsync -a would do. Paths in ignore are relative to src,
+    may contain shell wildcards and are neither copied nor deleted. Regular files are copied in parallel using jobs
+    threads. callback is called with the relative path of every transferred file. Returns a
+    dict with transfer statistics."""
+
+    ig = PathDict(dic={p: p for p in ignore}).compile(globs=True)
+    stats = {'files': 0, 'bytes': 0, 'deleted': 0}
+
+    try:
+        if not os.path.isdir(tgt):
+            os.makedirs(tgt)
+
+        S = _scan(src, ig)
+        T = _scan(tgt, ig)
+
+        same_fs = os.stat(src).st_dev == os.stat(tgt).st_dev
+        copier = _Copier(same_fs)
+        root = os.geteuid() == 0
+
+        # remove whatever changed type on the target, along with its contents. Each
+        # removed subtree counts as a single deletion.
+        for p in sorted(T.keys()):
+            if not p in T: continue
+            if p in S and stat.S_IFMT(S[p].st_mode) != stat.S_IFMT(T[p].st_mode):
+                _remove(os.path.join(tgt, p))
+                stats['deleted'] = stats['deleted'] + 1
+                for q in [q for q in T if q == p or q.startswith(p + os.sep)]:
+                    del T[q]
+
+        # delete extraneous paths on the target, children first
+        if delete:
+            for p in sorted(T.keys(), reverse=True):
+                if not p in S:
+                    _remove(os.path.join(tgt, p))
+                    stats['deleted'] = stats['deleted'] + 1
+
+        # create directories and symlinks, parents first
+        files = []
+        for p in sorted(S.keys()):
+            s = S[p]
+            path = os.path.join(tgt, p)
+
+            if stat.S_ISDIR(s.st_mode):
+                if not p in T: os.mkdir(path)
+                os.chmod(path, stat.S_IMODE(s.st_mode))
+
+            elif stat.S_ISLNK(s.st_mode):
+                link = os.readlink(os.path.join(src, p))
+                if p in T and os.readlink(path) == link: continue
+                if p in T: os.remove(path)
+                os.symlink(link, path)
+                if callback: callback(p)
+
+            elif stat.S_ISREG(s.st_mode):
+                if _changed(s, T.get(p, None)):
+                    files.append(p)
+
+        # copy file contents through a temporary file, so an interrupted copy never
+        # leaves a truncated file in place.
+        def func(p):
+            s = S[p]
+            path = os.path.join(tgt, p)
+            tmp = os.path.join(os.path.dirname(path), '.%s.async-tmp' % os.path.basename(path))
+            try:
+                copier.copy(os.path.join(src, p), tmp, s.st_size)
+                os.chmod(tmp, stat.S_IMODE(s.st_mode))
+                if root: os.lchown(tmp, s.st_uid, s.st_gid)
+                os.utime(tmp, ns=(s.st_atime_ns, s.st_mtime_ns))
+                os.replace(tmp, path)
+
+            except:
+                if os.path.exists(tmp): os.remove(tmp)
+                raise
+
+            return p
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for p in executor.map(func, files):
+                stats['files'] = stats['files'] + 1
+                stats['bytes'] = stats['bytes'] + S[p].st_size
+                if callback: callback(p)
+
+        # directory mtimes change while we populate them. fix them up at the end.
+        for p in sorted(S.keys(), reverse=True):
+            s = S[p]
+            if stat.S_ISDIR(s.st_mode):
+                os.utime(os.path.join(tgt, p), ns=(s.st_atime_ns, s.st_mtime_ns))
+
+    except (OSError, IOError) as err:
+        raise CopyError(str(err))
+
+    return stats
+
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
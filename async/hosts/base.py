@@ -22,17 +22,18 @@ import re
 import sys
 import json
 import subprocess
-import systemd.daemon
 import time
 from datetime import datetime, timedelta
-import dateutil.parser
 from collections import OrderedDict
 
 from async.pathdict import PathDict
+from async.statuscache import StatusCache
 from async.utils import number2human, read_keys, shquote
 
 import async.archui as ui
 import async.cmd as cmd
+import async.waiter as waiter
+import async.mounts as mounts
 
 
 class HostError(Exception):
@@ -64,7 +65,15 @@ class HostController:
         self.dryrun = dryrun
 
     def __enter__(self):
-        self.curstate = self.host.get_state()
+        self.host.open_scope()
+        try:
+            return self._enter()
+        except:
+            self.host.close_scope()
+            raise
+
+    def _enter(self):
+        self.curstate = self.host.current_state()
 
         if self.tgtstate:
             # change state
@@ -73,21 +82,28 @@ class HostController:
                 raise HostError("Could not bring '%s' host to '%s' state" % (self.host.name, self.tgtstate))
 
         # notify systemd, in case this is part of a systemd service
-        systemd.daemon.notify('\n'.join(['READY=1',
-                                         'STATUS="Host %s is mounted"' % self.host.name]))
+        if 'NOTIFY_SOCKET' in os.environ:
+            import systemd.daemon
+            systemd.daemon.notify('\n'.join(['READY=1',
+                                             'STATUS="Host %s is mounted"' % self.host.name]))
 
         return self.host
 
     def __exit__(self, type, value, traceback):
-        # do not get to current state if target state was not specified
-        if self.curstate and self.tgtstate:
-            self.host.set_state(self.curstate)
-
-        # disconnect from host
         try:
-            self.host.disconnect()
-        except AttributeError:
-            pass
+            # do not get to current state if target state was not specified
+            if self.curstate and self.tgtstate:
+                self.host.set_state(self.curstate)
+
+            # disconnect from host. Nested controllers leave it to the outermost one.
+            if not self.host.nested_scope():
+                try:
+                    self.host.disconnect()
+                except AttributeError:
+                    pass
+
+        finally:
+            self.host.close_scope()
 
 
 
@@ -95,13 +111,28 @@ class HostController:
 class BaseHost(object):
     STATES = ['offline', 'online', 'mounted']
 
-    def __init__(self, conf):
-        from async.directories import get_directory
+    # concurrent directory status queries. On ssh hosts each query opens its own
+    # connection, so keep it below sshd's MaxStartups (10 by default). Past that, sshd
+    # starts dropping unauthenticated connections.
+    STATUS_JOBS = 8
 
+    DIRSTATE_TYPES = {
+        'local' : '#Mlocal#t',
+        'unison': '#Yunison#t',
+        'rsync' : '#Yrsync#t',
+        'annex' : '#Gannex#t',
+        'git'   : '#Bgit#t',
+    }
+
+    def __init__(self, conf):
         super(BaseHost, self).__init__()
 
         self.state = None
 
+        # memo for queries to the host, valid while within a HostController
+        self.scope = None
+        self._scope_depth = 0
+
         # name and path
         self.name = conf['name']
         self.path = conf['path']
@@ -126,6 +157,7 @@ class BaseHost(object):
         self.asynclast_file   = conf['asynclast_file']
 
         self.skip_missing     = conf['skip_missing']
+        self.status_ttl       = conf['status_ttl']
 
         if conf['vol_keys']: self.vol_keys = read_keys(conf['vol_keys'])
         else:                self.vol_keys = {}
@@ -134,29 +166,57 @@ class BaseHost(object):
         self.ignore = [self.relativepath(p) for p in conf['ignore']]
         self.ignore.append(self.asynclast_file)
 
-        # directories indexed by relative paths
-        self.dirs = PathDict()
-        for name, dconf in conf['dirs'].items():
-            d = get_directory(dconf, unison_as_rsync=conf['unison_as_rsync'])
-            self.dirs[d.relpath] = d
+        # directories indexed by relative paths. Built on first access.
+        self.dirs_conf        = conf['dirs']
+        self.unison_as_rsync  = conf['unison_as_rsync']
+        self._dirs            = None
+
+
+    @property
+    def dirs(self):
+        """Directories indexed by relative paths"""
+        if self._dirs is None:
+            from async.directories import get_directory
+
+            dirs = PathDict()
+            for name, dconf in self.dirs_conf.items():
+                d = get_directory(dconf, unison_as_rsync=self.unison_as_rsync)
+                dirs[d.relpath] = d
+
+            for p in self.ignore:
+                dirs.remove(p)
+
+            self._dirs = dirs
 
-        for p in self.ignore:
-            self.dirs.remove(p)
+        return self._dirs
 
 
 
     # Utilities
     # ----------------------------------------------------------------
 
+    def open_scope(self):
+        """Starts a scope where queries to the host may be memoized in self.scope. Scopes
+        nest, and the memo is dropped when the outermost one is closed."""
+        if self._scope_depth == 0: self.scope = {}
+        self._scope_depth = self._scope_depth + 1
+
+
+    def close_scope(self):
+        self._scope_depth = self._scope_depth - 1
+        if self._scope_depth == 0: self.scope = None
+
+
+    def nested_scope(self):
+        """Returns true if the current scope is inside another one"""
+        return self._scope_depth > 1
+
+
     def wait_for(self, status, func, timeout=120):
         """Waits until func returns status. A timeout in seconds can be specified"""
-        time_passed = 0
-        step = 2
-        while func() != status and time_passed <= timeout:
-            time.sleep(step)
-            time_passed = time_passed + step
-
-        return func() == status
+        ok, elapsed, polls = waiter.wait_for(lambda: func() == status, timeout=timeout)
+        ui.print_debug("waited %.1f s for %s on %s (%d polls)" % (elapsed, status, self.name, polls))
+        return ok
 
 
 
@@ -172,132 +232,170 @@ class BaseHost(object):
     #      T      F      F
 
 
+    def probe_mounts(self, paths):
+        """Reads the mount table, active swaps and device-mapper names of the host with a
+        single command. Also resolves paths. See mounts.parse_probe."""
+        try:
+            raw = self.run_cmd(mounts.probe_cmd(paths), tgtpath='/', catchout=True)
+            return mounts.parse_probe(raw, paths)
+
+        except CmdError as err:
+            raise HostError("Can't read the mount table. %s" % str(err))
+
+
+    def run_mount_script(self, stages):
+        """Runs stages of mount actions in one go. Raises a HostError listing the failed
+        ones."""
+        stages = [st for st in stages if len(st) > 0]
+        if len(stages) == 0: return
+
+        actions = [a for st in stages for a in st]
+        for desc, cmd, key in actions:
+            ui.print_debug(desc)
+
+        script, stdin = mounts.batch_script(stages, sudo=True)
+        try:
+            self.run_cmd(script, tgtpath='/', catchout=True, stdin=stdin)
+
+        except CmdError as err:
+            failed = mounts.failed_actions(err.output)
+            msgs = ["Can't %s" % actions[i][0] for i in failed if i < len(actions)]
+            output = re.sub(r'^#failed \d+\n?', '', err.output or '', flags=re.MULTILINE).strip()
+            raise HostError('%s\n  out: %s' % ('\n'.join(msgs) or "Error running mount commands", output))
+
+
+    def mount_graph(self):
+        """Returns the dependencies between the devices of the host, as a dict mapping
+        each of 'luks:<name>', 'mount:<mp>', 'ecryptfs:<mp>' and 'swap' to the set of those
+        that must be mounted before it."""
+        names = list(self.luks_mounts.values())
+        mps = list(self.mounts.values())
+        cmps = list(self.ecryptfs_mounts.values())
+        graph = {}
+
+        for name in names:
+            graph['luks:%s' % name] = set()
+
+        for dev, mp in self.mounts.items():
+            graph['mount:%s' % mp] = set(['luks:%s' % n for n in mounts.luks_deps(dev, names)] +
+                                         ['mount:%s' % m for m in mps if m != mp and mounts.inside(mp, m)])
+
+        for cryp, mp in self.ecryptfs_mounts.items():
+            graph['ecryptfs:%s' % mp] = set(['mount:%s' % m for m in mps
+                                             if mounts.inside(cryp, m) or mounts.inside(mp, m)] +
+                                            ['ecryptfs:%s' % m for m in cmps if m != mp and mounts.inside(mp, m)])
+
+        if self.swapfile:
+            graph['swap'] = set(['mount:%s' % m for m in mps if mounts.inside(self.swapfile, m)] +
+                                ['ecryptfs:%s' % m for m in cmps if mounts.inside(self.swapfile, m)])
+
+        return graph
+
+
     def mount_devices(self):
         """Mounts local devices on the host. Takes care of luks and ecryptfs partitions.
-           The order is: open luks, mount devices, setup ecryptfs partitions."""
+           The order is: open luks, mount devices, setup ecryptfs partitions, swap. Actions
+           that do not depend on each other run concurrently."""
+        paths = list(self.mounts.values()) + list(self.ecryptfs_mounts.values())
+        if self.swapfile: paths.append(self.swapfile)
+        probe = self.probe_mounts(paths)
+        graph = self.mount_graph()
+        nodes = []
+
         # open luks partitions
         for dev, name in self.luks_mounts.items():
-            ui.print_debug("mounting luks: %s %s" % (dev, name))
-            passphrase = self.vol_keys[name]
-            try:
-                self.run_cmd('! (sudo cryptsetup status %s | grep -qs inactive) || ' % shquote(name) +
-                             'sudo cryptsetup --key-file=- open --type luks %s %s' % \
-                             (shquote(dev), shquote(name)), tgtpath='/', catchout=True, stdin=passphrase)
-
-            except CmdError as err:
-                raise HostError("Can't open luks partition. %s" % str(err))
+            if name in probe['mapper']: continue
+            nodes.append(('luks:%s' % name, graph['luks:%s' % name],
+                          ("open luks partition %s on %s" % (name, dev),
+                           'printf %%s "$key" | sudo cryptsetup --key-file=- open --type luks %s %s' % \
+                           (shquote(dev), shquote(name)), self.vol_keys[name])))
 
         # mount devices
         for dev, mp in self.mounts.items():
-            ui.print_debug("mounting device: %s %s" % (dev, mp))
-            try:
-                if self.mount_options:
-                    mount_cmd = 'sudo mount -o %s %s %s' % (self.mount_options, shquote(dev), shquote(mp))
-                else:
-                    mount_cmd = 'sudo mount %s %s' % (shquote(dev), shquote(mp))
-
-                self.run_cmd('grep -qs %s /proc/mounts || %s' % (shquote(mp), mount_cmd),
-                             tgtpath='/', catchout=True)
-
-            except CmdError as err:
-                raise HostError("Can't mount %s. %s" % (mp, str(err)))
+            if mounts.is_mounted(probe, mp): continue
+            if self.mount_options:
+                mount_cmd = 'sudo mount -o %s %s %s' % (shquote(self.mount_options), shquote(dev), shquote(mp))
+            else:
+                mount_cmd = 'sudo mount %s %s' % (shquote(dev), shquote(mp))
+            nodes.append(('mount:%s' % mp, graph['mount:%s' % mp], ("mount %s on %s" % (dev, mp), mount_cmd, None)))
 
         # mount ecryptfs
         # TODO: needs testing
         for cryp, mp in self.ecryptfs_mounts.items():
-            ui.print_debug("mounting ecryptfs: %s %s" % (cryp, mp))
-            passphrase = self.vol_keys[mp]
-
-            try:
-                raw = self.run_cmd('sudo ecryptfs-add-passphrase -',
-                                   catchout=True, stdin=passphrase)
-                sig = re.search("\[(.*?)\]", raw).group(1)
-                options = "no_sig_cache,ecryptfs_unlink_sigs,key=passphrase,ecryptfs_cipher=aes," + \
-                          "ecryptfs_key_bytes=16,ecryptfs_passthrough=n,ecryptfs_enable_filename_crypto=y," + \
-                          "ecryptfs_sig=%s,ecryptfs_fnek_sig=%s" % (sig, sig)
-
-                mount_cmd = 'sudo mount -i -t ecryptfs -o %s %s.crypt %s' % (shquote(options),
-                                                                              shquote(cryp),
-                                                                              shquote(mp)),
-
-                self.run_cmd('grep -qs %s /proc/mounts || %s' % (shquote(mp), mount_cmd),
-                             tgtpath='/', catchout=True)
-            except CmdError as err:
-                raise HostError("Can't mount ecryptfs directory %s. %s" % (mp, str(err)))
+            if mounts.is_mounted(probe, mp): continue
+            options = "no_sig_cache,ecryptfs_unlink_sigs,key=passphrase,ecryptfs_cipher=aes," + \
+                      "ecryptfs_key_bytes=16,ecryptfs_passthrough=n,ecryptfs_enable_filename_crypto=y," + \
+                      "ecryptfs_sig=$sig,ecryptfs_fnek_sig=$sig"
+            getsig = "sed -n %s | head -n 1" % shquote(r's/.*\[\(.*\)\].*/\1/p')
+            cmd = 'sig=$(printf %%s "$key" | sudo ecryptfs-add-passphrase - | %s) && [ -n "$sig" ] && ' % getsig + \
+                  'sudo mount -i -t ecryptfs -o "%s" %s %s' % (options, shquote(cryp + '.crypt'), shquote(mp))
+            nodes.append(('ecryptfs:%s' % mp, graph['ecryptfs:%s' % mp],
+                          ("mount ecryptfs directory %s" % mp, cmd, self.vol_keys[mp])))
 
         # mount swap
-        if self.swapfile:
-            ui.print_debug("mounting swap: %s" % self.swapfile)
-            try:
-                self.run_cmd('grep -qs %s /proc/swaps || ' % shquote(self.swapfile) + \
-                             '[ ! -f %s ] || ' % shquote(self.swapfile) + \
-                             'sudo swapon %s' % shquote(self.swapfile),
-                             tgtpath='/', catchout=True)
+        if self.swapfile and not probe['paths'][self.swapfile] in probe['swaps']:
+            nodes.append(('swap', graph['swap'],
+                          ("mount swap %s" % self.swapfile,
+                           '[ ! -f %s ] || sudo swapon %s' % (shquote(self.swapfile), shquote(self.swapfile)), None)))
 
-            except CmdError as err:
-                raise HostError("Can't mount swap %s. %s" % (self.swapfile, str(err)))
+        self.run_mount_script(mounts.schedule(nodes))
 
 
     def umount_devices(self):
+        """Umounts the devices mounted by mount_devices, in reverse order. Actions that do
+           not depend on each other run concurrently."""
+        paths = list(self.mounts.values()) + list(self.ecryptfs_mounts.values())
+        if self.swapfile: paths.append(self.swapfile)
+        probe = self.probe_mounts(paths)
+
+        # reverse the graph: a device waits for everything mounted on top of it. Everything
+        # waits for the systemd user instance to go away, as it may hold any of them busy.
+        graph = self.mount_graph()
+        rgraph = dict((n, set([m for m in graph if n in graph[m]] + ['systemd'])) for n in graph)
+        nodes = []
+
         # kill systemd user session
         if self.systemd_user:
-            ui.print_debug("stopping systemd --user")
-            try:
-                self.run_cmd('systemctl --user exit || true', tgtpath='/', catchout=True)
-
-            except CmdError as err:
-                raise HostError("Error stopping systemd --user instance. %s" % str(err))
+            nodes.append(('systemd', set(), ("stop systemd --user instance", 'systemctl --user exit || true', None)))
 
         # umount swap
-        if self.swapfile:
-            ui.print_debug("umounting swap: %s" % self.swapfile)
-            try:
-                self.run_cmd('! grep -qs %s /proc/swaps || ' % shquote(self.swapfile) + \
-                             'sudo swapoff %s' % shquote(self.swapfile),
-                             tgtpath='/', catchout=True)
-
-            except CmdError as err:
-                raise HostError("Can't umount %s. %s" % (self.swapfile, str(err)))
+        if self.swapfile and probe['paths'][self.swapfile] in probe['swaps']:
+            nodes.append(('swap', rgraph['swap'],
+                          ("umount swap %s" % self.swapfile, 'sudo swapoff %s' % shquote(self.swapfile), None)))
 
         # umount ecryptfs
         for cryp, mp in self.ecryptfs_mounts.items():
-            ui.print_debug("umounting ecryptfs: %s %s" % (cryp, mp))
-            try:
-                self.run_cmd('! grep -qs %s /proc/mounts || ' % shquote(mp) + \
-                             'sudo umount %s' % shquote(mp),
-                             tgtpath='/', catchout=True)
-            except CmdError as err:
-                raise HostError("Can't umount ecryptfs directory %s. %s" % (mp, str(err)))
+            if not mounts.is_mounted(probe, mp): continue
+            nodes.append(('ecryptfs:%s' % mp, rgraph['ecryptfs:%s' % mp],
+                          ("umount ecryptfs directory %s" % mp, 'sudo umount %s' % shquote(mp), None)))
 
         # umount devices
         for dev, mp in self.mounts.items():
-            ui.print_debug("umounting devices: %s %s" % (dev, mp))
-            try:
-                self.run_cmd('! grep -qs %s /proc/mounts || ' % shquote(mp) + \
-                             'sudo umount %s' % shquote(mp),
-                             tgtpath='/', catchout=True)
-            except CmdError as err:
-                raise HostError("Can't umount %s. %s" % (mp, str(err)))
+            if not mounts.is_mounted(probe, mp): continue
+            nodes.append(('mount:%s' % mp, rgraph['mount:%s' % mp],
+                          ("umount %s" % mp, 'sudo umount %s' % shquote(mp), None)))
 
         # close luks partitions
         for dev, name in self.luks_mounts.items():
-            ui.print_debug("umounting luks: %s %s" % (dev, name))
-            try:
-                self.run_cmd('sudo cryptsetup close --type luks %s' % shquote(name), tgtpath='/', catchout=True)
-            except CmdError as err:
-                raise HostError("Can't close luks partition %s. %s" % (name, str(err)))
+            if not name in probe['mapper']: continue
+            nodes.append(('luks:%s' % name, rgraph['luks:%s' % name],
+                          ("close luks partition %s" % name, 'sudo cryptsetup close --type luks %s' % shquote(name), None)))
+
+        self.run_mount_script(mounts.schedule(nodes))
 
 
     def check_devices(self):
         """Checks whether all devices are properly mounted, and path checks are ok"""
+        probe = self.probe_mounts(list(self.mounts.values()) + [self.path])
+
         # detect if some mountpoint is mising
         for dev, mt in self.mounts.items():
-            if not self.check_path_mountpoint(mt):
+            if not mounts.is_mounted(probe, mt):
                 ui.print_debug("path %s is not mounted" % mt)
                 return False
 
         # check whether basepath exists
-        if not self.path_exists(self.path):
+        if probe['paths'][self.path] == None:
             ui.print_debug("path %s does not exist" % self.path)
             return False
 
@@ -341,6 +439,55 @@ class BaseHost(object):
             raise HostError("Can't check disk usage. %s" % str(err))
 
 
+    def usage(self, path):
+        """Returns a dict with the disk usage in bytes and the number of files under path.
+        Uses the incremental index in async.dirindex, which runs on the host itself, and
+        falls back to du when python3 is not available there."""
+        import inspect
+        import async.dirindex as dirindex
+
+        try:
+            raw = self.run_cmd('python3 - usage .', tgtpath=path, catchout=True,
+                               stdin=inspect.getsource(dirindex))
+            return json.loads(raw)
+
+        except (CmdError, ValueError):
+            try:
+                raw = self.run_cmd('du -sk .; find . -not -type d -print | wc -l',
+                                   tgtpath=path, catchout=True)
+                size, files = raw.split('\n')[0].split()[0], raw.split('\n')[1]
+                return {'bytes': 1024*int(size), 'files': int(files)}
+            except (CmdError, ValueError, IndexError) as err:
+                raise HostError("Can't check disk usage. %s" % str(err))
+
+
+    def status_key(self, d, path):
+        """Returns the status key of directory d at path, see BaseDir.status_key"""
+        raw = self.run_cmd('%s; true' % d.status_key_cmd(self), tgtpath=path, catchout=True)
+        return raw.strip()
+
+
+    def git_numfiles(self, path):
+        """Returns the number of files tracked by the git repo at path. Reads the entry
+        count from the git index header, instead of listing the files."""
+        try:
+            raw = self.run_cmd('head -c 12 "$(git rev-parse --git-dir)/index" | od -An -tu1',
+                               tgtpath=path, catchout=True)
+            header = [int(b) for b in raw.split()]
+            if len(header) == 12 and bytes(header[0:4]) == b'DIRC':
+                return int.from_bytes(bytes(header[8:12]), 'big')
+
+        except (CmdError, ValueError) as err:
+            pass
+
+        # fallback to listing files
+        try:
+            raw = self.run_cmd("git ls-files | wc -l", tgtpath=path, catchout=True)
+            return int(raw.strip())
+        except (CmdError, ValueError) as err:
+            raise HostError("Can't count files. %s" % str(err))
+
+
 
     def run_on_dirs(self, dirs, func, action, desc=None, silent=False, dryrun=False):
         """Utility function to run a function on a set of directories.
@@ -412,17 +559,18 @@ class BaseHost(object):
                            'success': success,
                            'busy': False})
         try:
-            self.run_cmd('echo %s > %s' % (shquote(data), shquote(lsfile)), catchout=True)
+            self.write_file(lsfile, data + '\n')
         except:
             ui.print_warning("Can't save '%s'" % lsfile)
 
 
     def read_lastsync(self, path):
+        import dateutil.parser
+
         lsfile = os.path.join(path, self.asynclast_file)
 
         try:
-            raw = self.run_cmd('[ -f %s ] && cat %s || true' % (shquote(lsfile), shquote(lsfile)),
-                               catchout=True).strip()
+            raw = (self.read_file(lsfile) or '').strip()
             ls = json.loads(raw)
             return {'remote': ls.get('remote', None),
                     'timestamp': dateutil.parser.parse(ls['timestamp']),
@@ -447,7 +595,7 @@ class BaseHost(object):
                            'success': False,
                            'busy': True})
         try:
-            self.run_cmd('echo %s > %s' % (shquote(data), shquote(lsfile)))
+            self.write_file(lsfile, data + '\n')
         except:
             ui.print_warning("Can't save '%s'" % lsfile)
 
@@ -580,78 +728,130 @@ class BaseHost(object):
             ui.print_error(str(err))
 
 
+    def dirs_status(self, dirs, slow=False, jobs=None, cache=None):
+        """Generator producing the status of each directory in dirs, in order. Statuses are
+           computed concurrently, and each one is produced as soon as all the previous ones
+           are available. If a StatusCache is given, valid entries are used instead of
+           querying the directory, and fresh statuses are stored in it."""
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        jobs = jobs or self.STATUS_JOBS
+        num = len(dirs)
+        if num == 0: return
+
+        def func(d):
+            if cache == None:
+                return d.status(self, slow=slow)
+
+            key = d.status_key(self)
+            status = cache.get(d, key, slow=slow)
+            if status == None:
+                status = d.status(self, slow=slow)
+                cache.put(d, key, slow, status)
+            return status
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(func, d) for d in dirs]
+            pending = set(futures)
+            nxt = 0
+
+            while nxt < num:
+                if not futures[nxt].done():
+                    ui.print_progress("collecting status on %s" % self.name,
+                                      float(num - len(pending)) / num)
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    continue
+
+                ui.clear_progress()
+                yield futures[nxt].result()
+                nxt = nxt + 1
+
+
+    def dirstate_row(self, status):
+        """Formats a line of print_dirstate from a directory status"""
+        # sync status
+        if status['ls-success'] == None:    lastsync='  '
+        elif status['ls-success'] == False: lastsync=' #RX#t'
+        elif status['ls-success'] == True:  lastsync=' #G√#t'
+
+        # last sync timestamp
+        if status['ls-timestamp']: timestamp=status['ls-timestamp'].strftime(' %d %b %H:%M ')
+        else:                      timestamp="              "
+
+        dirname = ' #*b{0[relpath]:<10}#t'.format(status)
+        perms = ' #G{0[perms]} #Y{0[user]:<6}#t'.format(status)
+
+        # directory type
+        dirtype = ' '
+        if status['path']: dirtype = ' {0:<12}'.format(self.DIRSTATE_TYPES[status['type']])
+        else:              dirtype = ' {0:<12}'.format('#Rgone!#t')
+
+        # disk usage
+        size = '--'
+        if 'size' in status:
+            size = number2human(status['size'], fmt='%(value).3G%(symbol)s')
+        size = '#M{0:>6}#t'.format(size)
+
+        # number of files
+        numfiles = '--'
+        if 'numfiles' in status:
+            numfiles = number2human(status['numfiles'], fmt='%(value).3G%(symbol)s')
+        numfiles = '#C{0:>6}#t'.format(numfiles)
+
+        numchanged = '--'
+        if 'changed' in status:
+            numchanged = number2human(status.get('changed', 0) + status.get('staged', 0),
+                                      fmt='%(value).3G%(symbol)s')
+        numchanged = '#Y{0:>6}#t'.format(numchanged)
+
+        nummissing = '--'
+        if 'missing' in status:
+            nummissing = number2human(status['missing'], fmt='%(value).3G%(symbol)s')
+        nummissing = '#R{0:>6}#t'.format(nummissing)
+
+        numunused = '--'
+        if 'unused' in status:
+            numunused = number2human(status['unused'], fmt='%(value).3G%(symbol)s')
+        numunused = '#G{0:>6}#t'.format(numunused)
+
+        # git status
+        if status['type'] in set(['annex', 'git']):
+            if status['conflicts'] > 0:  symstate = ' #RX#t'
+            elif status['changed'] > 0:  symstate = ' #R*#t'
+            elif status['staged'] > 0:   symstate = ' #G*#t'
+            else:                        symstate = ' #G√#t'
+        else:                            symstate = ' ·'
+
+        return perms + lastsync + timestamp + symstate + dirtype + \
+            size + numfiles + numchanged + nummissing + numunused + " " + dirname
+
+
     def print_dirstate(self, state=None, silent=False, dryrun=False, opts=None):
         """Prints the state of directories in a host"""
 
-        types={
-            'local' : '#Mlocal#t',
-            'unison': '#Yunison#t',
-            'rsync' : '#Yrsync#t',
-            'annex' : '#Gannex#t',
-            'git'   : '#Bgit#t',
-        }
-
         if opts: slow = opts.slow
         else:    slow = True
 
+        if opts: jobs = opts.jobs
+        else:    jobs = None
+
+        # cached statuses are only used or refreshed on request
+        if opts and (opts.cached or opts.refresh):
+            cache = StatusCache(self, self.status_ttl, refresh=opts.refresh)
+        else:
+            cache = None
+
         try:
             with self.in_state(state, silent=silent, dryrun=dryrun):
                 ui.print_color("Directories on #*m%s#t (%s)\n" % (self.name, self.path))
-                for k, d in self.directories().items():
-                    status = d.status(self, slow=slow)
-
-                    # sync status
-                    if status['ls-success'] == None:    lastsync='  '
-                    elif status['ls-success'] == False: lastsync=' #RX#t'
-                    elif status['ls-success'] == True:  lastsync=' #G√#t'
-
-                    # last sync timestamp
-                    if status['ls-timestamp']: timestamp=status['ls-timestamp'].strftime(' %d %b %H:%M ')
-                    else:                      timestamp="              "
-
-                    dirname = ' #*b{0[relpath]:<10}#t'.format(status)
-                    perms = ' #G{0[perms]} #Y{0[user]:<6}#t'.format(status)
-
-                    # directory type
-                    dirtype = ' '
-                    if status['path']: dirtype = ' {0:<12}'.format(types[status['type']])
-                    else:              dirtype = ' {0:<12}'.format('#Rgone!#t')
-
-                    # number of files
-                    numfiles = '--'
-                    if 'numfiles' in status:
-                        numfiles = number2human(status['numfiles'], fmt='%(value).3G%(symbol)s')
-                    numfiles = '#C{0:>6}#t'.format(numfiles)
-
-                    numchanged = '--'
-                    if 'changed' in status:
-                        numchanged = number2human(status.get('changed', 0) + status.get('staged', 0),
-                                                  fmt='%(value).3G%(symbol)s')
-                    numchanged = '#Y{0:>6}#t'.format(numchanged)
-
-                    nummissing = '--'
-                    if 'missing' in status:
-                        nummissing = number2human(status['missing'], fmt='%(value).3G%(symbol)s')
-                    nummissing = '#R{0:>6}#t'.format(nummissing)
-
-                    numunused = '--'
-                    if 'unused' in status:
-                        numunused = number2human(status['unused'], fmt='%(value).3G%(symbol)s')
-                    numunused = '#G{0:>6}#t'.format(numunused)
-
-                    # git status
-                    if status['type'] in set(['annex', 'git']):
-                        if status['conflicts'] > 0:  symstate = ' #RX#t'
-                        elif status['changed'] > 0:  symstate = ' #R*#t'
-                        elif status['staged'] > 0:   symstate = ' #G*#t'
-                        else:                        symstate = ' #G√#t'
-                    else:                            symstate = ' ·'
-
-                    ui.print_color(perms + lastsync + timestamp + symstate + dirtype + \
-                                   numfiles + numchanged + nummissing + numunused + " " + dirname)
+                dirs = list(self.directories().values())
+                for status in self.dirs_status(dirs, slow=slow, jobs=jobs, cache=cache):
+                    ui.print_color(self.dirstate_row(status))
 
                 print("")
 
+            if cache: cache.save()
+
         except HostError as err:
             ui.print_error(str(err))
 
@@ -830,6 +1030,35 @@ class BaseHost(object):
             return False
 
 
+    def path_stat(self, path):
+        """Returns a dict with the perms, user and group of path after dereferencing
+        symlinks, or None if it does not exist"""
+        try:
+            raw = self.run_cmd('stat -L -c "%%a %%U:%%G" %s' % shquote(path), catchout=True)
+            m = re.match('^(\d+) ([^\s:]+):(\S+)$', raw.strip())
+            return {'perms': m.group(1), 'user': m.group(2), 'group': m.group(3)}
+
+        except (CmdError, AttributeError):
+            return None
+
+
+    def read_file(self, path):
+        """Returns the contents of a file, or None if it does not exist"""
+        try:
+            return self.run_cmd('[ -f %s ] && cat %s || true' % (shquote(path), shquote(path)),
+                                catchout=True)
+        except CmdError as err:
+            raise HostError("Can't read %s on %s. %s" % (path, self.name, str(err)))
+
+
+    def write_file(self, path, data):
+        """Writes data into a file, replacing its contents"""
+        try:
+            self.run_cmd('cat > %s' % shquote(path), stdin=data, catchout=True)
+        except CmdError as err:
+            raise HostError("Can't write %s on %s. %s" % (path, self.name, str(err)))
+
+
     def relativepath(self, path):
         """Returns the relative path from host root"""
         return os.path.relpath(os.path.join(self.path, path), self.path)
@@ -883,7 +1112,7 @@ class BaseHost(object):
 
     def set_state(self, state, silent=False, dryrun=False):
         """Sets the host to the given state, passing through all the states in between."""
-        self.state = self.get_state()
+        self.state = self.current_state()
         if state == 'unknown': return state
 
         ui.print_debug("set_state. %s --> %s" % (self.state, state))
@@ -899,6 +1128,7 @@ class BaseHost(object):
                 for i in range(cur, new, 1):
                     st = self.STATES[i+1]
                     def func():
+                        self.forget_state()
                         self.enter_state(st)
 
                     self.run_with_message(func=func,
@@ -911,6 +1141,7 @@ class BaseHost(object):
                 for i in range(cur, new, -1):
                     st = self.STATES[i]
                     def func():
+                        self.forget_state()
                         self.leave_state(st)
 
                     self.run_with_message(func=func,
@@ -923,10 +1154,28 @@ class BaseHost(object):
             ui.print_error(str(err))
             return self.state
 
-        self.state = self.get_state()
+        self.state = self.current_state()
         return self.state
 
 
+    def current_state(self):
+        """Returns the state of the host. Within a scope it is only queried once, and again
+        after each state transition."""
+        if self.scope != None and 'state' in self.scope:
+            self.state = self.scope['state']
+            return self.state
+
+        state = self.get_state()
+        if self.scope != None: self.scope['state'] = state
+        return state
+
+
+    def forget_state(self):
+        """Drops the state memoized in the current scope"""
+        if self.scope != None and 'state' in self.scope:
+            del self.scope['state']
+
+
     def get_state(self):
         """Queries the state of the host"""
         raise NotImplementedError
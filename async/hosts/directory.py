@@ -18,13 +18,20 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import pwd
+import grp
+import stat
+import shutil
 import subprocess
 from signal import signal, SIGPIPE, SIG_DFL
 
 import async.archui as ui
 import async.cmd as cmd
+import async.dirindex as dirindex
+import async.mounts as mounts
 
 from async.hosts.base import BaseHost, HostError, CmdError
+from async.utils import parse_mountinfo
 
 class DirectoryHost(BaseHost):
     """Host representing a local directory. A USB mountpoint, for instance"""
@@ -79,7 +86,7 @@ class DirectoryHost(BaseHost):
         """Gets a dictionary with host state parameters"""
         info = {}
 
-        info['state'] = self.get_state()
+        info['state'] = self.current_state()
         if info['state'] in set(['mounted']):
             size, available = self.df(self.path)
             info['size'] = size
@@ -134,5 +141,155 @@ class DirectoryHost(BaseHost):
 
 
 
+    # Filesystem manipulations
+    # ----------------------------------------------------------------
+
+    # NOTE: the host lives on the local filesystem, so we can do these in-process instead
+    # of forking a shell for every check.
+
+    def _localpath(self, path, base=None):
+        """Interprets path as run_cmd would, relative to base or the host path"""
+        base = os.path.expandvars(os.path.expanduser(base or self.path))
+        return os.path.join(base, path)
+
+
+    def symlink(self, tgt, path, force=False):
+        path = self._localpath(path)
+        try:
+            if force and os.path.lexists(path):
+                if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+                else:                                                os.remove(path)
+            os.symlink(tgt, path)
+
+        except OSError as err:
+            raise HostError("Can't create symlink on %s. %s" % (self.name, str(err)))
+
+
+    def path_exists(self, path):
+        """Returns true if given path exists"""
+        return os.path.lexists(self._localpath(path, '/'))
+
+
+    def path_is_directory(self, path):
+        """Returns true if given path is a directory"""
+        return os.path.isdir(self._localpath(path, '/'))
+
+
+    def path_is_symlink(self, path):
+        """Returns true if given path is a symlink"""
+        return os.path.islink(self._localpath(path, '/'))
+
+
+    def path_stat(self, path):
+        """Returns a dict with the perms, user and group of path after dereferencing
+        symlinks, or None if it does not exist"""
+        try:
+            st = os.stat(self._localpath(path))
+        except OSError:
+            return None
+
+        try:    user = pwd.getpwuid(st.st_uid).pw_name
+        except KeyError: user = str(st.st_uid)
+
+        try:    group = grp.getgrgid(st.st_gid).gr_name
+        except KeyError: group = str(st.st_gid)
+
+        return {'perms': '%o' % stat.S_IMODE(st.st_mode), 'user': user, 'group': group}
+
+
+    def read_file(self, path):
+        """Returns the contents of a file, or None if it does not exist"""
+        path = self._localpath(path)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, 'r') as fd:
+                return fd.read()
+        except IOError as err:
+            raise HostError("Can't read %s on %s. %s" % (path, self.name, str(err)))
+
+
+    def write_file(self, path, data):
+        """Writes data into a file, replacing its contents"""
+        path = self._localpath(path)
+        try:
+            with open(path, 'w') as fd:
+                fd.write(data)
+        except IOError as err:
+            raise HostError("Can't write %s on %s. %s" % (path, self.name, str(err)))
+
+
+    def realpath(self, path):
+        """Returns the real path after dereferencing symlinks, or none if dangling"""
+        rp = os.path.realpath(self._localpath(path, '/'))
+        if not os.path.isdir(os.path.dirname(rp)):
+            return None
+        return rp
+
+
+    def mkdir(self, path, mode):
+        path = self._localpath(path)
+        try:
+            os.mkdir(path)
+            os.chmod(path, mode)
+        except OSError as err:
+            raise HostError("Can't create directory on %s. %s" % (self.name, str(err)))
+
+
+    def chmod(self, path, mode):
+        try:
+            os.chmod(self._localpath(path), mode)
+        except OSError as err:
+            raise HostError("Can't chmod directory on %s. %s" % (self.name, str(err)))
+
+
+    def probe_mounts(self, paths):
+        """Reads the mount state in-process. No need for a shell."""
+        return mounts.local_probe(paths)
+
+
+    def check_path_mountpoint(self, path):
+        """Returns true if path is a mountpoint"""
+        path = os.path.realpath(self._localpath(path, '/'))
+        try:
+            with open('/proc/self/mountinfo', 'r') as fd:
+                mounts = parse_mountinfo(fd.read())
+            return path in set([m['mountpoint'] for m in mounts])
+
+        except IOError:
+            return os.path.ismount(path)
+
+
+    def df(self, path):
+        """Return a tuple of integers (size, available) in KiB, as df does"""
+        try:
+            st = os.statvfs(self._localpath(path))
+            return (st.f_blocks * st.f_frsize // 1024, st.f_bavail * st.f_frsize // 1024)
+        except OSError as err:
+            raise HostError("Can't check disk usage. %s" % str(err))
+
+
+    def usage(self, path):
+        """Returns a dict with the disk usage in bytes and the number of files under path"""
+        try:
+            return dirindex.usage(self._localpath(path))
+        except OSError as err:
+            raise HostError("Can't check disk usage. %s" % str(err))
+
+
+    def status_key(self, d, path):
+        """Returns the status key of directory d at path, computed in-process"""
+        return '\n'.join(d.status_key_local(self._localpath(path)))
+
+
+    def git_numfiles(self, path):
+        """Returns the number of files tracked by the git repo at path"""
+        count = dirindex.git_index_count(self._localpath(path))
+        if count == None: return super(DirectoryHost, self).git_numfiles(path)
+        else:             return count
+
+
+
 
 # vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -20,13 +20,15 @@
 from async.hosts.ssh import SshHost, SshError
 from async.hosts.base import HostError
 
+import time
 from datetime import datetime, date
-from boto import ec2
-from boto.exception import EC2ResponseError
+from collections import OrderedDict
 
 import async.archui as ui
 import async.cmd as cmd
 import async.utils as utils
+from async.utils import load_cache, save_cache
+import async.waiter as waiter
 
 
 class Ec2Error(Exception):
@@ -39,6 +41,9 @@ class Ec2Host(SshHost):
     # ordered list of states. terminate does not belong here as it destroys the instance.
     STATES = ['terminated', 'offline', 'running', 'online', 'attached', 'mounted']
 
+    # seconds we trust the ids found on a previous run, before discovering them again
+    ID_CACHE_TTL = 600
+
     def __init__(self, conf):
         ui.print_debug("begin Ec2Host.__init__")
 
@@ -55,7 +60,10 @@ class Ec2Host(SshHost):
         self.ec2_security_group = conf['instance']['ec2_security_group']
 
         self.ec2_region = conf['instance']['ec2_region']
-        self.aws_keys = utils.read_keys(conf['instance']['aws_keys'])
+        self.ec2_backend = conf['instance']['ec2_backend']
+
+        if conf['instance']['aws_keys']: self.aws_keys = utils.read_keys(conf['instance']['aws_keys'])
+        else:                            self.aws_keys = {}
 
         self.ec2_vol = conf['instance']['volumes']
 
@@ -64,48 +72,62 @@ class Ec2Host(SshHost):
         self.ami = None
         self.instance = None
 
+        self.id_cache = 'ec2-%s.json' % self.name
+
 
 
 
     # Utilities
     # ----------------------------------------------------------------
 
-    def detach_volume(self, vol):
-        try:
-            vol.update()
-            if vol.attachment_state() != 'detached':
-                vol.detach()
+    def _volume_errors(self, errors):
+        return '\n'.join(["%s (%s): %s" % (dev, self.volumes[dev].id, err) for dev, err in errors.items()])
 
-        except EC2ResponseError as err:
-            raise HostError(str(err))
 
-        def _state():
-            vol.update()
-            return vol.attachment_state()
+    def set_volumes(self, state, request):
+        """Brings all volumes to the given attachment state, calling request(dev, vol) for
+        the ones not there yet. All requests go out before we wait, and each poll covers
+        every volume with a single call. Errors are reported per volume."""
+        EC2ResponseError = self._backend()[1]
 
-        if not self.wait_for(None, _state):
-            raise HostError("Timed out detaching")
+        errors = OrderedDict()
+        pending = []
+        self.load_volumes()
+        for dev, vol in self.volumes.items():
+            if vol.attachment_state() == state: continue
+            try:
+                request(dev, vol)
+                pending.append(dev)
+            except EC2ResponseError as err:
+                errors[dev] = str(err)
+
+        last = {}
+        def _done():
+            self.load_volumes()
+            for dev in pending:
+                last[dev] = self.volumes[dev].attachment_state()
+            return all([last[dev] == state for dev in pending])
 
+        if len(pending) > 0 and not self.wait_for(True, _done):
+            for dev in pending:
+                if last.get(dev, None) != state:
+                    errors[dev] = "Timed out, volume is %s" % last.get(dev, None)
 
+        if len(errors) > 0:
+            raise HostError("Could not bring volumes to %s state:\n%s" % (state or 'detached', self._volume_errors(errors)))
 
-    def attach_volume(self, vol, inst, dev):
-        try:
-            vol.update()
-            if vol.attachment_state() != 'attached':
-                vol.attach(inst, dev)
 
-        except EC2ResponseError as err:
-            raise HostError(str(err))
+    def attach_volumes(self, inst):
+        self.set_volumes('attached', lambda dev, vol: vol.attach(inst, dev))
 
-        def _state():
-            vol.update()
-            return vol.attachment_state()
 
-        if not self.wait_for('attached', _state):
-            raise HostError("Timed out attaching")
+    def detach_volumes(self):
+        self.set_volumes(None, lambda dev, vol: vol.detach())
 
 
     def start_instance(self, id):
+        EC2ResponseError = self._backend()[1]
+
         try:
             self.conn.start_instances([id])
         except EC2ResponseError as err:
@@ -120,6 +142,8 @@ class Ec2Host(SshHost):
 
 
     def stop_instance(self, id):
+        EC2ResponseError = self._backend()[1]
+
         try:
             self.conn.stop_instances([id])
         except EC2ResponseError as err:
@@ -133,8 +157,30 @@ class Ec2Host(SshHost):
             raise HostError("Timed out stopping instance")
 
 
+    def terminate_instance(self, id):
+        EC2ResponseError = self._backend()[1]
+
+        try:
+            self.conn.terminate_instances([id])
+        except EC2ResponseError as err:
+            raise HostError(str(err))
+
+        def _state():
+            self.instance.update()
+            return self.instance.state
+
+        if not self.wait_for('terminated', _state):
+            raise HostError("Timed out terminating instance")
+
+        # a terminated instance is gone for good. Do not pick its id up again.
+        self.instance = None
+        self.save_cached_ids()
+
+
     def create_instance(self, ami_id, itype):
         """Creates a new instance"""
+        EC2ResponseError = self._backend()[1]
+
         try:
             res = self.conn.run_instances(min_count = 1, max_count = 1,
                                           image_id = ami_id,
@@ -160,19 +206,54 @@ class Ec2Host(SshHost):
         if not self.wait_for('running', _state):
             raise HostError("Timed out launching instance")
 
+        self.save_cached_ids()
+
+
+    def _backend(self):
+        """Returns the module implementing the ec2 api, and the exception it raises. Either
+        boto, or the in-process fake."""
+        if self.ec2_backend == 'boto':
+            from boto import ec2
+            from boto.exception import EC2ResponseError
+            return ec2, EC2ResponseError
+
+        elif self.ec2_backend == 'fake':
+            import async.hosts.ec2fake as ec2fake
+            return ec2fake, ec2fake.EC2ResponseError
+
+        else:
+            raise Ec2Error("Unknown ec2 backend %s" % self.ec2_backend)
+
 
     def aws_connect(self):
+        ec2, EC2ResponseError = self._backend()
+
         if self.conn == None:
             self.conn = ec2.connect_to_region(region_name = self.ec2_region,
-                                              aws_access_key_id = self.aws_keys['aws_access_key_id'],
-                                              aws_secret_access_key = self.aws_keys['aws_secret_access_key'])
+                                              aws_access_key_id = self.aws_keys.get('aws_access_key_id', None),
+                                              aws_secret_access_key = self.aws_keys.get('aws_secret_access_key', None))
 
-            self.load_volumes()
-            self.load_ami()
-            self.load_instance()
+            if self.conn == None:
+                raise Ec2Error("Could not establish a connection with aws.")
 
-        if self.conn == None:
-            raise Ec2Error("Could not establish a connection with aws.")
+            if not self.load_cached_ids():
+                from concurrent.futures import ThreadPoolExecutor
+
+                # the instance lookup needs the ami id. volumes can go in parallel.
+                def func():
+                    self.load_ami()
+                    self.load_instance()
+
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    futures = [executor.submit(self.load_volumes), executor.submit(func)]
+                    for fut in futures: fut.result()
+
+                self.save_cached_ids()
+
+            # these are fresh. no need to update them again within this scope.
+            if self.scope != None:
+                for obj in [self.ami, self.instance]:
+                    if obj: self.scope[('update', obj.id)] = True
 
 
     def aws_disconnect(self):
@@ -185,12 +266,78 @@ class Ec2Host(SshHost):
     # status functions
     # ------------------------------------------------------
 
+    def update(self, obj):
+        """Refreshes an aws object. Only once within a scope."""
+        if self.scope != None:
+            key = ('update', obj.id)
+            if key in self.scope: return
+            self.scope[key] = True
+
+        obj.update()
+
+
+    def load_cached_ids(self):
+        """Loads the ami, instance and volumes by the ids found on a previous run, with
+        targeted requests instead of searching. Returns False if there is no recent entry,
+        or it does not match aws anymore."""
+        from concurrent.futures import ThreadPoolExecutor
+        EC2ResponseError = self._backend()[1]
+
+        entry = load_cache(self.id_cache, None)
+        if entry == None:                                     return False
+        if time.time() - entry['time'] > self.ID_CACHE_TTL:   return False
+        if entry['ami'] != self.ec2_ami:                      return False
+        if entry['volumes'] != self.ec2_vol:                  return False
+
+        def func_instance():
+            res = self.conn.get_all_instances(instance_ids = [entry['instance_id']])
+            return [ins for r in res for ins in r.instances]
+
+        def func_ami():
+            return self.conn.get_all_images(image_ids = [entry['ami_id']])
+
+        try:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                futures = [executor.submit(func_instance), executor.submit(func_ami),
+                           executor.submit(self.load_volumes)]
+                instances, images, _ = [fut.result() for fut in futures]
+
+        except (EC2ResponseError, Ec2Error) as err:
+            ui.print_debug("discarding cached ec2 ids: %s" % str(err))
+            return False
+
+        if len(instances) != 1 or len(images) != 1:                 return False
+        if instances[0].state == 'terminated':                      return False
+        if instances[0].image_id != images[0].id:                   return False
+        if images[0].name != self.ec2_ami:                          return False
+
+        ui.print_debug("using cached ec2 ids for %s" % self.name)
+        self.instance = instances[0]
+        self.ami = images[0]
+        return True
+
+
+    def save_cached_ids(self):
+        # a missing instance may show up any time, so only cache ids of existing ones
+        if self.ami == None or self.instance == None:
+            save_cache(self.id_cache, None)
+            return
+
+        save_cache(self.id_cache, {'time': time.time(),
+                                   'ami': self.ec2_ami,
+                                   'ami_id': self.ami.id,
+                                   'instance_id': self.instance.id,
+                                   'volumes': self.ec2_vol})
+
+
     def load_instance(self):
         """Updates running instance"""
         if not self.conn: raise Ec2Error("No connection to EC2")
 
-        L = [ins for res in self.conn.get_all_instances() for ins in res.instances
-             if ins.image_id == self.ami.id and ins.state != 'terminated']
+        states = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+        res = self.conn.get_all_instances(filters={'image-id': self.ami.id,
+                                                   'instance-state-name': states})
+        L = [ins for r in res for ins in r.instances]
         if len(L) == 0:
             self.instance = None
         elif len(L) >= 2:
@@ -203,8 +350,7 @@ class Ec2Host(SshHost):
         """Loads an ami"""
         if not self.conn: raise Ec2Error("No connection to EC2")
 
-        L = [a for a in self.conn.get_all_images(owners = self.ec2_owner)
-             if self.ec2_ami == a.name]
+        L = self.conn.get_all_images(owners = self.ec2_owner, filters={'name': self.ec2_ami})
         if len(L) == 0:
             raise Ec2Error("Ami %s not found" % self.ec2_ami)
         elif len(L) >= 2:
@@ -214,21 +360,32 @@ class Ec2Host(SshHost):
 
 
     def load_volumes(self):
+        """Loads all the volumes with a single request"""
+        EC2ResponseError = self._backend()[1]
+
         if not self.conn: raise Ec2Error("No connection to EC2")
+        if len(self.ec2_vol) == 0: return
 
-        for dev, vol in self.ec2_vol.items():
-            L = self.conn.get_all_volumes(volume_ids = [vol])
-            if len(L) == 0:
-                raise Ec2Error("Can't fine volume %s" % vol)
-            elif len(L) >= 2:
-                raise Ec2Error("Found several volumes with id %s" % vol)
-            else:
-                self.volumes[dev] = L[0]
+        try:
+            L = self.conn.get_all_volumes(volume_ids = list(self.ec2_vol.values()))
+        except EC2ResponseError as err:
+            raise Ec2Error("Can't find volumes: %s" % str(err))
+
+        byid = {}
+        for vol in L:
+            if vol.id in byid:
+                raise Ec2Error("Found several volumes with id %s" % vol.id)
+            byid[vol.id] = vol
+
+        for dev, vid in self.ec2_vol.items():
+            if not vid in byid:
+                raise Ec2Error("Can't find volume %s" % vid)
+            self.volumes[dev] = byid[vid]
 
 
     def check_ami(self):
         """Returns true if the ami is available"""
-        if self.ami: self.ami.update()
+        if self.ami: self.update(self.ami)
         if self.ami:
             ui.print_debug("check_ami. ami: %s, state: %s" % (self.ami.id, self.ami.state))
             return self.ami.state == 'available'
@@ -238,7 +395,7 @@ class Ec2Host(SshHost):
 
     def check_instance(self):
         """Returns true if there is an instance running"""
-        if self.instance: self.instance.update()
+        if self.instance: self.update(self.instance)
         if self.instance:
             ui.print_debug("check_instance. instance: %s, state: %s" % (self.instance.id, self.instance.state))
             return self.instance.state == 'running'
@@ -249,8 +406,8 @@ class Ec2Host(SshHost):
     def check_volumes(self):
         """Returns true if all the volumes are attached"""
         attached = True
+        self.load_volumes()
         for dev, vol in self.volumes.items():
-            vol.update()
             state = vol.attachment_state()
             ui.print_debug("check_volumes. vol: %s, state: %s" % (dev, state))
             if not state == 'attached':
@@ -258,6 +415,11 @@ class Ec2Host(SshHost):
         return attached
 
 
+    def ssh_ready(self):
+        """Returns true once the instance accepts connections on the ssh port"""
+        return waiter.tcp_probe(self.ip, 22)
+
+
     def check_aws(self):
         self.aws_connect()
         return self.instance != None
@@ -289,6 +451,7 @@ class Ec2Host(SshHost):
             if self.instance == None:
 
                 def func():
+                    self.forget_state()
                     self.create_instance(ami_id=self.ami.id, itype=itype)
 
                 self.run_with_message(func=func,
@@ -312,7 +475,7 @@ class Ec2Host(SshHost):
         """Starts the host if not running and attach."""
         st = 'attached'
         ret = True
-        if self.state == None: self.get_state()
+        if self.state == None: self.current_state()
 
         try:
             if self.STATES.index(self.state) < self.STATES.index('attached'):
@@ -329,7 +492,7 @@ class Ec2Host(SshHost):
         """Terminates the current instance"""
         st = 'terminated'
         ret = True
-        if self.state == None: self.get_state()
+        if self.state == None: self.current_state()
 
         try:
             if self.STATES.index(self.state) > self.STATES.index('terminated'):
@@ -346,7 +509,7 @@ class Ec2Host(SshHost):
         """Attaches volumes"""
         st = 'attached'
         ret = True
-        if self.state == None: self.get_state()
+        if self.state == None: self.current_state()
 
         try:
             if self.STATES.index(self.state) < self.STATES.index('attached'):
@@ -363,7 +526,7 @@ class Ec2Host(SshHost):
         """Deataches volumes"""
         st = self.STATES[self.STATES.index('attached') - 1]
         ret = True
-        if self.state == None: self.get_state()
+        if self.state == None: self.current_state()
 
         try:
             if self.STATES.index(self.state) >= self.STATES.index('attached'):
@@ -379,7 +542,7 @@ class Ec2Host(SshHost):
     def snapshot(self, silent=False, dryrun=False):
         """Creates a snapshot of the running instance"""
         ret = False
-        if self.state == None: self.get_state()
+        if self.state == None: self.current_state()
 
         try:
             # go to online state, with detached data
@@ -415,7 +578,7 @@ class Ec2Host(SshHost):
     def backup(self, silent=False, dryrun=False):
         """Creates a data backup"""
         ret = False
-        if self.state == None: self.get_state()
+        if self.state == None: self.current_state()
 
         try:
             # go to online state with detached data
@@ -428,16 +591,17 @@ class Ec2Host(SshHost):
 
             cont = ui.ask_question_yesno("Do you want to continue?", default='yes')
             if cont == 'yes':
-                for k, dev in self.volumes.items():
-                    description = "volume %s on %s %s" % (k, self.name, date.today().strftime("%Y-%m-%d"))
-                    def func():
-                        self.make_data_snapshot(dev = dev, desc = description)
+                today = date.today().strftime("%Y-%m-%d")
+                descs = OrderedDict([(dev, "volume %s on %s %s" % (dev, self.name, today))
+                                     for dev in self.volumes.keys()])
+                def func():
+                    self.make_data_snapshots(descs)
 
-                    self.run_with_message(func=func,
-                                          msg="Creating volume backup for %s" % k,
-                                          silent=silent,
-                                          dryrun=dryrun)
-                    ret = True
+                self.run_with_message(func=func,
+                                      msg="Creating volume backups for %s" % ', '.join(descs.keys()),
+                                      silent=silent,
+                                      dryrun=dryrun)
+                ret = True
 
         except HostError as err:
             ui.print_error(str(err))
@@ -482,11 +646,13 @@ class Ec2Host(SshHost):
             self.start_instance(self.instance.id)
 
         elif state == 'online':
+            # a freshly started instance takes a while to bring up sshd. Wait for the
+            # port to open before paying for a full ssh handshake.
+            self.wait_for(True, self.ssh_ready)
             self.ssh_connect(alt_hostname=self.hostname)
 
         elif state == 'attached':
-            for dev, vol in self.volumes.items():
-                self.attach_volume(vol, self.instance.id, dev)
+            self.attach_volumes(self.instance.id)
 
         elif state == 'mounted':
             self.mount_devices()
@@ -500,7 +666,7 @@ class Ec2Host(SshHost):
             pass
 
         elif state == 'offline':
-            self.conn.terminate_instances([self.instance.id])
+            self.terminate_instance(self.instance.id)
 
         elif state == 'running':
             self.stop_instance(self.instance.id)
@@ -509,8 +675,7 @@ class Ec2Host(SshHost):
             pass
 
         elif state == 'attached':
-            for dev, vol in self.volumes.items():
-                self.detach_volume(vol)
+            self.detach_volumes()
 
         elif state == 'mounted':
             self.umount_devices()
@@ -614,14 +779,33 @@ class Ec2Host(SshHost):
             raise HostError("Timed out creating ami")
 
 
-    def make_data_snapshot(self, dev, desc):
-        """Creates a snapshot of the data volume."""
+    def make_data_snapshots(self, descs):
+        """Creates snapshots of the data volumes. descs maps devices to the snapshot
+        descriptions. All snapshots are requested before checking on any of them."""
+        EC2ResponseError = self._backend()[1]
+
         if not self.conn: raise Ec2Error("No connection to EC2")
 
-        if dev in self.volumes:
-            id = self.volumes[dev].id
-            self.conn.create_snapshot(volume_id = id,
-                                      description = desc)
+        errors = OrderedDict()
+        snaps = OrderedDict()
+        for dev, desc in descs.items():
+            if not dev in self.volumes: continue
+            try:
+                snaps[dev] = self.conn.create_snapshot(volume_id = self.volumes[dev].id,
+                                                       description = desc)
+            except EC2ResponseError as err:
+                errors[dev] = str(err)
+
+        # snapshots are point in time. Once started we need not wait for them to complete,
+        # but we want to know about the ones that failed right away.
+        if len(snaps) > 0:
+            ids = dict([(snap.id, dev) for dev, snap in snaps.items()])
+            for snap in self.conn.get_all_snapshots(snapshot_ids = list(ids.keys())):
+                if snap.status == 'error':
+                    errors[ids[snap.id]] = "Snapshot %s failed" % snap.id
+
+        if len(errors) > 0:
+            raise HostError("Could not snapshot volumes:\n%s" % self._volume_errors(errors))
 
 
 
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# async - A tool to manage and sync different machines
+# Copyright 2012,2013 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# In-process stand-in for the subset of boto's ec2 api that Ec2Host uses. Instances,
+# images, volumes and snapshots go through their intermediate states with configurable
+# delays, so the ec2 lifecycle can be exercised and timed without an aws account. Select
+# it with 'ec2_backend = fake' in the instance section of the config.
+#
+# Every describe call returns fresh copies of the objects, like the real api does, so
+# stale objects stay stale until updated. The region counts the api calls it gets.
+
+import time
+import threading
+from collections import OrderedDict
+
+
+# seconds each transition takes
+DELAYS = {
+    'launch':    30,     # pending -> running
+    'start':     20,     # pending -> running
+    'stop':      30,     # stopping -> stopped
+    'terminate': 20,     # shutting-down -> terminated
+    'attach':     5,     # attaching -> attached
+    'detach':     5,     # detaching -> detached
+    'image':     60,     # pending -> available
+    'snapshot':  60,     # pending -> completed
+}
+
+
+class EC2ResponseError(Exception):
+    def __init__(self, code, msg=None):
+        super(EC2ResponseError, self).__init__('%s: %s' % (code, msg or ''))
+        self.error_code = code
+
+
+
+class Region(object):
+    """The state of a fake ec2 region. With autocreate, images and volumes are made up on
+    the spot when looked up by name or id, so any config works out of the box."""
+
+    def __init__(self, delays=None, autocreate=True):
+        self.delays = dict(DELAYS)
+        if delays: self.delays.update(delays)
+        self.autocreate = autocreate
+
+        self.instances = OrderedDict()
+        self.images    = OrderedDict()
+        self.volumes   = OrderedDict()
+        self.snapshots = OrderedDict()
+
+        self.lock = threading.RLock()
+        self.counter = 0
+        self.calls = {}         # number of api calls by name
+
+
+    def new_id(self, prefix):
+        self.counter = self.counter + 1
+        return '%s-%08x' % (prefix, self.counter)
+
+
+    def transition(self, rec, key, now, then, delay):
+        """Sets rec[key] to now, and to then after delay seconds"""
+        rec[key] = now
+        rec['next'] = (key, then, time.time() + self.delays[delay])
+
+
+    def settle(self, rec):
+        """Applies the pending transition of rec if it is due"""
+        if rec.get('next', None) != None and time.time() >= rec['next'][2]:
+            key, val, t = rec['next']
+            rec[key] = val
+            rec['next'] = None
+        return rec
+
+
+    def add_image(self, name, owner=None, state='available'):
+        iid = self.new_id('ami')
+        self.images[iid] = {'id': iid, 'name': name, 'owner': owner, 'state': state}
+        return self.images[iid]
+
+
+    def add_volume(self, vid=None):
+        vid = vid or self.new_id('vol')
+        self.volumes[vid] = {'id': vid, 'status': None, 'instance': None, 'device': None}
+        return self.volumes[vid]
+
+
+
+_regions = {}
+_regions_lock = threading.Lock()
+
+
+def get_region(name, **kwargs):
+    """Returns the fake region with the given name. Keyword arguments are passed to
+    Region when it is created."""
+    with _regions_lock:
+        if not name in _regions:
+            _regions[name] = Region(**kwargs)
+        return _regions[name]
+
+
+def reset():
+    """Forgets all regions"""
+    with _regions_lock:
+        _regions.clear()
+
+
+def connect_to_region(region_name, **kwargs):
+    return Connection(get_region(region_name))
+
+
+
+# aws objects. They copy the state of a record when fetched or updated
+# ----------------------------------------------------------------
+
+class _Object(object):
+    TABLE = None
+
+    def __init__(self, conn, rec):
+        self.connection = conn
+        self._load(rec)
+
+    def _load(self, rec):
+        self.id = rec['id']
+
+    def update(self):
+        with self.connection.region.lock:
+            self.connection.count('update')
+            table = getattr(self.connection.region, self.TABLE)
+            if not self.id in table:
+                raise EC2ResponseError('NotFound', self.id)
+            self._load(self.connection.region.settle(table[self.id]))
+
+
+class Instance(_Object):
+    TABLE = 'instances'
+
+    def _load(self, rec):
+        self.id = rec['id']
+        self.image_id = rec['image_id']
+        self.state = rec['state']
+        self.instance_type = rec['instance_type']
+        self.placement = rec['placement']
+        self.root_device_name = '/dev/sda1'
+
+        if self.state == 'running':
+            self.ip_address = rec['ip_address']
+            self.public_dns_name = 'ec2-%s.compute.amazonaws.com' % rec['ip_address'].replace('.', '-')
+        else:
+            self.ip_address = None
+            self.public_dns_name = ''
+
+        self.block_device_mapping = {'/dev/sda1': None}
+        for vol in self.connection.region.volumes.values():
+            if vol['instance'] == self.id: self.block_device_mapping[vol['device']] = None
+
+    def get_console_output(self):
+        return _Output('fake console of %s\n' % self.id)
+
+
+class Image(_Object):
+    TABLE = 'images'
+
+    def _load(self, rec):
+        self.id = rec['id']
+        self.name = rec['name']
+        self.state = rec['state']
+        self.owner_id = rec['owner']
+
+
+class Volume(_Object):
+    TABLE = 'volumes'
+
+    def _load(self, rec):
+        self.id = rec['id']
+        self.attach_status = rec['status']
+        self.instance_id = rec['instance']
+        self.device = rec['device']
+
+    def attachment_state(self):
+        return self.attach_status
+
+    def attach(self, instance_id, device):
+        return self.connection.attach_volume(self.id, instance_id, device)
+
+    def detach(self):
+        return self.connection.detach_volume(self.id)
+
+
+class Snapshot(_Object):
+    TABLE = 'snapshots'
+
+    def _load(self, rec):
+        self.id = rec['id']
+        self.volume_id = rec['volume']
+        self.description = rec['description']
+        self.status = rec['status']
+
+
+class Reservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class _Output(object):
+    def __init__(self, output):
+        self.output = output
+
+
+
+# connection
+# ----------------------------------------------------------------
+
+def _match(val, pattern):
+    if isinstance(pattern, (list, tuple)): return val in pattern
+    else:                                  return val == pattern
+
+
+class Connection(object):
+    """Implements the calls of boto's EC2Connection that async uses"""
+
+    def __init__(self, region):
+        self.region = region
+
+
+    def count(self, name):
+        calls = self.region.calls
+        calls[name] = calls.get(name, 0) + 1
+
+
+    def close(self):
+        pass
+
+
+    def _records(self, table, ids, kind):
+        R = self.region
+        if ids == None:
+            return [R.settle(rec) for rec in table.values()]
+
+        recs = []
+        for i in ids:
+            if not i in table:
+                raise EC2ResponseError('Invalid%s.NotFound' % kind, "The %s '%s' does not exist" % (kind, i))
+            recs.append(R.settle(table[i]))
+        return recs
+
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        with self.region.lock:
+            self.count('get_all_instances')
+            filters = filters or {}
+            L = []
+            for rec in self._records(self.region.instances, instance_ids, 'InstanceID'):
+                if 'image-id' in filters and not _match(rec['image_id'], filters['image-id']):                  continue
+                if 'instance-state-name' in filters and not _match(rec['state'], filters['instance-state-name']): continue
+                L.append(Instance(self, rec))
+            return [Reservation([ins]) for ins in L]
+
+
+    def get_all_images(self, image_ids=None, owners=None, filters=None):
+        with self.region.lock:
+            self.count('get_all_images')
+            filters = filters or {}
+            if isinstance(owners, str): owners = [owners]
+
+            def func():
+                L = []
+                for rec in self._records(self.region.images, image_ids, 'AMIID'):
+                    if owners and not rec['owner'] in owners:                       continue
+                    if 'name' in filters and not _match(rec['name'], filters['name']): continue
+                    L.append(Image(self, rec))
+                return L
+
+            L = func()
+            if len(L) == 0 and self.region.autocreate and image_ids == None and 'name' in filters:
+                self.region.add_image(filters['name'], owner=(owners or [None])[0])
+                L = func()
+            return L
+
+
+    def get_all_volumes(self, volume_ids=None, filters=None):
+        with self.region.lock:
+            self.count('get_all_volumes')
+            if self.region.autocreate:
+                for vid in volume_ids or []:
+                    if not vid in self.region.volumes: self.region.add_volume(vid)
+
+            return [Volume(self, rec) for rec in self._records(self.region.volumes, volume_ids, 'Volume')]
+
+
+    def get_all_snapshots(self, snapshot_ids=None, filters=None):
+        with self.region.lock:
+            self.count('get_all_snapshots')
+            return [Snapshot(self, rec) for rec in self._records(self.region.snapshots, snapshot_ids, 'Snapshot')]
+
+
+    def run_instances(self, image_id, min_count=1, max_count=1, key_name=None,
+                      security_groups=None, instance_type='m1.small', placement=None):
+        with self.region.lock:
+            self.count('run_instances')
+            R = self.region
+            if not image_id in R.images or R.settle(R.images[image_id])['state'] != 'available':
+                raise EC2ResponseError('InvalidAMIID.Unavailable', "Image '%s' is not available" % image_id)
+
+            iid = R.new_id('i')
+            rec = {'id': iid, 'image_id': image_id, 'instance_type': instance_type,
+                   'placement': placement, 'ip_address': '10.0.%d.%d' % (R.counter // 256 % 256, R.counter % 256)}
+            R.transition(rec, 'state', 'pending', 'running', 'launch')
+            R.instances[iid] = rec
+            return Reservation([Instance(self, rec)])
+
+
+    def _set_instances_state(self, call, instance_ids, states, now, then, delay):
+        with self.region.lock:
+            self.count(call)
+            for rec in self._records(self.region.instances, instance_ids, 'InstanceID'):
+                if rec['state'] in states:
+                    self.region.transition(rec, 'state', now, then, delay)
+                elif rec['state'] != then and rec['state'] != now:
+                    raise EC2ResponseError('IncorrectInstanceState', "Instance '%s' is %s" % (rec['id'], rec['state']))
+
+                # terminated instances lose their volumes
+                if then == 'terminated':
+                    for vol in self.region.volumes.values():
+                        if vol['instance'] == rec['id']:
+                            vol['status'] = vol['instance'] = vol['device'] = None
+
+
+    def start_instances(self, instance_ids):
+        self._set_instances_state('start_instances', instance_ids, ['stopped'], 'pending', 'running', 'start')
+
+
+    def stop_instances(self, instance_ids):
+        self._set_instances_state('stop_instances', instance_ids, ['running', 'pending'], 'stopping', 'stopped', 'stop')
+
+
+    def terminate_instances(self, instance_ids):
+        self._set_instances_state('terminate_instances', instance_ids,
+                                  ['running', 'pending', 'stopping', 'stopped'],
+                                  'shutting-down', 'terminated', 'terminate')
+
+
+    def attach_volume(self, volume_id, instance_id, device):
+        with self.region.lock:
+            self.count('attach_volume')
+            vol, = self._records(self.region.volumes, [volume_id], 'Volume')
+            ins, = self._records(self.region.instances, [instance_id], 'InstanceID')
+            if vol['status'] != None:
+                raise EC2ResponseError('VolumeInUse', "Volume '%s' is %s" % (volume_id, vol['status']))
+            if not ins['state'] in ['running', 'stopped']:
+                raise EC2ResponseError('IncorrectState', "Instance '%s' is %s" % (instance_id, ins['state']))
+
+            vol['instance'] = instance_id
+            vol['device'] = device
+            self.region.transition(vol, 'status', 'attaching', 'attached', 'attach')
+            return True
+
+
+    def detach_volume(self, volume_id):
+        with self.region.lock:
+            self.count('detach_volume')
+            vol, = self._records(self.region.volumes, [volume_id], 'Volume')
+            if vol['status'] != 'attached':
+                raise EC2ResponseError('IncorrectState', "Volume '%s' is %s" % (volume_id, vol['status']))
+
+            vol['instance'] = vol['device'] = None
+            self.region.transition(vol, 'status', 'detaching', None, 'detach')
+            return True
+
+
+    def create_image(self, instance_id, name, description=None):
+        with self.region.lock:
+            self.count('create_image')
+            for rec in self.region.images.values():
+                if rec['name'] == name:
+                    raise EC2ResponseError('InvalidAMIName.Duplicate', "Image '%s' already exists" % name)
+
+            ins, = self._records(self.region.instances, [instance_id], 'InstanceID')
+            owner = self.region.images[ins['image_id']]['owner']
+            rec = self.region.add_image(name, owner=owner, state=None)
+            self.region.transition(rec, 'state', 'pending', 'available', 'image')
+            return rec['id']
+
+
+    def create_snapshot(self, volume_id, description=None):
+        with self.region.lock:
+            self.count('create_snapshot')
+            self._records(self.region.volumes, [volume_id], 'Volume')
+
+            sid = self.region.new_id('snap')
+            rec = {'id': sid, 'volume': volume_id, 'description': description}
+            self.region.transition(rec, 'status', 'pending', 'completed', 'snapshot')
+            self.region.snapshots[sid] = rec
+            return Snapshot(self, rec)
+
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -22,8 +22,6 @@ from collections import OrderedDict
 
 from async.hosts.base import HostError
 from async.hosts.directory import DirectoryHost
-from async.directories import SyncError, InitError, CheckError, LocalDir, HookError, SkipError
-from async.lastsync import LastSync
 
 import async.archui as ui
 
@@ -61,6 +59,8 @@ class LocalHost(DirectoryHost):
 
     def sync(self, remote, silent=False, dryrun=False, opts=None):
         """Syncs local machine to this host"""
+        from async.lastsync import LastSync
+
         dirs = (self.dirs & remote.dirs).data(keys=opts.dirs, ignore=opts.ignore)
 
         # keep actual directories which are syncable, and indexed by name.
@@ -20,6 +20,7 @@
 import re
 import os
 import sys
+import time
 import subprocess
 
 import async.archui as ui
@@ -27,6 +28,8 @@ import async.cmd as cmd
 
 from async.hosts.base import BaseHost, HostError, CmdError
 from async.openssh import SSHConnection, SSHConnectionError, SSHCmdError
+from async.utils import load_cache, save_cache
+import async.waiter as waiter
 
 class SshError(HostError):
     def __init__(self, msg=None):
@@ -38,6 +41,14 @@ class SshHost(BaseHost):
 
     STATES = ['offline', 'running', 'online', 'mounted']
 
+    # seconds to trust a resolved address, and a failed lookup. Failed lookups are
+    # retried sooner, but not on every call, as unreachable DNS may take seconds.
+    RESOLVE_TTL = 3600
+    RESOLVE_FAIL_TTL = 60
+
+    # seconds to wait for a woken up host to open its ssh port
+    WAKE_TIMEOUT = 120
+
     def __init__(self, conf):
         ui.print_debug("begin SshHost.__init__")
         super(SshHost, self).__init__(conf)
@@ -51,6 +62,7 @@ class SshHost(BaseHost):
 
         self._hostname        = None
         self._ip              = None
+        self._resolved        = False
 
         socketfile="ssh-%s.socket" % str(os.getpid())
         socket = os.path.expandvars('$XDG_RUNTIME_DIR/async/%s' % socketfile)
@@ -110,6 +122,31 @@ class SshHost(BaseHost):
             self.ssh.close()
 
 
+    def wait_ssh(self, timeout=None):
+        """Waits until the host accepts connections on the ssh port. Much cheaper than
+        retrying full ssh handshakes while the machine boots. Through a proxy the port is
+        not reachable from here, so we fall back to polling ssh itself."""
+        conf = self.ssh.ssh_config(self.ssh_hostname)
+        timeout = timeout or self.WAKE_TIMEOUT
+
+        proxied = any([conf.get(k, 'none') != 'none' for k in ['proxyjump', 'proxycommand']])
+        proxied = proxied or any([a == '-J' or 'proxy' in a.lower() for a in self.ssh_args])
+        if proxied:
+            ok, elapsed, polls = waiter.wait_for(self.check_ssh, timeout=timeout, initial=1, maximum=10)
+            ui.print_debug("waited %.1f s for ssh on %s through a proxy (%d attempts)" % (elapsed, self.name, polls))
+            return ok
+
+        host = self.ip or conf.get('hostname', self.ssh_hostname)
+        try:
+            port = int(conf.get('port', 22))
+        except ValueError:
+            port = 22
+
+        ok, elapsed, attempts = waiter.tcp_wait(host, port, timeout=timeout)
+        ui.print_debug("waited %.1f s for port %d on %s (%d attempts)" % (elapsed, port, self.name, attempts))
+        return ok
+
+
     def check_ssh(self):
         try:
             self.connect()
@@ -130,7 +167,10 @@ class SshHost(BaseHost):
             pass
 
         elif state == 'running':
-            self.wake_on_lan()
+            if self.mac_address:
+                self.wake_on_lan()
+                if not self.wait_ssh():
+                    raise SshError("%s did not come up after wake on lan" % self.name)
 
         elif state == 'online':
             self.connect()
@@ -177,15 +217,46 @@ class SshHost(BaseHost):
     # ----------------------------------------------------------------
 
     def _cache_hostname_and_ip(self):
-        hostname, ip = self.ssh.resolve(hostname=self.ssh_hostname)
-        self._ip = ip
-        if hostname: self._hostname = hostname
-        else:        self._hostname = ip
+        """Resolves the hostname and ip through ssh config and DNS. The answer is kept
+        on disk for a while, and invalidated when any ssh config file changes, included
+        ones too."""
+        mtimes = []
+        for path in self.ssh.config_files():
+            try:
+                mtimes.append([path, os.stat(path).st_mtime])
+            except OSError:
+                mtimes.append([path, None])
+
+        cache = load_cache('resolve.json', {})
+        entry = cache.get(self.ssh_hostname, None)
+
+        if entry != None and entry.get('config', None) == mtimes:
+            if entry['ip']: ttl = self.RESOLVE_TTL
+            else:           ttl = self.RESOLVE_FAIL_TTL
+            if time.time() - entry['time'] > ttl: entry = None
+        else:
+            entry = None
+
+        if entry == None:
+            hostname, ip = self.ssh.resolve(hostname=self.ssh_hostname)
+            entry = {'time': time.time(), 'config': mtimes, 'hostname': hostname, 'ip': ip}
+
+            cache = load_cache('resolve.json', {})
+            cache[self.ssh_hostname] = entry
+            save_cache('resolve.json', cache)
+
+        else:
+            ui.print_debug("using cached address for %s" % self.ssh_hostname)
+
+        self._ip = entry['ip']
+        if entry['hostname']: self._hostname = entry['hostname']
+        else:                 self._hostname = entry['ip']
+        self._resolved = True
 
 
     @property
     def hostname(self):
-        if self._hostname == None:
+        if not self._resolved:
             self._cache_hostname_and_ip()
 
         return self._hostname
@@ -193,7 +264,7 @@ class SshHost(BaseHost):
 
     @property
     def ip(self):
-        if self._ip == None:
+        if not self._resolved:
             self._cache_hostname_and_ip()
 
         return self._ip
@@ -223,7 +294,7 @@ class SshHost(BaseHost):
         ui.print_debug("begin SshHost.get_info")
         info = {}
 
-        info['state'] = self.get_state()
+        info['state'] = self.current_state()
         if info['state'] in set(['mounted', 'online']):
             info['host'] = self.hostname
             info['ip'] = self.ip
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# async - A tool to manage and sync different machines
+# Copyright 2012,2013 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Helpers to mount and umount the devices of a host in a single round trip. We read the
+# mount table, active swaps and device-mapper names with one command, decide what needs
+# doing, and run all of it as one shell script.
+#
+# A script is a list of stages, and each stage a list of actions (desc, cmd, key). The
+# actions within a stage run concurrently, and a stage only starts when the previous one
+# succeeded. Keys are fed through stdin, one per line, and an action sees its own as "$key",
+# so passphrases never show up in a command line.
+#
+# The stages come from the dependencies between actions (see schedule), so independent
+# luks containers are opened at the same time, and a device mount does not wait for
+# unrelated containers.
+
+import os
+import re
+
+from async.utils import parse_mountinfo, shquote
+
+
+def probe_cmd(paths):
+    """Returns a shell command printing the mount table, the active swaps, the
+    device-mapper names, and for each of paths, its canonical path if it exists"""
+    lines = ['echo "#mountinfo"', 'cat /proc/self/mountinfo',
+             'echo "#swaps"',     'cat /proc/swaps 2>/dev/null',
+             'echo "#mapper"',    'ls -1 /dev/mapper 2>/dev/null',
+             'echo "#paths"']
+
+    for p in paths:
+        q = shquote(p)
+        lines.append('if [ -e %s ] || [ -h %s ]; then printf "+%%s\\n" "$(readlink -f %s || echo %s)"; '
+                     'else echo "-"; fi' % (q, q, q, q))
+
+    return '; '.join(lines) + '; true'
+
+
+def _parse_swaps(lines):
+    swaps = set()
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) > 0: swaps.add(re.sub(r'\\040', ' ', fields[0]))
+    return swaps
+
+
+def parse_probe(raw, paths):
+    """Parses the output of probe_cmd. Returns a dict with the sets of 'mounts', 'swaps'
+    and 'mapper' names, and 'paths' mapping each of paths to its canonical path, or None
+    if it does not exist."""
+    sections = {}
+    cur = None
+    for line in raw.split('\n'):
+        if line in ['#mountinfo', '#swaps', '#mapper', '#paths']:
+            cur = line[1:]
+            sections[cur] = []
+        elif cur != None:
+            sections[cur].append(line)
+
+    mounts = set([m['mountpoint'] for m in parse_mountinfo('\n'.join(sections.get('mountinfo', [])))])
+    swaps = _parse_swaps(sections.get('swaps', []))
+    mapper = set([n.strip() for n in sections.get('mapper', []) if len(n.strip()) > 0])
+
+    canonical = {}
+    lines = [l for l in sections.get('paths', []) if len(l) > 0]
+    for p, line in zip(paths, lines):
+        if line.startswith('+'): canonical[p] = line[1:]
+        else:                    canonical[p] = None
+
+    return {'mounts': mounts, 'swaps': swaps, 'mapper': mapper, 'paths': canonical}
+
+
+def local_probe(paths):
+    """Same as running probe_cmd and parsing its output, but in-process on this machine.
+    Relative paths are taken relative to /."""
+    def read(path):
+        try:
+            with open(path, 'r') as fd:
+                return fd.read()
+        except (IOError, OSError):
+            return ''
+
+    try:
+        mapper = set(os.listdir('/dev/mapper'))
+    except OSError:
+        mapper = set()
+
+    canonical = {}
+    for p in paths:
+        path = os.path.join('/', p)
+        if os.path.lexists(path): canonical[p] = os.path.realpath(path)
+        else:                     canonical[p] = None
+
+    return {'mounts': set([m['mountpoint'] for m in parse_mountinfo(read('/proc/self/mountinfo'))]),
+            'swaps':  _parse_swaps(read('/proc/swaps').split('\n')),
+            'mapper': mapper,
+            'paths':  canonical}
+
+
+def is_mounted(probe, path):
+    """Returns true if path is a mountpoint, according to a probe that included path"""
+    path = probe['paths'].get(path, None)
+    return path != None and path in probe['mounts']
+
+
+def inside(path, mp):
+    """Returns true if path is mp or lies below it"""
+    path = os.path.normpath(path)
+    mp = os.path.normpath(mp)
+    return path == mp or path.startswith(mp.rstrip('/') + '/')
+
+
+def luks_deps(dev, names):
+    """Returns which of the luks names the device dev may sit on. /dev/mapper/<name> only
+    depends on name, and plain kernel devices like /dev/sdb1 on none. Anything else, like
+    LVM volumes or UUID= specs, could live inside any of them."""
+    names = list(names)
+    if dev.startswith('/dev/mapper/'):
+        name = dev[len('/dev/mapper/'):]
+        if name in names: return [name]
+        else:             return names
+
+    if re.match(r'^/dev/[^/]+$', dev) and not dev.startswith('/dev/dm-'):
+        return []
+
+    return names
+
+
+def schedule(nodes):
+    """Groups actions into stages. nodes is a list of (name, deps, action), where deps
+    are the names of the nodes that must finish before this one. Each action lands in the
+    first stage after all its dependencies. Dependencies on names not in nodes are taken as
+    already satisfied."""
+    deps = dict((name, set(d)) for name, d, action in nodes)
+    level = {}
+
+    def visit(name, path):
+        if name in level: return level[name]
+        if name in path:  raise ValueError("Dependency cycle among %s" % ', '.join(path))
+        lv = 0
+        for d in deps[name]:
+            if d in deps: lv = max(lv, visit(d, path + [name]) + 1)
+        level[name] = lv
+        return lv
+
+    stages = []
+    for name, d, action in nodes:
+        lv = visit(name, [])
+        while len(stages) <= lv: stages.append([])
+        stages[lv].append(action)
+
+    return stages
+
+
+def batch_script(stages, sudo=False):
+    """Returns a tuple (script, stdin) running the actions in stages. A failed action
+    prints a line '#failed <n>', with n its index among all actions. With sudo, the script
+    authenticates with sudo once before running anything, so the concurrent actions never
+    race for a password prompt."""
+    keys = []
+    body = ['rc=0']
+
+    n = 0
+    for stage in stages:
+        cmds = []
+        for desc, cmd, key in stage:
+            if key != None:
+                cmds.append('key="$key%d"; %s' % (len(keys), cmd))
+                keys.append(key)
+            else:
+                cmds.append(cmd)
+
+        if len(cmds) == 1:
+            body.append('{ %s; } || { echo "#failed %d"; rc=1; }' % (cmds[0], n))
+
+        else:
+            # run the stage in background subshells, and collect their exit codes
+            for i, cmd in enumerate(cmds):
+                body.append('( %s ) & pid%d=$!' % (cmd, i))
+            for i in range(len(cmds)):
+                body.append('wait $pid%d || { echo "#failed %d"; rc=1; }' % (i, n + i))
+
+        n = n + len(cmds)
+        body.append('[ $rc = 0 ] || exit 1')
+
+    reads = ['IFS= read -r key%d || true' % i for i in range(len(keys))]
+    if sudo: reads.append('sudo true || { echo "Can\'t authenticate with sudo"; exit 1; }')
+    script = '\n'.join(reads + body) + '\n'
+
+    if len(keys) > 0: stdin = '\n'.join(keys) + '\n'
+    else:             stdin = None
+
+    return script, stdin
+
+
+def failed_actions(output):
+    """Returns the indices of the failed actions from the output of a batch script"""
+    return [int(m.group(1)) for m in re.finditer(r'^#failed (\d+)$', output or '', flags=re.MULTILINE)]
+
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -25,6 +25,7 @@ import shlex
 import signal
 import subprocess
 import socket
+import fnmatch
 
 if sys.version_info[0] < 3:
     def shquote(s):
@@ -105,17 +106,78 @@ class SSHConnection(object):
         return hosts
 
 
-    def resolve(self, hostname):
-        """Resolves a hostname into a tuple, (fqdn, ip). Parses .ssh/config to resolve
-        aliases."""
+    def config_files(self):
+        """Returns the ssh config files in use: the user and system ones, and whatever they
+        pull in through Include directives. Relative includes are taken from ~/.ssh for the
+        user config and from /etc/ssh for the system one."""
+        import glob
+
+        files = []
+        stack = [(os.path.expanduser('~/.ssh/config'), os.path.expanduser('~/.ssh')),
+                 ('/etc/ssh/ssh_config', '/etc/ssh')]
+        stack.reverse()
+
+        while len(stack) > 0:
+            path, base = stack.pop()
+            if path in files: continue
+            files.append(path)
+
+            try:
+                with open(path, 'r') as fd:
+                    raw = fd.read()
+            except (IOError, OSError):
+                continue
+
+            included = []
+            for m in re.finditer(r'^\s*Include\s+(.*)$', raw, flags=re.MULTILINE | re.IGNORECASE):
+                for pattern in shlex.split(m.group(1)):
+                    pattern = os.path.join(base, os.path.expanduser(pattern))
+                    included.extend([(p, base) for p in sorted(glob.glob(pattern))])
+
+            stack.extend(reversed(included))
+
+        return files
+
+
+    def ssh_config(self, hostname):
+        """Returns the ssh options for hostname as a dict with lowercase keys. Asks ssh
+        itself with 'ssh -G', so Include, Match and wildcard Host blocks are honored. Falls
+        back to parsing .ssh/config on openssh versions without -G."""
+        try:
+            proc = subprocess.Popen(['ssh', '-G', hostname],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            stdout, stderr = proc.communicate(timeout=10)
+            if proc.returncode == 0:
+                conf = {}
+                for line in stdout.decode().split('\n'):
+                    kv = line.strip().split(None, 1)
+                    if len(kv) == 2 and not kv[0] in conf: conf[kv[0]] = kv[1]
+                return conf
+
+        except OSError:
+            pass
 
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+        # ssh uses the first value it finds for each option
+        conf = {}
         hosts = self._parse_ssh_config(os.path.expanduser("~/.ssh/config"))
+        for pattern, dic in hosts.items():
+            if fnmatch.fnmatch(hostname, pattern):
+                for k, v in dic.items():
+                    if not k.lower() in conf: conf[k.lower()] = v
+        return conf
+
+
+    def resolve(self, hostname):
+        """Resolves a hostname into a tuple, (fqdn, ip). Uses the ssh configuration to
+        resolve aliases."""
 
-        if hostname in hosts:
-            dic = hosts[hostname]
-            if "HostName" in dic: hostname = dic['HostName']
+        conf = self.ssh_config(hostname)
+        hostname = conf.get('hostname', hostname).strip()
 
-        hostname = hostname.strip()
         if re.match("^(\d+.\d+.\d+.\d+)$", hostname):
             return (None, hostname)
 
@@ -128,6 +190,11 @@ class SSHConnection(object):
     def connect(self, hostname, user=None, keyfile=None, alt_hostname=None, timeout=30, args=[]):
         self.args = []
         if keyfile: self.args = self.args + ['-i', keyfile]
+
+        # replace hostname, but use the given alias if present in ~/.ssh/config. Kept in
+        # self.args, so later commands and checks go to the same machine as the master.
+        if alt_hostname:
+            self.args = self.args + ['-o', 'Hostname=%s' % alt_hostname]
         self.args = self.args + args
 
         if user: self.decorated_host = "%s@%s" % (user, hostname)
@@ -135,10 +202,6 @@ class SSHConnection(object):
 
         sshargs = ['-N']
 
-        # replace hostname, but use the given alias if present in ~/.ssh/config.
-        if alt_hostname:
-            sshargs = sshargs + ['-o', 'Hostname=%s' % alt_hostname]
-
         if self.socket:
             if os.path.exists(self.socket):
                 raise SSHConnectionError("Socket %s already exists" % self.socket)
@@ -149,13 +212,53 @@ class SSHConnection(object):
             self.master_proc = self._ssh(sshargs + [self.decorated_host],
                                          timeout=timeout, stdout=devnull, stderr=devnull)
 
-        sec = 0
-        while not self.alive() and sec <= timeout:
-            time.sleep(1)
-            sec = sec + 1
+        # the master process starts immediately, but it is only useful once authenticated.
+        # Without a control socket the only check is a handshake of its own, which waits
+        # for the host by itself. Run it once instead of polling.
+        deadline = time.time() + timeout
+        if not self.socket:
+            if self.check(timeout=timeout):
+                return
+
+            ret = self.master_proc.poll()
+            self.close()
+            if ret != None: raise SSHConnectionError("Can't connect: ssh exited with status %d" % ret)
+            else:           raise SSHConnectionError("Can't connect")
+
+        # asking the master through the socket is cheap. Poll fast at first, the master is
+        # usually up within a fraction of a second.
+        delay = 0.05
+        while True:
+            ret = self.master_proc.poll()
+            if ret != None:
+                self.master_proc = None
+                self.decorated_host = None
+                raise SSHConnectionError("Can't connect: ssh exited with status %d" % ret)
+
+            if self.check(timeout=max(1, int(deadline - time.time()))):
+                return
+
+            if time.time() >= deadline:
+                self.close()
+                raise SSHConnectionError("Can't connect: timeout")
+
+            time.sleep(delay)
+            delay = min(2 * delay, 1)
+
+
+    def check(self, timeout=30):
+        """Returns true if we can run commands on the host. Asks the master through the
+        control socket if there is one. Otherwise runs a trivial command, which costs a
+        full ssh handshake of its own next to the master's."""
+        if self.decorated_host == None:
+            return False
+
+        if self.socket: sshargs = ['-O', 'check', '-o', 'ControlPath=%s' % self.socket, self.decorated_host]
+        else:           sshargs = self.args + [self.decorated_host, 'true']
 
-        if sec >= timeout:
-            raise SSHConnectionError("Can't connect: timeout")
+        with open(os.devnull, 'r+') as devnull:
+            proc = self._ssh(sshargs, timeout=timeout, stdout=devnull, stderr=devnull, stdin=devnull)
+            return proc.wait() == 0
 
 
 
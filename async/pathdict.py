@@ -18,43 +18,57 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
+import sys
+import json
+import mmap
+import struct
+import fnmatch
 
 from collections import OrderedDict
 
 class PathDict(object):
     """A dictionary that maps paths to data objects. Every subpath inherits the data
-    object from its parent."""
+    object from its parent.
+
+    If index is true, also keeps a flat dict from paths to nodes, which makes exact lookups
+    of leaves O(1), at the cost of some memory.
+
+    Nodes are shared between copies and derived PathDicts. Every PathDict has an owner token
+    and only modifies in place the nodes carrying it. Other nodes are copied, along with the
+    path from the root, before being modified."""
 
     class _node(object):
-        def __init__(self, path, leaf=False, ignore=False, data=None):
+        __slots__ = ('path', 'sub', 'data', 'leaf', 'ignore', 'owner')
+
+        def __init__(self, path, leaf=False, ignore=False, data=None, owner=None):
             self.path = path
             self.sub = OrderedDict()
             self.data = data
             self.leaf = leaf      # If leaf is true, the node implicitly affects all its subdirectories
             self.ignore = ignore  # If ignore is true, ignore this and all subdirs.
-
-        def copy(self):
-            new = PathDict._node(path=self.path,
-                                 data=self.data,
-                                 leaf=self.leaf,
-                                 ignore=self.ignore)
-
-            for k, v in self.sub.items():
-                new.sub[k] = self.sub[k].copy()
+            self.owner = owner    # Token of the PathDict that may modify this node
 
         def __eq__(self, other):
-            if not self.path == other.path: return False
-            if not self.sub == other.sub: return False
-            if not self.leaf == other.leaf: return False
-            if not self.ignore == other.ignore: return False
-            if not self.data == other.data: return False
+            stack = [(self, other)]
+            while len(stack) > 0:
+                a, b = stack.pop()
+                if not a.path == b.path: return False
+                if not a.leaf == b.leaf: return False
+                if not a.ignore == b.ignore: return False
+                if not a.data == b.data: return False
+                if not list(a.sub.keys()) == list(b.sub.keys()): return False
+                stack.extend(zip(a.sub.values(), b.sub.values()))
             return True
 
 
 
-    def __init__(self, dic={}, ignore={}):
+    def __init__(self, dic={}, ignore={}, index=False):
         # root tree is a leaf that ignores everything.
-        self.tree = PathDict._node(path="", leaf=True, ignore=True)
+        self.owner = object()
+        self.tree = PathDict._node(path="", leaf=True, ignore=True, owner=self.owner)
+        self.index = {} if index else None
+        self.empty = False    # whether some key has an empty component, like 'a//b'
 
         # add data in dic
         if type(dic) == type([]):
@@ -74,59 +88,196 @@ class PathDict(object):
     # Internal primitives   #
     # --------------------- #
 
-    def _splitpath(self, p):
-        """splits the first directory in path"""
-        if p == None:     return None, None
+    def _leafparent(self, tree, leafparent, p):
+        """Returns the deepest node marked as leaf among p and its parents"""
+        # fast path for exact lookups of leaves
+        if self.index != None and tree is self.tree:
+            node = self.index.get(p, None)
+            if node is not None and node.leaf: return node
+
+        if tree.leaf: leafparent = tree
+        if p == None: return leafparent
+
+        for head in p.split('/'):
+            if not head: break
+
+            tree = tree.sub.get(head, None)
+            if tree is None: break
+            if tree.leaf: leafparent = tree
 
-        L = p.split('/', 1)
-        if len(L) > 1:    return L[0], L[1]
-        elif len(L) == 1: return L[0], None
-        else:             return None, None
+        return leafparent
 
 
     def _checkpath(self, tree, leafparent, p):
         """Checks whether the path p is a subdirectory of some path in the structure"""
-        head, tail = self._splitpath(p)
-        if tree.leaf: leafparent = tree
-
-        if head and head in tree.sub: return self._checkpath(tree.sub[head], leafparent, tail)
-        else:                         return not leafparent.ignore
+        return not self._leafparent(tree, leafparent, p).ignore
 
 
     def _getdata(self, tree, leafparent, p):
         """Returns the tree leaf associated to path p, or KeyError if not found"""
-        head, tail = self._splitpath(p)
-        if tree.leaf: leafparent = tree
-
-        if head and head in tree.sub: return self._getdata(tree.sub[head], leafparent, tail)
-        elif not leafparent.ignore:   return leafparent
-        else:                         raise KeyError("Path '%s' not found" % tree.path)
+        leafparent = self._leafparent(tree, leafparent, p)
+        if not leafparent.ignore: return leafparent
+        else:                     raise KeyError("Path '%s' not found" % p)
 
 
-    def _addleaf(self, tree, p, data, ignore):
-        """Adds a leaf to the tree"""
-        head, tail = self._splitpath(p)
+    def _writable(self, parent, head, node, indexed=False):
+        """Returns node if self owns it. Otherwise replaces it by a copy owned by self in
+        parent, which must be owned by self, or as the root if parent is None."""
+        if node.owner is self.owner: return node
 
-        if head == None:
-            tree.leaf = True
-            tree.data = data
-            tree.ignore = ignore
-
-        else:
-            if not head in tree.sub:
-                tree.sub[head] = PathDict._node(path=os.path.join(tree.path, head))
-
-            self._addleaf(tree.sub[head], tail, data, ignore=ignore)
+        new = PathDict._node(path=node.path, data=node.data, leaf=node.leaf,
+                             ignore=node.ignore, owner=self.owner)
+        new.sub = OrderedDict(node.sub)
 
+        if parent is None: self.tree = new
+        else:              parent.sub[head] = new
+        if indexed: self.index[new.path] = new
+        return new
 
-    def _leafgen(self, tree):
-        """Generator that runs over all leaves"""
-        for p, val in tree.sub.items():
-            if val.leaf:
-                yield (val.path, val)
 
-            for k, v in self._leafgen(val):
-                yield (k, v)
+    def _addleaf(self, tree, p, data, ignore):
+        """Adds a leaf to the tree"""
+        tree = self._writable(None, None, self.tree)
+        if p != None:
+            # paths with empty components are not indexed, as lookups stop on them.
+            indexed = self.index != None
+            for head in p.split('/'):
+                indexed = indexed and head != ''
+                if head == '': self.empty = True
+                node = tree.sub.get(head, None)
+                if node is None:
+                    # same as os.path.join, as head has no slashes
+                    head = sys.intern(head)
+                    if tree.path == '' or tree.path[-1] == '/': path = tree.path + head
+                    else:                                       path = tree.path + '/' + head
+
+                    node = PathDict._node(path=path, owner=self.owner)
+                    tree.sub[head] = node
+                    if indexed: self.index[node.path] = node
+
+                else:
+                    node = self._writable(tree, head, node, indexed)
+
+                tree = node
+
+        tree.leaf = True
+        tree.data = data
+        tree.ignore = ignore
+
+
+    def _leafgen(self, tree, reachable=False):
+        """Generator that runs over all leaves. If reachable is true, skips leaves below an
+        empty path component, which lookups never get to."""
+        stack = [iter(tree.sub.items())]
+        while len(stack) > 0:
+            for head, val in stack[-1]:
+                if reachable and head == '': continue
+                if val.leaf:
+                    yield (val.path, val)
+
+                stack.append(iter(val.sub.items()))
+                break
+
+            else:
+                stack.pop()
+
+
+    def _reindex(self, tree):
+        """Adds the nodes below tree to the flat index"""
+        stack = [tree]
+        while len(stack) > 0:
+            tree = stack.pop()
+            for head, node in tree.sub.items():
+                if head == '': continue
+                self.index[node.path] = node
+                stack.append(node)
+
+
+    def _mergeleaves(self, src, other, cond, invert=False):
+        """Walks the leaves of src in order and adds into self those for which cond(ignore,
+        contained) holds, where contained tells whether the leaf path is in other. Walks
+        the matching nodes of other and self along with src, so no lookups from the root
+        are needed. The added leaves are ignored if leaf.ignore != invert.
+
+        Subtrees of src that would be copied unchanged are shared instead.
+
+        Node paths of keys with empty components do not match their position in the tree,
+        and re-adding them moves the leaves around. When src has any, fall back to adding
+        its leaves one at a time, so the result is the same as that of plain insertions."""
+        if src.empty:
+            for p, val in src._leafgen(src.tree):
+                contained = other._checkpath(other.tree, other.tree, val.path)
+                if cond(val.ignore, contained):
+                    self._addleaf(self.tree, val.path, val.data, ignore=val.ignore != invert)
+            return
+
+        def materialize(stack):
+            """creates the missing nodes in self along the stack"""
+            i = len(stack) - 1
+            while stack[i][4] is None: i = i - 1
+            for j in range(i + 1, len(stack)):
+                parent, head = stack[j-1][4], stack[j][1]
+                node = parent.sub.get(head, None)
+                if node is None:
+                    if parent.path == '' or parent.path[-1] == '/': path = parent.path + head
+                    else:                                           path = parent.path + '/' + head
+
+                    node = PathDict._node(path=path, owner=self.owner)
+                    parent.sub[head] = node
+                    if self.index != None: self.index[path] = node
+
+                else:
+                    node = self._writable(parent, head, node, self.index != None)
+
+                stack[j][4] = node
+
+        # each level holds the iterator over the children of a src node, its key, the
+        # matching node in other, the deepest leaf of other above it, and the matching node
+        # in self, created on demand.
+        root = [iter(src.tree.sub.items()), None, other.tree, other.tree,
+                self._writable(None, None, self.tree)]
+        stack = [root]
+        shared = False
+        while len(stack) > 0:
+            it, _, onode, oleaf, _ = stack[-1]
+            for head, val in it:
+                break
+            else:
+                stack.pop()
+                continue
+
+            if onode is not None:
+                onode = onode.sub.get(head, None)
+                if onode is not None and onode.leaf: oleaf = onode
+
+            # other has nothing below, so every leaf in the subtree gets the same
+            # treatment. if all of them are kept as they are, share the subtree.
+            if onode is None and not invert:
+                contained = not oleaf.ignore
+                if cond(True, contained) and cond(False, contained):
+                    materialize(stack)
+                    parent = stack[-1][4]
+                    if parent.sub.get(head, None) is None:
+                        parent.sub[head] = val
+                        if self.index != None:
+                            self.index[val.path] = val
+                            self._reindex(val)
+                        shared = True
+                        continue
+
+            stack.append([iter(val.sub.items()), head, onode, oleaf, None])
+            if not val.leaf: continue
+
+            if not cond(val.ignore, not oleaf.ignore): continue
+
+            materialize(stack)
+            node = stack[-1][4]
+            node.leaf = True
+            node.data = val.data
+            node.ignore = val.ignore != invert
+
+        # src must not modify the shared nodes in place from now on
+        if shared: src.owner = object()
 
 
 
@@ -134,9 +285,14 @@ class PathDict(object):
     # Interface             #
     # --------------------- #
 
-    def copy(self, dic):
-        new = PathDict()
-        new.tree = self.tree.copy()
+    def copy(self):
+        """Returns a copy of the PathDict in constant time. Both share the tree, and neither
+        owns it any more, so nodes get copied as they are modified."""
+        new = PathDict(index=self.index != None)
+        new.tree = self.tree
+        new.empty = self.empty
+        if self.index != None: new.index = dict(self.index)
+        self.owner = object()
         return new
 
 
@@ -145,10 +301,8 @@ class PathDict(object):
 
         """
 
-        new = PathDict()
-
-        for p, val in self._leafgen(self.tree):
-            new._addleaf(new.tree, val.path, val.data, ignore=not val.ignore)
+        new = PathDict(index=self.index != None)
+        new._mergeleaves(self, self, lambda ig, c: True, invert=True)
         return new
 
 
@@ -158,16 +312,9 @@ class PathDict(object):
 
         """
 
-        new = PathDict()
-
-        for p, val in dic._leafgen(dic.tree):
-            if val.ignore or p in self:
-                new._addleaf(new.tree, val.path, val.data, ignore=val.ignore)
-
-        for p, val in self._leafgen(self.tree):
-            if val.ignore or p in dic:
-                new._addleaf(new.tree, val.path, val.data, ignore=val.ignore)
-
+        new = PathDict(index=self.index != None)
+        new._mergeleaves(dic, self, lambda ig, c: ig or c)
+        new._mergeleaves(self, dic, lambda ig, c: ig or c)
         return new
 
 
@@ -177,16 +324,9 @@ class PathDict(object):
 
         """
 
-        new = PathDict()
-
-        for p, val in dic._leafgen(dic.tree):
-            if not val.ignore or not p in self:
-                new._addleaf(new.tree, val.path, val.data, ignore=val.ignore)
-
-        for p, val in self._leafgen(self.tree):
-            if not val.ignore or not p in dic:
-                new._addleaf(new.tree, val.path, val.data, ignore=val.ignore)
-
+        new = PathDict(index=self.index != None)
+        new._mergeleaves(dic, self, lambda ig, c: not ig or not c)
+        new._mergeleaves(self, dic, lambda ig, c: not ig or not c)
         return new
 
 
@@ -196,17 +336,19 @@ class PathDict(object):
 
         """
 
-        new = PathDict()
-
-        for p, val in dic._leafgen(dic.tree):
-            if not val.ignore or p in dic:
-                new._addleaf(new.tree, val.path, val.data, ignore=not val.ignore)
+        new = PathDict(index=self.index != None)
+        new._mergeleaves(dic, dic, lambda ig, c: not ig or c, invert=True)
+        new._mergeleaves(self, dic, lambda ig, c: ig or not c)
+        return new
 
-        for p, val in self._leafgen(self.tree):
-            if val.ignore or not p in dic:
-                new._addleaf(new.tree, val.path, val.data, ignore=val.ignore)
 
-        return new
+    def _assign(self, new):
+        """Takes over the tree of new"""
+        self.tree = new.tree
+        self.index = new.index
+        self.empty = new.empty
+        self.owner = new.owner
+        return self
 
 
     def get(self, key, default=None):
@@ -220,14 +362,36 @@ class PathDict(object):
         self._addleaf(self.tree, key, None, ignore=True)
 
 
+    def compile(self, globs=False):
+        """Returns a PathMatcher for the current contents of the PathDict"""
+        return PathMatcher(self, globs=globs)
+
+
+    def dump(self, path, encode=json.dumps):
+        """Writes a binary snapshot of the PathDict into path, which MappedPathDict can load
+        lazily. encode turns data objects into strings."""
+        write_snapshot(self, path, encode)
+
+
+    @staticmethod
+    def load(path, decode=json.loads):
+        """Maps a snapshot written by dump. Returns a read only MappedPathDict."""
+        return MappedPathDict(path, decode=decode)
+
+
     def data(self, keys=None, ignore=[]):
         """Extract an OrderedDict, from the PathDict. If keys is provided, Use those keys for the
            OrderedDict, in that same order. Do not complain on KeyError, just put None as
-           data.
+           data. ignore is a list of paths or a PathMatcher.
 
         """
         if keys == None: keys = list(self.keys())
-        ig = PathDict(dic={p: p for p in ignore})
+
+        # compiling only pays off for many lookups. a few dirs against a few ignores are
+        # cheaper on the plain trie, and no ignores need no lookups at all.
+        if isinstance(ignore, PathMatcher): ig = ignore
+        elif len(ignore) > 0:               ig = PathDict(dic={p: p for p in ignore})
+        else:                               ig = ()
 
         dic = OrderedDict()
         for k in keys:
@@ -279,6 +443,15 @@ class PathDict(object):
     def __sub__(self, dic):
         return self.subtract(dic)
 
+    def __iand__(self, dic):
+        return self._assign(self.intersection(dic))
+
+    def __ior__(self, dic):
+        return self._assign(self.union(dic))
+
+    def __isub__(self, dic):
+        return self._assign(self.subtract(dic))
+
     def __contains__(self, key):
         return self._checkpath(self.tree, self.tree, key)
 
@@ -300,3 +473,371 @@ class PathDict(object):
 
     def __repr__(self):
         return str(self)
+
+
+
+def _glob_component(comp):
+    """Translates a path component with shell wildcards into a regex. Wildcards never
+    match a slash."""
+    res = []
+    i, n = 0, len(comp)
+    while i < n:
+        c = comp[i]
+        i = i + 1
+
+        if c == '*':   res.append('[^/]*')
+        elif c == '?': res.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and comp[j] == '!': j = j + 1
+            if j < n and comp[j] == ']': j = j + 1
+            j = comp.find(']', j)
+
+            if j < 0:
+                res.append('\\[')
+            else:
+                stuff = comp[i:j].replace('\\', '\\\\')
+                if stuff[0] == '!':   stuff = '^/' + stuff[1:]
+                elif stuff[0] == '^': stuff = '\\' + stuff
+                res.append('[%s]' % stuff)
+                i = j + 1
+
+        else:
+            res.append(re.escape(c))
+
+    return ''.join(res)
+
+
+
+class PathMatcher(object):
+    """Compiled form of a PathDict, to classify large numbers of paths. A path gets the data
+    of the deepest leaf among itself and its parents, as in PathDict. If globs is true,
+    path components in the PathDict may contain shell wildcards *, ? and [...], which match
+    within a single component. The matcher does not see later changes to the PathDict."""
+
+    GLOB_CHARS = re.compile('[*?[]')
+
+    def __init__(self, pathdict, globs=False):
+        self.globs = globs
+        self.leaves = []         # (path, ignore, data) in PathDict order
+        self.nodes = {}          # path -> (ignore, data, depth) of the deepest leaf among path
+                                 # and its parents, for every node without wildcards
+        self.patterns = []       # (depth, regex, [(ignore, data)]) for leaves with wildcards
+
+        globbed = OrderedDict()
+        stack = [(iter(pathdict.tree.sub.items()), (True, None, 0), True)]
+        while len(stack) > 0:
+            it, inherited, clean = stack[-1]
+            for head, val in it:
+                break
+            else:
+                stack.pop()
+                continue
+
+            p = val.path
+            if val.leaf:
+                self.leaves.append((p, val.ignore, val.data))
+
+            # lookups stop on empty components, but their leaves still make patterns
+            if not clean or head == '':
+                stack.append((iter(val.sub.items()), inherited, False))
+                continue
+
+            if globs and self.GLOB_CHARS.search(p):
+                if val.leaf:
+                    depth = p.count('/') + 1
+                    globbed.setdefault(depth, []).append((p, (val.ignore, val.data)))
+
+            else:
+                if val.leaf: inherited = (val.ignore, val.data, p.count('/') + 1)
+                self.nodes[p] = inherited
+
+            stack.append((iter(val.sub.items()), inherited, True))
+
+        # a single regex per depth, deepest first. the matching alternative tells the leaf.
+        for depth in sorted(globbed.keys(), reverse=True):
+            alts = ['(?P<g%d>%s)' % (i, '/'.join([_glob_component(c) for c in p.split('/')]))
+                    for i, (p, leaf) in enumerate(globbed[depth])]
+            regex = re.compile('(?:%s)(?:/|$)' % '|'.join(alts))
+            self.patterns.append((depth, regex, [leaf for p, leaf in globbed[depth]]))
+
+
+    def _lookup(self, p):
+        """Returns the tuple (ignore, data) of the deepest leaf among p and its parents"""
+        nodes = self.nodes
+        found = (True, None, 0)
+
+        # walk down p and its parents while they are nodes
+        i = p.find('/')
+        while True:
+            if i < 0: q = p
+            else:     q = p[:i]
+
+            val = nodes.get(q, None)
+            if val == None: break
+
+            found = val
+            if i < 0: break
+            i = p.find('/', i + 1)
+
+        # wildcards only win if they match deeper than the leaf in found
+        for d, regex, leaves in self.patterns:
+            if d <= found[2]: break
+            m = regex.match(p)
+            if m: return leaves[int(m.lastgroup[1:])]
+
+        return found[0:2]
+
+
+    def _match_component(self, pattern, name):
+        if self.globs: return fnmatch.fnmatchcase(name, pattern)
+        else:          return pattern == name
+
+
+    def get(self, key, default=None):
+        ignore, data = self._lookup(key)
+        if ignore: return default
+        else:      return data
+
+
+    def filter(self, paths):
+        """Generator producing the paths that are in the matcher"""
+        lookup = self._lookup
+        for p in paths:
+            if not lookup(p)[0]:
+                yield p
+
+
+    def rsync_excludes(self, root=''):
+        """Generator producing rsync exclude patterns for the paths in the matcher that lie
+        under root, anchored at root. Ignored paths below them can't be expressed as
+        excludes and are left out."""
+        rcomps = root.split('/') if root else []
+        for p, ignore, data in self.leaves:
+            if ignore: continue
+
+            comps = p.split('/')
+            if len(comps) <= len(rcomps): continue
+            if all([self._match_component(c, r) for c, r in zip(comps, rcomps)]):
+                yield '/' + '/'.join(comps[len(rcomps):])
+
+
+    def unison_ignores(self):
+        """Generator producing unison ignore patterns for the paths in the matcher"""
+        for p, ignore, data in self.leaves:
+            if not ignore:
+                yield 'Path %s' % p
+
+
+    def __contains__(self, key):
+        return not self._lookup(key)[0]
+
+
+
+# Binary snapshots
+# ----------------
+#
+# A header, followed by an array of nodes in breadth first order, so the children of a node
+# are contiguous, an array with the children of every node sorted by name, and a table of
+# utf-8 strings. Nodes refer to their name and data by offset and length into the string
+# table, and to their children by the index of the first one and their count.
+
+SNAPSHOT_MAGIC   = b'APD1'
+SNAPSHOT_HEADER  = struct.Struct('<4sIIII')    # magic, nodes, nodes off, order off, strings off
+SNAPSHOT_NODE    = struct.Struct('<IIIIIIB')   # name off, name len, data off, data len,
+                                               # first child, children, flags
+SNAPSHOT_INDEX   = struct.Struct('<I')
+
+SNAPSHOT_LEAF    = 1
+SNAPSHOT_IGNORE  = 2
+
+
+def write_snapshot(pathdict, path, encode=json.dumps):
+    """Writes a binary snapshot of pathdict into path. The file is replaced atomically, so
+    readers holding the old one mapped are not disturbed."""
+    strings = bytearray()
+    offsets = {}
+
+    def string(st):
+        b = st.encode('utf-8')
+        if not b in offsets:
+            offsets[b] = len(strings)
+            strings.extend(b)
+        return offsets[b], len(b)
+
+    # number nodes in breadth first order
+    queue = [('', pathdict.tree)]
+    nodes = []
+    order = []
+    i = 0
+    while i < len(queue):
+        name, node = queue[i]
+        first = len(queue)
+        queue.extend(node.sub.items())
+
+        flags = (SNAPSHOT_LEAF if node.leaf else 0) | (SNAPSHOT_IGNORE if node.ignore else 0)
+        name_off, name_len = string(name)
+        if node.leaf: data_off, data_len = string(encode(node.data))
+        else:         data_off, data_len = 0, 0
+
+        nodes.append((name_off, name_len, data_off, data_len, first, len(node.sub), flags))
+        keys = [k.encode('utf-8') for k in node.sub.keys()]
+        order.extend([first + k for k in sorted(range(len(keys)), key=lambda k: keys[k])])
+        i = i + 1
+
+    nodes_off = SNAPSHOT_HEADER.size
+    order_off = nodes_off + len(nodes) * SNAPSHOT_NODE.size
+    strings_off = order_off + len(order) * SNAPSHOT_INDEX.size
+
+    tmp = '%s.%d' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as fd:
+            fd.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(nodes), nodes_off, order_off, strings_off))
+            for n in nodes: fd.write(SNAPSHOT_NODE.pack(*n))
+            for k in order: fd.write(SNAPSHOT_INDEX.pack(k))
+            fd.write(strings)
+        os.replace(tmp, path)
+
+    except:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+
+
+class MappedPathDict(object):
+    """Read only PathDict backed by a memory mapped snapshot, as written by PathDict.dump.
+    Nothing is read until needed, so loading takes constant time. Lookups binary search
+    the children of each node along the path. decode turns the stored strings back into
+    data objects."""
+
+    def __init__(self, path, decode=json.loads):
+        self.decode = decode
+        with open(path, 'rb') as fd:
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.numnodes, self.nodes_off, self.order_off, self.strings_off = \
+            SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+
+        if magic != SNAPSHOT_MAGIC:
+            self.mm.close()
+            raise ValueError("%s is not a PathDict snapshot" % path)
+
+
+    def _node(self, i):
+        return SNAPSHOT_NODE.unpack_from(self.mm, self.nodes_off + i * SNAPSHOT_NODE.size)
+
+
+    def _string(self, off, length):
+        start = self.strings_off + off
+        return self.mm[start:start+length]
+
+
+    def _child(self, node, name):
+        """Returns the index of the child of node with the given name, or None"""
+        first, num = node[4], node[5]
+        lo, hi = first, first + num
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = SNAPSHOT_INDEX.unpack_from(self.mm, self.order_off + (mid - 1) * SNAPSHOT_INDEX.size)[0]
+            child = self._node(k)
+            cname = self._string(child[0], child[1])
+            if cname < name:   lo = mid + 1
+            elif cname > name: hi = mid
+            else:              return k
+        return None
+
+
+    def _leafparent(self, p):
+        """Returns the deepest node marked as leaf among p and its parents"""
+        node = self._node(0)
+        leafparent = node
+
+        for head in p.split('/'):
+            if not head: break
+
+            i = self._child(node, head.encode('utf-8'))
+            if i == None: break
+
+            node = self._node(i)
+            if node[6] & SNAPSHOT_LEAF: leafparent = node
+
+        return leafparent
+
+
+    def _leafgen(self):
+        """Generator that runs over all leaves, in the order of the original PathDict"""
+        stack = [('', 0)]
+        while len(stack) > 0:
+            path, i = stack.pop()
+            node = self._node(i)
+            if i > 0 and node[6] & SNAPSHOT_LEAF:
+                yield path, node
+
+            children = []
+            for k in range(node[4], node[4] + node[5]):
+                name = self._string(*self._node(k)[0:2]).decode('utf-8')
+                children.append((os.path.join(path, name), k))
+            stack.extend(reversed(children))
+
+
+    def close(self):
+        self.mm.close()
+
+
+    def to_pathdict(self):
+        """Materializes the whole snapshot into a PathDict"""
+        new = PathDict()
+        stack = [(new.tree, 0)]
+        while len(stack) > 0:
+            tree, i = stack.pop()
+            node = self._node(i)
+            tree.leaf = bool(node[6] & SNAPSHOT_LEAF)
+            tree.ignore = bool(node[6] & SNAPSHOT_IGNORE)
+            if tree.leaf: tree.data = self.decode(self._string(node[2], node[3]).decode('utf-8'))
+
+            for k in range(node[4], node[4] + node[5]):
+                name = sys.intern(self._string(*self._node(k)[0:2]).decode('utf-8'))
+                if name == '': new.empty = True
+                tree.sub[name] = PathDict._node(path=os.path.join(tree.path, name), owner=new.owner)
+                stack.append((tree.sub[name], k))
+
+        return new
+
+
+    def get(self, key, default=None):
+        node = self._leafparent(key)
+        if node[6] & SNAPSHOT_IGNORE: return default
+        else:                         return self.decode(self._string(node[2], node[3]).decode('utf-8'))
+
+
+    def ignored_items(self):
+        """Generator producing a list of ignored paths"""
+        for p, node in self._leafgen():
+            if node[6] & SNAPSHOT_IGNORE:
+                yield (p, self.decode(self._string(node[2], node[3]).decode('utf-8')))
+
+    def items(self):
+        """Generator producing a list of tuples of key, value pairs
+           for the nodes marked as leaf"""
+        for p, node in self._leafgen():
+            if not node[6] & SNAPSHOT_IGNORE:
+                yield (p, self.decode(self._string(node[2], node[3]).decode('utf-8')))
+
+    def keys(self):
+        """Generator producing a list of keys for the nodes marked as leaf"""
+        for p, node in self._leafgen():
+            if not node[6] & SNAPSHOT_IGNORE:
+                yield p
+
+    def values(self):
+        """Generator producing a list of values for the nodes marked as leaf"""
+        for k, d in self.items():
+            yield d
+
+    def __contains__(self, key):
+        return not self._leafparent(key)[6] & SNAPSHOT_IGNORE
+
+    def __getitem__(self, key):
+        node = self._leafparent(key)
+        if node[6] & SNAPSHOT_IGNORE: raise KeyError("Path '%s' not found" % key)
+        return self.decode(self._string(node[2], node[3]).decode('utf-8'))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# async - A tool to manage and sync different machines
+# Copyright 2012,2013 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from datetime import datetime
+
+from async.utils import load_cache, save_cache
+
+import async.archui as ui
+
+
+class StatusCache(object):
+    """On-disk cache of the directory statuses of a host. An entry is valid while it is
+    younger than the ttl and the directory status key did not change."""
+
+    def __init__(self, host, ttl, refresh=False):
+        self.host = host
+        self.ttl = ttl
+        self.refresh = refresh
+        self.name = 'status-%s.json' % host.name
+        self.entries = load_cache(self.name, {})
+
+
+    def _encode(self, status):
+        dic = {}
+        for k, v in status.items():
+            if isinstance(v, datetime): dic[k] = {'datetime': v.isoformat()}
+            else:                       dic[k] = v
+        return dic
+
+
+    def _decode(self, dic):
+        import dateutil.parser
+
+        status = {}
+        for k, v in dic.items():
+            if isinstance(v, dict) and 'datetime' in v: status[k] = dateutil.parser.parse(v['datetime'])
+            else:                                       status[k] = v
+        return status
+
+
+    def get(self, d, key, slow=False):
+        """Returns the cached status of directory d, or None if there is no valid one. A
+        fast status can't stand in for a slow one."""
+        if self.refresh or key == None:
+            return None
+
+        entry = self.entries.get(d.name, None)
+        if entry == None:                             return None
+        if time.time() - entry['time'] > self.ttl:    return None
+        if entry['key'] != key:                       return None
+        if slow and not entry['slow']:                return None
+
+        ui.print_debug("using cached status for %s on %s" % (d.name, self.host.name))
+        return self._decode(entry['status'])
+
+
+    def put(self, d, key, slow, status):
+        if key == None: return
+        self.entries[d.name] = {'time': time.time(),
+                                'key': key,
+                                'slow': slow,
+                                'status': self._encode(status)}
+
+
+    def save(self):
+        save_cache(self.name, self.entries)
+
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
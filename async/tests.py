@@ -17,10 +17,34 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
 import unittest
 
 from async.pathdict import PathDict
+import async.waiter as waiter
+import async.mounts as mounts
+import async.dirindex as dirindex
+from async.cmd import StreamWriter
+import async.cmd as cmd
+import async.archui as ui
+import async.hosts.ec2fake as ec2fake
+from async.hosts import Ec2Host
+from async.config import AsyncConfig, load_config
+from async.hosts import DirectoryHost, SshHost, HostError
+from async.hosts.base import BaseHost
+from async.directories.rsync import RsyncDir
+from async.directories.unison import UnisonDir
+from async.directories.git import GitDir
+from async.statuscache import StatusCache
+from async.fastcopy import sync_tree
+from async.utils import load_cache, save_cache
+from async.openssh import SSHConnection
 from collections import OrderedDict
 
 class PathDictTests(unittest.TestCase):
@@ -33,6 +57,9 @@ class PathDictTests(unittest.TestCase):
         self.assertEqual(list(self.A.items()), [('a', 1), ('a/c',3), ('b', 2), ('b/d/g',5)])
         self.assertEqual(list(self.A.ignored_items()), [('b/d', 4)])
         self.assertEqual(self.A.data(keys=['b', 'a/c']), OrderedDict([('b', 2), ('a/c', 3)]))
+        self.assertEqual(self.A.data(keys=['b', 'a/c'], ignore=['a']), OrderedDict([('b', 2)]))
+        M = PathDict(dic={'b': 'b'}).compile()
+        self.assertEqual(self.A.data(keys=['b', 'a/c'], ignore=M), OrderedDict([('a/c', 3)]))
 
     def test_membership(self):
         self.assertEqual(self.A.get('a'), 1)
@@ -51,6 +78,845 @@ class PathDictTests(unittest.TestCase):
         Ic = self.A & self.B
         self.assertEqual(Ic, Ir)
 
+    def test_subtraction(self):
+        Sc = self.A - self.B
+        self.assertEqual(list(Sc.items()), [('b', 2), ('b/d/g', 5)])
+        self.assertEqual(list(Sc.ignored_items()), [('a', 10), ('b/d', 4), ('b/d/e', 20)])
+
+    def test_inplace(self):
+        for op, iop in [('__and__', '__iand__'), ('__or__', '__ior__'), ('__sub__', '__isub__')]:
+            C = self.A.copy()
+            D = getattr(C, iop)(self.B)
+            self.assertIs(D, C)
+            self.assertEqual(C, getattr(self.A, op)(self.B))
+
+    def test_matcher(self):
+        M = self.A.compile()
+        for p in ['a', 'a/f', 'a/c', 'b/d', 'b/d/g', 'b/d/g/h', 'x', '']:
+            self.assertEqual(M.get(p), self.A.get(p))
+            self.assertEqual(p in M, p in self.A)
+
+        self.assertEqual(list(M.filter(['a/x', 'b/d/x', 'b/x'])), ['a/x', 'b/x'])
+        self.assertEqual(list(M.rsync_excludes('b')), ['/d/g'])
+
+    def test_matcher_globs(self):
+        G = PathDict(dic=[('a', 1), ('*/c', 2), ('a/[!x]/d', 3)], ignore=[('a/c/z*', 4)])
+        M = G.compile(globs=True)
+        self.assertEqual(M.get('a/q'), 1)
+        self.assertEqual(M.get('q/c/f'), 2)
+        self.assertEqual(M.get('a/c/zz'), None)
+        self.assertEqual(M.get('a/y/d'), 3)
+        self.assertEqual(M.get('a/x/d'), 1)
+        self.assertEqual(M.get('q'), None)
+        self.assertEqual(list(M.rsync_excludes('a')), ['/[!x]/d', '/c'])
+        self.assertEqual(list(M.unison_ignores()), ['Path a', 'Path a/[!x]/d', 'Path */c'])
+
+    def test_matcher_empty_components(self):
+        ignore = ['docs/tmp/', 'docs/cache', 'other', 'docs/a//b']
+        M = PathDict(dic={p: p for p in ignore}).compile(globs=True)
+        self.assertEqual(sorted(M.rsync_excludes('docs')), ['/a/b', '/cache', '/tmp/'])
+        self.assertEqual(sorted(M.unison_ignores()),
+                         ['Path docs/a/b', 'Path docs/cache', 'Path docs/tmp/', 'Path other'])
+        self.assertTrue('docs/cache/x' in M)
+        self.assertFalse('docs/tmp' in M)
+
+    def test_snapshot(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.A.dump(path)
+            M = PathDict.load(path)
+            for p in ['a', 'a/f', 'a/c', 'b/d', 'b/d/g', 'b/d/g/h', 'x', '']:
+                self.assertEqual(M.get(p), self.A.get(p))
+                self.assertEqual(p in M, p in self.A)
+
+            self.assertEqual(list(M.items()), list(self.A.items()))
+            self.assertEqual(list(M.ignored_items()), list(self.A.ignored_items()))
+            self.assertEqual(M.to_pathdict(), self.A)
+            M.close()
+
+        finally:
+            os.remove(path)
+
+    def test_copy(self):
+        C = self.A.copy()
+        self.assertEqual(C, self.A)
+        C['b/d/h'] = 6
+        self.assertEqual(C.get('b/d/h'), 6)
+        self.assertEqual(self.A.get('b/d/h'), None)
+
+        # only the modified path gets copied
+        self.assertIs(C.tree.sub['a'], self.A.tree.sub['a'])
+        self.assertIsNot(C.tree.sub['b'], self.A.tree.sub['b'])
+
+        self.A['a/c'] = 7
+        self.assertEqual(C.get('a/c'), 3)
+
+    def test_sharing(self):
+        U = self.A | PathDict(dic=[('x', 1)])
+        self.assertIs(U.tree.sub['a'], self.A.tree.sub['a'])
+
+        U['a/c'] = 8
+        self.assertEqual(self.A.get('a/c'), 3)
+        self.assertEqual(U.get('a/c'), 8)
+
+    def test_index(self):
+        A = PathDict(dic=[('a', 1), ('b', 2), ('a/c',3), ('b/d/g',5)], ignore=[('b/d', 4)], index=True)
+        self.assertEqual(A, self.A)
+        for p in ['a', 'a/f', 'a/c', 'b/d', 'b/d/g', 'b/d/g/h', 'x', '']:
+            self.assertEqual(A.get(p), self.A.get(p))
+            self.assertEqual(p in A, p in self.A)
+
+        A['b/d/g'] = 7
+        self.assertEqual(A['b/d/g'], 7)
+        self.assertEqual(A.copy()['b/d/g'], 7)
+
+    def test_deep_paths(self):
+        path = '/'.join(['x'] * 5000)
+        A = PathDict(dic=[(path, 1)])
+        self.assertEqual(A.get(path + '/y'), 1)
+        self.assertEqual(list(A.keys()), [path])
+        self.assertEqual(A.copy(), A)
+
+    def test_empty_components(self):
+        # same results as inserting the leaves one at a time
+        A = PathDict(dic=[('c/b/a', 7), ('a/', 4), ('//b/', 3), ('c/a', 2)], ignore=[('c//c', 5)])
+        B = PathDict(dic=[('b//b', 1), ('c', 6), ('c//', 9)])
+
+        U = A | B
+        self.assertEqual(list(U.items()), [('b/b', 1), ('b/', 3), ('c', 6), ('c/', 9),
+                                           ('c/b/a', 7), ('c/a', 2), ('a/', 4)])
+        self.assertEqual(list(U.ignored_items()), [])
+
+        I = A & B
+        self.assertEqual(list(I.items()), [('c/b/a', 7), ('c/a', 2)])
+        self.assertEqual(list(I.ignored_items()), [('c/c', 5)])
+
+        S = B - A
+        self.assertEqual(list(S.items()), [('c', 6), ('c/', 9), ('b/b', 1)])
+        self.assertEqual(list(S.ignored_items()), [('c/b/a', 7), ('c/a', 2), ('a/', 4), ('b/', 3)])
+
+
+class NativeCopyTests(unittest.TestCase):
+
+    def test_native_copy_ok(self):
+        rd = RsyncDir.__new__(RsyncDir)
+        rd.native_copy = True
+        host = DirectoryHost.__new__(DirectoryHost)
+
+        self.assertTrue(rd._native_copy_ok(host, host, ['-av', '--delete']))
+        self.assertTrue(rd._native_copy_ok(host, host, ['-rlptgoD']))
+        self.assertTrue(rd._native_copy_ok(host, host, ['--recursive', '--links', '-ptgoD']))
+        self.assertFalse(rd._native_copy_ok(host, host, []))
+        self.assertFalse(rd._native_copy_ok(host, host, ['-r']))
+        self.assertFalse(rd._native_copy_ok(host, host, ['-a', '--inplace']))
+
+    def test_unison_force_up(self):
+        class Opts(object):
+            ignore = []
+            auto = slow = batch = False
+            force = 'up'
+
+        tmp = tempfile.mkdtemp()
+        unison = cmd.unison
+        try:
+            hosts = []
+            for name in ['src', 'tgt']:
+                conf = dict([(k, v[0]) for k, v in AsyncConfig.FIELDS['host'].items()])
+                conf.update({'name': name, 'path': os.path.join(tmp, name), 'dirs': {}})
+                os.makedirs(os.path.join(tmp, name, 'docs'))
+                hosts.append(DirectoryHost(conf))
+
+            conf = dict([(k, v[0]) for k, v in AsyncConfig.FIELDS['directory'].items()])
+            conf.update({'name': 'docs', 'path': 'docs', 'conf_path': tmp,
+                         'unison_profile': 'default', 'unison_args': ['-times']})
+            ud = UnisonDir(conf)
+
+            with open(os.path.join(tmp, 'src', 'docs', 'f'), 'w') as fd: fd.write('data')
+            with open(os.path.join(tmp, 'tgt', 'docs', 'old'), 'w') as fd: fd.write('old')
+
+            calls = []
+            cmd.unison = lambda args, silent=False: calls.append(args)
+            ud.sync(hosts[0], hosts[1], silent=True, opts=Opts())
+            self.assertEqual(calls, [])
+            self.assertEqual(os.listdir(os.path.join(tmp, 'tgt', 'docs')), ['f'])
+
+            # options only unison knows about need the real thing
+            ud.unison_args = ['-perms', '0']
+            ud.sync(hosts[0], hosts[1], silent=True, opts=Opts())
+            self.assertEqual(len(calls), 1)
+
+        finally:
+            cmd.unison = unison
+            shutil.rmtree(tmp)
+
+    def test_type_change(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp, 'src')
+            tgt = os.path.join(tmp, 'tgt')
+            os.makedirs(os.path.join(tgt, 'x', 'y'))
+            for p in ['x/y/f', 'x/g', 'old']:
+                with open(os.path.join(tgt, p), 'w') as fd: fd.write(p)
+            os.makedirs(src)
+            with open(os.path.join(src, 'x'), 'w') as fd: fd.write('now a file')
+
+            stats = sync_tree(src, tgt, delete=True)
+            self.assertEqual(stats['deleted'], 2)
+            self.assertEqual(stats['files'], 1)
+            self.assertEqual(sorted(os.listdir(tgt)), ['x'])
+            with open(os.path.join(tgt, 'x')) as fd: self.assertEqual(fd.read(), 'now a file')
+
+        finally:
+            shutil.rmtree(tmp)
+
+
+class DirectoryHostTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmp, 'cache')
+
+        conf = dict([(k, v[0]) for k, v in AsyncConfig.FIELDS['host'].items()])
+        conf.update({'name': 'test', 'path': os.path.join(self.tmp, 'host'), 'dirs': {}})
+        os.makedirs(conf['path'])
+        self.host = DirectoryHost(conf)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def test_fs_ops(self):
+        host = self.host
+        base = host.path
+
+        host.mkdir('d', 0o750)
+        host.write_file('d/f', 'data')
+        host.symlink('d', 'l')
+        host.symlink('f', 'l', force=True)
+        host.chmod('d/f', 0o600)
+        self.assertEqual(host.read_file('d/f'), 'data')
+        self.assertEqual(host.read_file('d/missing'), None)
+        self.assertEqual(os.readlink(os.path.join(base, 'l')), 'f')
+
+        # same answers as the shell versions
+        for p in ['d', 'd/f', 'l', 'missing', 'missing/x']:
+            path = os.path.join(base, p)
+            self.assertEqual(host.path_exists(path), BaseHost.path_exists(host, path))
+            self.assertEqual(host.path_is_directory(path), BaseHost.path_is_directory(host, path))
+            self.assertEqual(host.path_is_symlink(path), BaseHost.path_is_symlink(host, path))
+            self.assertEqual(host.path_stat(p), BaseHost.path_stat(host, p))
+
+        self.assertEqual(host.path_stat('d/f')['perms'], '600')
+        self.assertEqual(host.path_stat('d')['perms'], '750')
+        self.assertEqual(host.realpath(os.path.join(base, 'd', '..', 'd')),
+                         os.path.join(os.path.realpath(base), 'd'))
+        self.assertEqual(host.realpath(os.path.join(base, 'missing', 'x')), None)
+        self.assertRaises(HostError, host.mkdir, 'd', 0o750)
+
+    def git(self, path, *args):
+        subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@test'] + list(args),
+                              cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def git_repo(self, name, files):
+        path = os.path.join(self.host.path, name)
+        os.makedirs(path)
+        for p in files:
+            with open(os.path.join(path, p), 'w') as fd: fd.write(p)
+
+        self.git(path, 'init', '-q')
+        self.git(path, 'add', '.')
+        self.git(path, 'commit', '-q', '-m', 'init')
+        return path
+
+    def git_dir(self, name):
+        conf = dict([(k, v[0]) for k, v in AsyncConfig.FIELDS['directory'].items()])
+        conf.update({'name': name, 'path': name, 'conf_path': self.tmp, 'git_remotes': {}})
+        return GitDir(conf)
+
+    def test_dirs_status_order(self):
+        class Dir(object):
+            def __init__(self, name, delay):
+                self.name = name
+                self.delay = delay
+
+            def status(self, host, slow=False):
+                time.sleep(self.delay)
+                return {'name': self.name}
+
+        # the first dirs finish last
+        dirs = [Dir(str(i), 0.02 * (5 - i)) for i in range(6)]
+        start = time.time()
+        names = [st['name'] for st in self.host.dirs_status(dirs, jobs=6)]
+        self.assertEqual(names, [d.name for d in dirs])
+        self.assertLess(time.time() - start, 0.2)
+
+    def test_usage(self):
+        host = self.host
+        root = os.path.join(host.path, 'd')
+        os.makedirs(os.path.join(root, 'sub', 'deep'))
+        for p in ['a', 'sub/b', 'sub/deep/c']:
+            with open(os.path.join(root, p), 'w') as fd: fd.write('x' * 5000)
+
+        usage = host.usage(root)
+        self.assertEqual(usage['files'], 3)
+        self.assertEqual(BaseHost.usage(host, root), usage)
+
+        # only the changed directory gets listed again
+        index = dirindex.load_index(root)
+        with open(os.path.join(root, 'sub', 'new'), 'w') as fd: fd.write('x' * 5000)
+        updated = dirindex.update_index(root, index)
+        self.assertIs(updated['sub/deep'], index['sub/deep'])
+        self.assertIsNot(updated['sub'], index['sub'])
+
+        added = host.usage(root)
+        self.assertEqual(added['files'], 4)
+        self.assertGreater(added['bytes'], usage['bytes'])
+
+        os.remove(os.path.join(root, 'a'))
+        shutil.rmtree(os.path.join(root, 'sub', 'deep'))
+        removed = host.usage(root)
+        self.assertEqual(removed['files'], 2)
+        self.assertLess(removed['bytes'], added['bytes'])
+        self.assertEqual(BaseHost.usage(host, root), removed)
+        self.assertEqual(sorted(dirindex.load_index(root).keys()), ['', 'sub'])
+
+    def test_git_numfiles(self):
+        path = self.git_repo('repo', ['a', 'b', 'c'])
+        os.makedirs(os.path.join(path, 'sub'))
+        with open(os.path.join(path, 'sub', 'd'), 'w') as fd: fd.write('d')
+        self.git(path, 'add', 'sub/d')
+
+        listed = subprocess.check_output(['git', 'ls-files'], cwd=path).decode().split()
+        self.assertEqual(len(listed), 4)
+        self.assertEqual(dirindex.git_index_count(path), 4)
+        self.assertEqual(self.host.git_numfiles(path), 4)
+
+        # the shell version reads the header too, without falling back to listing files
+        run_cmd = self.host.run_cmd
+        def no_listing(cm, **kwargs):
+            self.assertNotIn('ls-files', cm)
+            return run_cmd(cm, **kwargs)
+        self.host.run_cmd = no_listing
+        self.assertEqual(BaseHost.git_numfiles(self.host, path), 4)
+
+        # not a repo
+        self.assertEqual(dirindex.git_index_count(self.host.path), None)
+
+    def test_status_cache(self):
+        path = self.git_repo('repo', ['a'])
+        d = self.git_dir('repo')
+        host = self.host
+
+        # changes within the same second must show, so age the index
+        index = os.path.join(path, '.git', 'index')
+        aged = int(time.time()) - 100
+        os.utime(index, (aged, aged))
+
+        key = d.status_key(host)
+        self.assertEqual(key, BaseHost.status_key(host, d, path))
+
+        cache = StatusCache(host, ttl=60)
+        cache.put(d, key, False, {'numfiles': 1})
+        self.assertEqual(cache.get(d, d.status_key(host)), {'numfiles': 1})
+        self.assertEqual(cache.get(d, d.status_key(host), slow=True), None)
+        cache.save()
+        self.assertEqual(StatusCache(host, ttl=60).get(d, key), {'numfiles': 1})
+        self.assertEqual(StatusCache(host, ttl=60, refresh=True).get(d, key), None)
+
+        # the index changes
+        with open(os.path.join(path, 'b'), 'w') as fd: fd.write('b')
+        self.git(path, 'add', 'b')
+        added = d.status_key(host)
+        self.assertNotEqual(added, key)
+        self.assertEqual(cache.get(d, added), None)
+
+        # HEAD changes
+        os.utime(index, (aged, aged))
+        before = d.status_key(host)
+        self.git(path, 'commit', '-q', '-m', 'b')
+        os.utime(index, (aged, aged))
+        self.assertNotEqual(d.status_key(host), before)
+        self.assertEqual(d.status_key(host), BaseHost.status_key(host, d, path))
+
+        # the entry expires
+        key = d.status_key(host)
+        cache.put(d, key, False, {'numfiles': 2})
+        self.assertEqual(cache.get(d, key), {'numfiles': 2})
+        cache.entries[d.name]['time'] = time.time() - 61
+        self.assertEqual(cache.get(d, key), None)
+
+
+class ConfigCacheTests(unittest.TestCase):
+
+    CONF = '\n'.join(['[async]', '[host_defaults]', '[directory_defaults]',
+                      '[remote_defaults]', '[instance_defaults]',
+                      '[directory docs]', 'type = rsync', 'path = $ASYNC_TEST_DOCS',
+                      '[host laptop]', 'type = directory', 'path = %(path)s', 'dirs = docs',
+                      'vol_keys = %(path)s/keys', 'hostname = %(hostname)s', ''])
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmp, 'cache')
+        os.environ['ASYNC_TEST_DOCS'] = 'docs'
+
+        self.write('laptop')
+        with open(os.path.join(self.tmp, 'keys'), 'w') as fd: fd.write('key')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def write(self, hostname):
+        with open(os.path.join(self.tmp, 'async.conf'), 'w') as fd:
+            fd.write(self.CONF % {'path': self.tmp, 'hostname': hostname})
+
+    def load(self):
+        """Returns the config, and whether it was parsed instead of taken from the cache.
+        A cached config skips reading the files, so it has no sections."""
+        conf = load_config(self.tmp)
+        return conf, len(conf.sections()) > 0
+
+    def test_invalidation(self):
+        conf, parsed = self.load()
+        self.assertTrue(parsed)
+        conf, parsed = self.load()
+        self.assertFalse(parsed)
+        self.assertEqual(conf.directory['docs']['path'], 'docs')
+        self.assertEqual(list(conf.host['laptop']['dirs'].keys()), ['docs'])
+
+        # a config file changes
+        self.write('laptop.lan')
+        conf, parsed = self.load()
+        self.assertTrue(parsed)
+        self.assertEqual(conf.host['laptop']['hostname'], 'laptop.lan')
+        self.assertFalse(self.load()[1])
+
+        # a referenced key file changes
+        keys = os.path.join(self.tmp, 'keys')
+        os.utime(keys, (time.time() - 100, time.time() - 100))
+        self.assertTrue(self.load()[1])
+        self.assertFalse(self.load()[1])
+
+        # an environment variable the paths expand changes
+        os.environ['ASYNC_TEST_DOCS'] = 'papers'
+        conf, parsed = self.load()
+        self.assertTrue(parsed)
+        self.assertEqual(conf.directory['docs']['path'], 'papers')
+        self.assertFalse(self.load()[1])
+
+
+class SshConfigTests(unittest.TestCase):
+
+    def test_config_files(self):
+        home = tempfile.mkdtemp()
+        environ = dict(os.environ)
+        try:
+            os.environ['HOME'] = home
+            os.makedirs(os.path.join(home, '.ssh', 'conf.d'))
+            files = {'.ssh/config':      'Include conf.d/*\nHost x\n  Include ~/extra\n',
+                     '.ssh/conf.d/a':    'Host a\n',
+                     '.ssh/conf.d/b':    'Include ~/.ssh/config\n',
+                     'extra':            'Host e\n'}
+            for p, data in files.items():
+                with open(os.path.join(home, p), 'w') as fd: fd.write(data)
+
+            found = SSHConnection().config_files()
+            self.assertEqual(found[0:4], [os.path.join(home, p) for p in
+                                          ['.ssh/config', '.ssh/conf.d/a', '.ssh/conf.d/b', 'extra']])
+            self.assertEqual(found[4], '/etc/ssh/ssh_config')
+
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(home)
+
+
+class WaiterTests(unittest.TestCase):
+
+    class Ssh(object):
+        def __init__(self, conf):
+            self.conf = conf
+
+        def ssh_config(self, hostname):
+            return self.conf
+
+    def test_wait_for(self):
+        calls = []
+        def cond():
+            calls.append(1)
+            return len(calls) >= 3
+
+        ok, elapsed, polls = waiter.wait_for(cond, timeout=10, initial=0.01)
+        self.assertTrue(ok)
+        self.assertEqual(polls, 3)
+        self.assertLess(elapsed, 1)
+
+        ok, elapsed, polls = waiter.wait_for(lambda: False, timeout=0.2, initial=0.01, maximum=0.05)
+        self.assertFalse(ok)
+        self.assertGreaterEqual(elapsed, 0.2)
+        self.assertLess(elapsed, 1)
+
+    def test_wait_ssh_proxy(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+        host = SshHost.__new__(SshHost)
+        host.name = host.ssh_hostname = 'test'
+        host._resolved = True
+        host._ip = None
+        host.ssh_args = []
+        host.check_ssh = lambda: True
+
+        # nothing listens on the port, but through a proxy only ssh itself can tell
+        host.ssh = self.Ssh({'hostname': '127.0.0.1', 'port': str(port), 'proxyjump': 'gw'})
+        self.assertTrue(host.wait_ssh(timeout=0.3))
+        host.ssh = self.Ssh({'hostname': '127.0.0.1', 'port': str(port), 'proxyjump': 'none'})
+        self.assertFalse(host.wait_ssh(timeout=0.3))
+        host.ssh_args = ['-o ProxyCommand=nc gw 22']
+        self.assertTrue(host.wait_ssh(timeout=0.3))
+        sock.close()
+
+    def test_tcp_probe(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        port = sock.getsockname()[1]
+        self.assertTrue(waiter.tcp_probe('127.0.0.1', port))
+        sock.close()
+        self.assertFalse(waiter.tcp_probe('127.0.0.1', port))
+        self.assertFalse(waiter.tcp_probe(None))
+
+    def test_tcp_wait(self):
+        import threading
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+        ok, elapsed, attempts = waiter.tcp_wait('127.0.0.1', port, timeout=0.3, initial=0.05)
+        self.assertFalse(ok)
+        self.assertGreater(attempts, 1)
+        self.assertLess(elapsed, 1)
+
+        # start listening a while after we begin waiting
+        timer = threading.Timer(0.3, sock.listen, [1])
+        timer.start()
+        ok, elapsed, attempts = waiter.tcp_wait('127.0.0.1', port, timeout=5, initial=0.05)
+        timer.join()
+        sock.close()
+        self.assertTrue(ok)
+        self.assertGreaterEqual(elapsed, 0.25)
+        self.assertLess(elapsed, 2)
+        self.assertFalse(waiter.tcp_wait(None)[0])
+
+
+class MountsTests(unittest.TestCase):
+
+    def test_parse_probe(self):
+        raw = '\n'.join(['#mountinfo',
+                         '22 1 8:2 / / rw,relatime shared:1 - ext4 /dev/sda2 rw',
+                         '40 22 253:0 / /mnt/my\\040data rw shared:2 - ext4 /dev/mapper/data rw',
+                         '#swaps',
+                         'Filename    Type    Size    Used    Priority',
+                         '/swapfile   file    1024    0       -2',
+                         '#mapper',
+                         'control',
+                         'data',
+                         '#paths',
+                         '+/mnt/my data',
+                         '-',
+                         '+/swapfile', ''])
+        probe = mounts.parse_probe(raw, ['/mnt/my data', '/mnt/other', '/swapfile'])
+        self.assertEqual(probe['mapper'], set(['control', 'data']))
+        self.assertEqual(probe['swaps'], set(['/swapfile']))
+        self.assertEqual(probe['paths']['/mnt/other'], None)
+        self.assertTrue(mounts.is_mounted(probe, '/mnt/my data'))
+        self.assertFalse(mounts.is_mounted(probe, '/mnt/other'))
+        self.assertFalse(mounts.is_mounted(probe, '/swapfile'))
+
+    def test_batch_script(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, 'out')
+            stages = [[('write key', 'printf %%s "$key" > %s' % out, "it's a secret"),
+                       ('fail', 'false', None),
+                       ('succeed', 'true', None)],
+                      [('never run', 'touch %s.2' % out, None)]]
+            script, stdin = mounts.batch_script(stages)
+            proc = subprocess.Popen(['sh', '-c', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output = proc.communicate(stdin.encode())[0].decode()
+
+            self.assertEqual(proc.returncode, 1)
+            self.assertEqual(mounts.failed_actions(output), [1])
+            with open(out, 'r') as fd:
+                self.assertEqual(fd.read(), "it's a secret")
+            self.assertFalse(os.path.exists(out + '.2'))
+            self.assertFalse("secret" in script)
+
+            # sudo authenticates once, after reading the keys and before any action
+            lines = mounts.batch_script(stages, sudo=True)[0].split('\n')
+            self.assertTrue(lines[0].startswith('IFS= read'))
+            self.assertTrue(lines[1].startswith('sudo true'))
+
+
+    def test_schedule(self):
+        names = ['data', 'home']
+        self.assertEqual(mounts.luks_deps('/dev/mapper/home', names), ['home'])
+        self.assertEqual(mounts.luks_deps('/dev/xvdf', names), [])
+        self.assertEqual(mounts.luks_deps('/dev/vg/lv', names), names)
+        self.assertTrue(mounts.inside('/mnt/data/swap', '/mnt/data/'))
+        self.assertFalse(mounts.inside('/mnt/database', '/mnt/data'))
+
+        stages = mounts.schedule([('luks:data', [], 'open data'),
+                                  ('luks:home', [], 'open home'),
+                                  ('mount:/mnt', [], 'mount mnt'),
+                                  ('mount:/mnt/data', ['luks:data', 'mount:/mnt'], 'mount data'),
+                                  ('mount:/home', ['luks:home'], 'mount home'),
+                                  ('swap', ['mount:/mnt/data', 'mount:/gone'], 'swapon')])
+        self.assertEqual(stages, [['open data', 'open home', 'mount mnt'],
+                                  ['mount data', 'mount home'],
+                                  ['swapon']])
+
+        self.assertRaises(ValueError, mounts.schedule, [('a', ['b'], 'a'), ('b', ['a'], 'b')])
+
+
+    def test_batch_script_concurrent(self):
+        stages = [[('sleep %d' % i, 'sleep 0.5', None) for i in range(4)]]
+        script, stdin = mounts.batch_script(stages)
+
+        start = time.time()
+        subprocess.check_call(['sh', '-c', script])
+        self.assertTrue(time.time() - start < 1.5)
+
+
+class StreamWriterTests(unittest.TestCase):
+
+    def test_stream(self):
+        rd, wr = os.pipe()
+        chars = []
+        lines = []
+        writer = StreamWriter(stream=os.fdopen(rd, 'rb'), char_callback=chars.append,
+                              line_callback=lines.append, prefix='  ', encoding='utf-8')
+        writer.start()
+
+        # a multibyte character split between writes
+        data = 'one\ntwo 50%\rtwo 100%\nthr\u00e9e'.encode('utf-8')
+        os.write(wr, data[:-1])
+        time.sleep(0.1)
+        os.write(wr, data[-1:])
+        os.close(wr)
+        writer.join(5)
+
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(lines, ['  one\n', '  two 100%\n'])
+        self.assertEqual(''.join(chars), 'one  two 50%\r  two 100%  thr\u00e9e')
+        self.assertLess(len(chars), 6)
+
+
+class ColorTests(unittest.TestCase):
+
+    def test_color(self):
+        self.assertEqual(ui.color('#*bhost#t: #R10#t%', use_color=False), 'host: 10%')
+        self.assertEqual(ui.color('no codes', use_color=False), 'no codes')
+
+        # '##' escapes a literal '#'
+        self.assertEqual(ui.strip_color(ui.color('#*r##r#Gok', use_color=True)), '#rok')
+        self.assertEqual(ui.strip_color(ui.color('#Y50%#t done', use_color=True)), '50% done')
+
+        # a trailing '#' is not a code
+        self.assertEqual(ui.color('C#', use_color=False), 'C#')
+        self.assertEqual(ui.strip_color(ui.color('C#', use_color=True)), 'C#')
+
+
+class Ec2FakeTests(unittest.TestCase):
+
+    class Host(Ec2Host):
+        # no ssh, the instance never gets past running
+        def check_ssh(self):
+            return False
+
+        def ssh_connect(self, alt_hostname=None):
+            pass
+
+        def ssh_disconnect(self):
+            pass
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = self.cachedir
+
+        ec2fake.reset()
+        delays = dict([(k, 0.002 * v) for k, v in ec2fake.DELAYS.items()])
+        self.region = ec2fake.get_region('test', delays=delays)
+
+        conf = dict([(k, v[0]) for k, v in AsyncConfig.FIELDS['host'].items()])
+        conf.update({'name': 'test', 'path': '/home/test', 'dirs': {}, 'hostname': 'test'})
+        inst = dict([(k, v[0]) for k, v in AsyncConfig.FIELDS['instance'].items()])
+        inst.update({'ec2_ami': 'test-ami', 'ec2_owner': 'test', 'ec2_region': 'test',
+                     'ec2_itype': 't1.micro', 'ec2_backend': 'fake', 'volumes': {}})
+        conf['instance'] = inst
+        self.conf = conf
+        self.host = self.Host(conf)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.cachedir, ignore_errors=True)
+
+    def test_launch_terminate(self):
+        self.assertEqual(self.host.get_state(), 'terminated')
+
+        self.assertTrue(self.host.launch(silent=True))
+        self.assertEqual(self.host.get_state(), 'running')
+        self.assertEqual(self.region.calls.get('run_instances', 0), 1)
+
+        self.assertTrue(self.host.terminate(silent=True))
+        self.assertEqual(self.host.get_state(), 'terminated')
+        self.assertEqual(self.region.calls.get('terminate_instances', 0), 1)
+
+        # a new host does not find the terminated instance either
+        self.assertEqual(self.Host(self.conf).get_state(), 'terminated')
+
+    def test_filtered_lookups(self):
+        self.conf['instance']['volumes'] = {'/dev/sdf': 'vol-a', '/dev/sdg': 'vol-b'}
+        self.assertTrue(self.Host(self.conf).launch(silent=True))
+
+        # instances of other images, and terminated ones of ours, are not picked up
+        conn = ec2fake.connect_to_region('test')
+        other = self.region.add_image('other-ami', owner='test')
+        conn.run_instances(image_id=other['id'])
+        ours = [rec for rec in self.region.instances.values() if rec['image_id'] != other['id']][0]
+        self.region.instances['i-dead'] = dict(ours, id='i-dead', state='terminated', next=None)
+
+        save_cache('ec2-test.json', None)
+        calls = dict(self.region.calls)
+        host = self.Host(self.conf)
+        host.aws_connect()
+        self.assertEqual(host.instance.id, ours['id'])
+        self.assertEqual(host.ami.name, 'test-ami')
+        self.assertEqual(sorted(host.volumes.keys()), ['/dev/sdf', '/dev/sdg'])
+
+        # one filtered call each
+        for name in ['get_all_images', 'get_all_instances', 'get_all_volumes']:
+            self.assertEqual(self.region.calls[name] - calls.get(name, 0), 1)
+
+    def test_set_volumes(self):
+        self.conf['instance']['volumes'] = {'/dev/sdf': 'vol-a', '/dev/sdg': 'vol-b', '/dev/sdh': 'vol-c'}
+        host = self.Host(self.conf)
+        self.assertTrue(host.launch(silent=True))
+        host.wait_for = lambda status, func: BaseHost.wait_for(host, status, func, timeout=0.2)
+        volumes = self.region.volumes
+
+        # vol-b is in use elsewhere, and vol-c never finishes attaching
+        volumes['vol-b'].update({'status': 'attaching', 'instance': 'i-other', 'next': None})
+        def attach(dev, vol):
+            self.region.delays['attach'] = 60 if vol.id == 'vol-c' else 0
+            vol.attach(host.instance.id, dev)
+
+        with self.assertRaises(HostError) as cm:
+            host.set_volumes('attached', attach)
+        msg = str(cm.exception)
+        self.assertIn("/dev/sdg (vol-b): VolumeInUse", msg)
+        self.assertIn("/dev/sdh (vol-c): Timed out, volume is attaching", msg)
+        self.assertNotIn('/dev/sdf', msg)
+        self.assertEqual(volumes['vol-a']['status'], 'attached')
+
+        # volumes already there are left alone
+        for vid in ['vol-b', 'vol-c']:
+            volumes[vid].update({'status': None, 'instance': None, 'device': None, 'next': None})
+        self.region.delays['attach'] = 0
+        calls = self.region.calls['attach_volume']
+        host.attach_volumes(host.instance.id)
+        self.assertTrue(host.check_volumes())
+        self.assertEqual(self.region.calls['attach_volume'] - calls, 2)
+
+        # one volume fails to detach, the others still do
+        volumes['vol-c']['status'] = 'busy'
+        with self.assertRaises(HostError) as cm:
+            host.detach_volumes()
+        msg = str(cm.exception)
+        self.assertIn("/dev/sdh (vol-c): IncorrectState", msg)
+        self.assertNotIn('/dev/sdf', msg)
+        self.assertNotIn('/dev/sdg', msg)
+        self.assertEqual(volumes['vol-a']['status'], None)
+        self.assertEqual(volumes['vol-b']['status'], None)
+
+    def test_id_cache(self):
+        self.assertTrue(self.Host(self.conf).launch(silent=True))
+        entry = load_cache('ec2-test.json')
+        self.assertEqual(entry['ami'], 'test-ami')
+
+        def host():
+            h = self.Host(self.conf)
+            h.discovered = 0
+            load_ami = h.load_ami
+            def func():
+                h.discovered = h.discovered + 1
+                load_ami()
+            h.load_ami = func
+            return h
+
+        # a recent entry spares the discovery
+        h = host()
+        self.assertEqual(h.get_state(), 'running')
+        self.assertEqual(h.discovered, 0)
+        self.assertEqual(h.instance.id, entry['instance_id'])
+
+        # an old one does not, and gets refreshed
+        entry['time'] = time.time() - Ec2Host.ID_CACHE_TTL - 1
+        save_cache('ec2-test.json', entry)
+        h = host()
+        self.assertEqual(h.get_state(), 'running')
+        self.assertEqual(h.discovered, 1)
+        self.assertGreater(load_cache('ec2-test.json')['time'], entry['time'])
+
+        # an instance terminated behind our back is not trusted
+        conn = ec2fake.connect_to_region('test')
+        conn.terminate_instances([entry['instance_id']])
+        def terminated():
+            res = conn.get_all_instances(instance_ids=[entry['instance_id']])
+            return res[0].instances[0].state == 'terminated'
+        self.assertTrue(waiter.wait_for(terminated, timeout=5, initial=0.01)[0])
+        h = host()
+        self.assertEqual(h.get_state(), 'terminated')
+        self.assertEqual(h.discovered, 1)
+        self.assertEqual(load_cache('ec2-test.json'), None)
+
+    def test_state_scope(self):
+        host = self.Host(self.conf)
+        self.assertTrue(host.launch(silent=True))
+
+        host.probes = 0
+        get_state = host.get_state
+        def func():
+            host.probes = host.probes + 1
+            return get_state()
+        host.get_state = func
+
+        with host.in_state():
+            self.assertEqual(host.probes, 1)
+            self.assertEqual(host.current_state(), 'running')
+            self.assertEqual(host.current_state(), 'running')
+            self.assertEqual(host.probes, 1)
+
+            # the state is probed again once the transition is done
+            self.assertEqual(host.set_state('offline', silent=True), 'offline')
+            self.assertEqual(self.region.instances[host.instance.id]['state'], 'stopped')
+            self.assertEqual(host.probes, 2)
+            self.assertEqual(host.current_state(), 'offline')
+            self.assertEqual(host.probes, 2)
+
+        # outside of a scope nothing is memoized
+        host.current_state()
+        host.current_state()
+        self.assertEqual(host.probes, 4)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -19,6 +19,7 @@
 
 import os
 import re
+import json
 
 import shlex
 import sys
@@ -68,3 +69,61 @@ def read_keys(path):
             if m: keys[m.group(1).strip()] = m.group(2).strip()
 
     return keys
+
+
+
+def cache_path(name):
+    """Returns the path of a file in async's cache directory"""
+    cachedir = os.environ.get('XDG_CACHE_HOME', None) or os.path.expanduser('~/.cache')
+    return os.path.join(cachedir, 'async', name)
+
+
+def load_cache(name, default=None):
+    """Loads a json file from the cache directory. Returns default if missing or broken"""
+    try:
+        with open(cache_path(name), 'r') as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def save_cache(name, data):
+    """Saves data as json in the cache directory. Writes a temporary file and renames it,
+    so concurrent readers never see a partial file."""
+    path = cache_path(name)
+    tmp = '%s.%d' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(tmp, 'w') as fd:
+            json.dump(data, fd)
+        os.rename(tmp, path)
+
+    except (IOError, OSError):
+        if os.path.exists(tmp): os.remove(tmp)
+
+
+
+def _unescape_mountinfo(s):
+    """Undoes the octal escapes the kernel uses for spaces and such in mount tables"""
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), s)
+
+
+def parse_mountinfo(raw):
+    """Parses the contents of /proc/self/mountinfo. Returns a list of dicts with keys
+    mountpoint, root, fstype and source"""
+    mounts = []
+    for line in raw.split('\n'):
+        fields = line.split()
+        if not '-' in fields: continue
+
+        sep = fields.index('-')
+        if sep < 6 or len(fields) < sep + 3: continue
+
+        mounts.append({'root':       _unescape_mountinfo(fields[3]),
+                       'mountpoint': _unescape_mountinfo(fields[4]),
+                       'fstype':     fields[sep + 1],
+                       'source':     _unescape_mountinfo(fields[sep + 2])})
+
+    return mounts
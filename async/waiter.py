@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# async - A tool to manage and sync different machines
+# Copyright 2012,2013 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Polling with exponential backoff. Most state changes we wait for finish within a
+# second or two, while some take minutes, so we poll fast at first and then back off. The
+# delays get some random jitter, so concurrent waiters do not poll in lockstep.
+
+import time
+import errno
+import random
+import select
+import socket
+
+
+def backoff(initial=0.1, maximum=5, factor=2, jitter=0.25):
+    """Generates the delays between polls. Starts at initial seconds and grows by factor
+    up to maximum. Each delay is randomly shortened by up to a fraction jitter."""
+    delay = initial
+    while True:
+        yield delay * (1 - jitter * random.random())
+        delay = min(delay * factor, maximum)
+
+
+def wait_for(cond, timeout=120, **kwargs):
+    """Polls cond until it returns true or timeout seconds pass. The last poll happens at
+    the deadline. Extra keyword arguments are passed to backoff. Returns a tuple (ok,
+    elapsed, polls)."""
+    start = time.time()
+    deadline = start + timeout
+    polls = 0
+
+    for delay in backoff(**kwargs):
+        polls = polls + 1
+        if cond():
+            return (True, time.time() - start, polls)
+
+        now = time.time()
+        if now >= deadline:
+            return (False, now - start, polls)
+
+        time.sleep(min(delay, deadline - now))
+
+
+def tcp_probe(host, port=22, timeout=1):
+    """Returns true if something accepts tcp connections on host:port. Much cheaper than a
+    full ssh handshake to tell whether a machine finished booting."""
+    if host == None:
+        return False
+
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+        sock.close()
+        return True
+
+    except (socket.error, socket.timeout, OSError):
+        return False
+
+
+
+def tcp_wait(host, port=22, timeout=60, attempt_timeout=3, **kwargs):
+    """Waits until host accepts tcp connections on port. Instead of waiting for each
+    attempt to time out, starts a new one at every backoff step and keeps the older ones
+    pending for up to attempt_timeout seconds, so a SYN lost while the machine boots does not
+    cost a full retransmission timeout. Extra keyword arguments are passed to backoff.
+    Returns a tuple (ok, elapsed, attempts)."""
+    start = time.time()
+    deadline = start + timeout
+    kwargs.setdefault('initial', 0.2)
+    kwargs.setdefault('maximum', 1)
+
+    if host == None:
+        return (False, 0, 0)
+
+    try:
+        family, stype, proto, cname, addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+    except (socket.error, TypeError, UnicodeError):
+        return (False, time.time() - start, 0)
+
+    pending = {}
+    attempts = 0
+
+    try:
+        for delay in backoff(**kwargs):
+            # start a new attempt
+            sock = socket.socket(family, stype, proto)
+            sock.setblocking(False)
+            attempts = attempts + 1
+            err = sock.connect_ex(addr)
+            if err == 0:
+                sock.close()
+                return (True, time.time() - start, attempts)
+            elif err in [errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN]:
+                pending[sock] = time.time()
+            else:
+                sock.close()
+
+            # wait for any pending attempt until the next step
+            end = min(time.time() + delay, deadline)
+            while len(pending) > 0 and time.time() < end:
+                rd, wr, ex = select.select([], list(pending.keys()), [], max(0, end - time.time()))
+                for s in wr:
+                    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    del pending[s]
+                    s.close()
+                    if err == 0:
+                        return (True, time.time() - start, attempts)
+
+            if len(pending) == 0 and time.time() < end:
+                time.sleep(end - time.time())
+
+            # give up on stale attempts
+            now = time.time()
+            for s, t in list(pending.items()):
+                if now - t > attempt_timeout:
+                    del pending[s]
+                    s.close()
+
+            if now >= deadline:
+                return (False, now - start, attempts)
+
+    finally:
+        for s in pending.keys():
+            s.close()
+
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# async - A tool to manage and sync different machines
+# Copyright 2012-2014 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Drives an ec2 host through launch -> mounted -> terminated against the in-process ec2
+# fake, and reports the time and number of api calls of each step. The fake's delays are
+# scaled down, so a run takes a few seconds. ssh and the mounts are simulated.
+#
+#   python bench/ec2_lifecycle.py [volumes] [scale]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async.config import AsyncConfig
+from async.hosts import Ec2Host
+import async.hosts.ec2fake as ec2fake
+import async.archui as ui
+
+
+class BenchHost(Ec2Host):
+    """An ec2 host whose ssh side is simulated. sshd comes up a while after the instance
+    is running."""
+
+    SSHD_DELAY = 5
+
+    def __init__(self, conf, scale):
+        super(BenchHost, self).__init__(conf)
+        self.sshd_delay = self.SSHD_DELAY * scale
+        self.running_since = None
+        self.mounted = False
+
+    def ssh_ready(self):
+        if self.instance == None or self.instance.state != 'running':
+            self.running_since = None
+            return False
+
+        if self.running_since == None: self.running_since = time.time()
+        return time.time() - self.running_since >= self.sshd_delay
+
+    def check_ssh(self):
+        self.update(self.instance)
+        return self.ssh_ready()
+
+    def ssh_connect(self, alt_hostname=None):
+        pass
+
+    def ssh_disconnect(self):
+        pass
+
+    def mount_devices(self):
+        self.mounted = True
+
+    def umount_devices(self):
+        self.mounted = False
+
+    def check_devices(self):
+        return self.mounted
+
+
+def host_conf(volumes):
+    conf = dict([(k, v[0]) for k, v in AsyncConfig.FIELDS['host'].items()])
+    conf.update({'name': 'bench', 'path': '/home/bench', 'dirs': {}, 'hostname': 'bench'})
+
+    inst = dict([(k, v[0]) for k, v in AsyncConfig.FIELDS['instance'].items()])
+    inst.update({'ec2_ami': 'bench-ami', 'ec2_owner': 'bench', 'ec2_region': 'bench',
+                 'ec2_itype': 't1.micro', 'ec2_backend': 'fake',
+                 'volumes': dict([('/dev/xvd%s' % chr(ord('f') + i), 'vol-bench%d' % i)
+                                  for i in range(volumes)])})
+    conf['instance'] = inst
+    return conf
+
+
+def step(name, region, func):
+    calls = dict(region.calls)
+    t0 = time.time()
+    ret = func()
+    elapsed = time.time() - t0
+
+    ncalls = sum(region.calls.values()) - sum(calls.values())
+    print("%-12s  %7.2f s  %4d api calls  -> %s" % (name, elapsed, ncalls, ret))
+    return elapsed, ret
+
+
+def main(args):
+    volumes = int(args[0]) if len(args) > 0 else 4
+    scale = float(args[1]) if len(args) > 1 else 0.05
+
+    ui.set_loglevel(1)
+
+    ec2fake.reset()
+    region = ec2fake.get_region('bench', delays=dict([(k, v * scale) for k, v in ec2fake.DELAYS.items()]))
+
+    # do not pick up ids cached by a previous run
+    cachedir = tempfile.mkdtemp(prefix='async-bench-')
+    os.environ['XDG_CACHE_HOME'] = cachedir
+
+    try:
+        host = BenchHost(host_conf(volumes), scale)
+
+        steps = [('launch',    lambda: host.launch(silent=True)),
+                 ('mounted',   lambda: host.set_state('mounted', silent=True) == 'mounted'),
+                 ('offline',   lambda: host.set_state('offline', silent=True) == 'offline'),
+                 ('mounted',   lambda: host.set_state('mounted', silent=True) == 'mounted'),
+                 ('terminate', lambda: host.terminate(silent=True))]
+
+        total = 0
+        failed = []
+        for name, func in steps:
+            elapsed, ret = step(name, region, func)
+            total = total + elapsed
+            if ret != True: failed.append(name)
+
+        print("%-12s  %7.2f s  %4d api calls" % ('total', total, sum(region.calls.values())))
+        for name, n in sorted(region.calls.items()):
+            print("    %-20s %4d" % (name, n))
+
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+
+    if len(failed) > 0:
+        print("failed steps: %s" % ', '.join(failed))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80
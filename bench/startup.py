@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# async - A tool to manage and sync different machines
+# Copyright 2012-2014 Abdó Roig-Maranges <abdo.roig@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures the startup time of async. Each sample runs in a fresh interpreter, so it
+# includes the interpreter startup itself, as the user sees it. The bare interpreter goes
+# first, and the time async adds on top is checked against a budget relative to it. Also
+# reports heavy modules that got loaded on startup, which should only be imported when
+# actually needed.
+#
+#   python bench/startup.py [runs]
+
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that should not be loaded just by importing async
+HEAVY = ['boto', 'systemd', 'dateutil', 'curses', 'concurrent.futures', 'async.directories']
+
+SAMPLES = [
+    ('python', [sys.executable, '-c', 'pass']),
+    ('import async', [sys.executable, '-c', 'import async']),
+    ('async --version', [sys.executable, os.path.join(ROOT, 'async.py'), '--version']),
+]
+
+# what async may add on top of the bare interpreter startup, in multiples of it. Relative,
+# so the budget holds on slow and fast machines alike.
+BUDGET = 5
+
+
+def timeit(args, runs):
+    times = []
+    for i in range(runs):
+        t0 = time.time()
+        subprocess.check_call(args, cwd=ROOT, stdout=subprocess.DEVNULL)
+        times.append(time.time() - t0)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def loaded_modules():
+    code = "import sys, async; print('\\n'.join(sys.modules.keys()))"
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    mods = set(out.decode('utf-8').split())
+    return [m for m in HEAVY if m in mods]
+
+
+def main(args):
+    runs = int(args[0]) if len(args) > 0 else 10
+
+    ret = 0
+    base = None
+    for name, cmdargs in SAMPLES:
+        best, median = timeit(cmdargs, runs)
+        if base == None:
+            base = median
+            print("%-20s  best %6.1f ms   median %6.1f ms" % (name, 1000*best, 1000*median))
+            continue
+
+        over = median - base > BUDGET * base
+        print("%-20s  best %6.1f ms   median %6.1f ms   +%.1fx%s" % (name, 1000*best, 1000*median,
+                                                                   (median - base) / base,
+                                                                   '   over budget' if over else ''))
+        if over: ret = 1
+
+    heavy = loaded_modules()
+    if len(heavy) > 0:
+        print("loaded on startup: %s" % ', '.join(heavy))
+        ret = 1
+
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+
+
+# vim: expandtab:shiftwidth=4:tabstop=4:softtabstop=4:textwidth=80